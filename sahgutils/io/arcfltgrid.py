@@ -2,31 +2,73 @@
 
 This module contains some simple functions to make it easier
 to read and plot the data contained in the binary grid files
-produced by ArcGIS.
+produced by ArcGIS, and to write arrays and Rasters to the same
+format (a .flt file of 32-bit floats described by an ESRI .hdr file).
 
 """
-import sys
+import os
+from glob import glob
+from multiprocessing import Pool
+
 import numpy as np
 from numpy import ma
 
+from arraytools import Raster
+
+# Number of rows written at a time, bounds the temporary arrays
+_block_rows = 256
+
+def _dtype(byteorder):
+    """The float32 dtype of a header byteorder value."""
+    byteorder = byteorder.upper()
+    if byteorder in ('LSBFIRST', 'I', 'LITTLE'):
+        return np.dtype('<f4')
+    elif byteorder in ('MSBFIRST', 'M', 'BIG'):
+        return np.dtype('>f4')
 
-def read_bin(fname):
+    raise ValueError('Unknown byteorder: %s' % byteorder)
+
+def read_bin(fname, byteorder='LSBFIRST'):
     """Read data from a ArcGIS binary file into an array.
     
     Read the data from a binary file created by ArcGIS into
     a Numpy array. The file is expected to be in binary format
-    with floating point precision. e.g. ".flt" extension.
+    with floating point precision. e.g. ".flt" extension, in the
+    given `byteorder` (from the header, see `read_header`). The
+    data are returned as native float32.
 
     """
-    
-    f = open(fname, "rb")
-    raw = f.read()
-    f.close()
-    data = np.fromstring(raw, 'f')
-    if sys.byteorder == 'big':
-        data = data.byteswap()
 
-    return data
+    data = np.fromfile(fname, dtype=_dtype(byteorder))
+
+    return data.astype(np.float32, copy=False)
+
+def read_header(bingrid_name):
+    """Read the header of an ArcGIS binary grid into a dictionary.
+
+    The keys are the lower case header names, e.g. 'ncols', 'nrows',
+    'xllcorner' (or 'xllcenter'), 'cellsize', 'nodata_value' and
+    'byteorder'. The byteorder defaults to 'LSBFIRST' if it is not
+    given.
+
+    """
+
+    header = {'byteorder': 'LSBFIRST'}
+    with open(bingrid_name + '.hdr', 'r') as f:
+        for line in f:
+            items = line.split()
+            if len(items) < 2:
+                continue
+
+            key = items[0].lower()
+            if key == 'byteorder':
+                header[key] = items[1].upper()
+            elif key in ('ncols', 'nrows'):
+                header[key] = int(items[1])
+            else:
+                header[key] = float(items[1])
+
+    return header
 
 def read(bingrid_name):
     """Read the data field and headers from an ArcGIS binary grid
@@ -37,13 +79,14 @@ def read(bingrid_name):
     """
 
     li_headers=read_headers(bingrid_name)
+    header = read_header(bingrid_name)
 
-    rows = li_headers[1] # fixed for UM grid
-    cols = li_headers[0] # fixed for UM grid
+    rows = header['nrows']
+    cols = header['ncols']
     
     bin_name = bingrid_name + '.flt'
 
-    a = read_bin(bin_name)
+    a = read_bin(bin_name, header['byteorder'])
 
     a = a.reshape(rows, cols)
 
@@ -80,6 +123,129 @@ def read_headers(bingrid_name):
             
     return li_headers
 
+def read_raster(bingrid_name, mmap=False):
+    """Read an ArcGIS binary grid into a Raster.
+
+    The origin of the Raster is the centre of the lower left cell, from
+    the header's xllcorner/yllcorner or xllcenter/yllcenter. Cells
+    equal to the header's NODATA_value are set to NaN, unless `mmap`
+    is True, when the data are a read-only memory map of the .flt file
+    and are returned unchanged.
+
+    """
+    header = read_header(bingrid_name)
+
+    rows, cols = header['nrows'], header['ncols']
+    cellsize = header['cellsize']
+
+    if 'xllcenter' in header:
+        x0, y0 = header['xllcenter'], header['yllcenter']
+    else:
+        x0 = header['xllcorner'] + 0.5*cellsize
+        y0 = header['yllcorner'] + 0.5*cellsize
+
+    dtype = _dtype(header['byteorder'])
+    if mmap:
+        data = np.memmap(bingrid_name + '.flt', dtype=dtype, mode='r',
+                         shape=(rows, cols))
+    else:
+        data = read_bin(bingrid_name + '.flt', header['byteorder'])
+        data = data.reshape(rows, cols)
+        if 'nodata_value' in header:
+            data[data == header['nodata_value']] = np.nan
+
+    return Raster(data, x0, y0, cellsize, cellsize)
+
+def _format(value):
+    if value == int(value):
+        return '%d' % value
+    return '%.12g' % value
+
+def write(bingrid_name, data, x0=None, y0=None, cellsize=None,
+          nodata_value=-9999, byteorder='LSBFIRST'):
+    """Write an array to an ArcGIS binary grid.
+
+    The data are written as 32-bit floats to bingrid_name + '.flt'
+    with a header, bingrid_name + '.hdr', which may be imported into
+    ArcGIS. Rows are converted and written a block at a time, so the
+    data may be a memory map or a Raster too large to copy.
+
+    Parameters
+    ----------
+    bingrid_name : string
+        The name of the grid, without the .flt/.hdr extension.
+    data : array_like
+        A 2D array or masked array, with the first row the most
+        northerly. Masked cells are written as `nodata_value`. If
+        `data` is a Raster, its origin and grid spacing are used.
+    x0, y0 : float, optional
+        The centre of the lower left cell, required unless `data` is a
+        Raster.
+    cellsize : float, optional
+        The grid spacing, required unless `data` is a Raster.
+    nodata_value : float, optional
+        The value of cells with no data.
+    byteorder : {'LSBFIRST', 'MSBFIRST'}, optional
+        The byte order of the .flt file.
+
+    """
+    if isinstance(data, Raster):
+        if data.dx != data.dy:
+            raise ValueError('ArcGIS grids must have square cells')
+        if x0 is None:
+            x0, y0 = data.x0, data.y0
+        if cellsize is None:
+            cellsize = data.dx
+
+    if x0 is None or y0 is None or cellsize is None:
+        raise ValueError('The grid origin and cellsize must be given')
+
+    dtype = _dtype(byteorder)
+    rows, cols = np.shape(data)
+
+    with open(bingrid_name + '.flt', 'wb') as fp:
+        for start in range(0, rows, _block_rows):
+            block = data[start:start+_block_rows]
+            if ma.isMaskedArray(block):
+                block = block.filled(nodata_value)
+            np.asarray(block, dtype=dtype).tofile(fp)
+
+    header = [('ncols', cols), ('nrows', rows),
+              ('xllcenter', _format(x0)), ('yllcenter', _format(y0)),
+              ('cellsize', _format(cellsize)),
+              ('NODATA_value', _format(nodata_value)),
+              ('byteorder', byteorder.upper())]
+
+    with open(bingrid_name + '.hdr', 'w') as fp:
+        for key, value in header:
+            fp.write('%-14s%s\n' % (key, value))
+
+def convert_directory(func, directory, pattern, processes=None):
+    """Convert all the matching files in a directory to ArcGIS grids.
+
+    Applies `func`, e.g. mpegrib.write_arcgis_fltfile, to each file in
+    `directory` matching `pattern`, using a pool of `processes` worker
+    processes (by default one per CPU). `func` must be a module level
+    function so that it can be sent to the workers.
+
+    Returns
+    -------
+    results : list
+        The results of `func` for each file, in sorted file name order.
+
+    """
+    fnames = sorted(glob(os.path.join(directory, pattern)))
+
+    if processes == 1 or len(fnames) < 2:
+        return [func(fname) for fname in fnames]
+
+    pool = Pool(processes)
+    try:
+        return pool.map(func, fnames)
+    finally:
+        pool.close()
+        pool.join()
+
 def plot(bin_name, fig_name, title='Raster Plot'):
     """Create a plot of the data in an ArcGIS binary file."""
     import pylab as pl
@@ -1,4 +1,5 @@
 import struct
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -7,6 +8,8 @@ class BMPFile:
 
     This class handles a very specific subset of valid bitmap
     files. Namely 256 colour (8-bit) colour paletted bitmap files.
+    Only the header and palette are read when the file is opened, the
+    pixel data are memory mapped when first requested.
 
     Example usage:
 
@@ -24,12 +27,15 @@ class BMPFile:
     >>> bmp_data = bmp_file.data()
     >>> print(bmp_data)
 
+    >>> print('---COLOURS---')
+    >>> bmp_rgba = bmp_file.rgba()
+    >>> print(bmp_rgba.shape)
+
     """
     def __init__(self, filename):
         self.filename = filename
 
         self._header_fmt = '=2sihhiiiihhiiiiii'
-        self._palette_fmt = 'BBBB'*256
 
         self._header_length = 54
         self._palette_length = 1024
@@ -37,7 +43,9 @@ class BMPFile:
         with open(filename, 'rb') as self._fp:
             self._read_header()
             self._read_palette()
-            self._read_data()
+
+        # The pixel data are mapped on first access
+        self._data = None
 
     # Internal methods
 
@@ -45,30 +53,49 @@ class BMPFile:
     # http://blog.cykerway.com/post/65 accessed 2013-11-13
     def _read_header(self):
         #read header
-        header_fmt = '=2sihhiiiihhiiiiii'
-        header_length = 54
+        s_header = self._fp.read(self._header_length)
+        self._header = struct.unpack(self._header_fmt, s_header)
+
+        if self._header[9] != 8 or self._header[10] != 0:
+            raise ValueError('Only uncompressed 8-bit bitmaps '
+                             'are supported')
+
+        width = self._header[6]
+        height = self._header[7]
 
-        s_header = self._fp.read(header_length)
-        self._header = struct.unpack(header_fmt, s_header)
+        # Rows are padded to a multiple of 4 bytes and are stored
+        # bottom-up unless the height is negative
+        self._rows = abs(height)
+        self._cols = width
+        self._stride = (width + 3) & ~3
+        self._bottom_up = height > 0
 
     def _read_palette(self):
-        #read palette
-        palette_fmt = 'BBBB'*256
-        palette_length = 1024
+        #read palette, which follows the (variable length) info header
+        self._fp.seek(14 + self._header[5])
 
-        s_palette = self._fp.read(palette_length)
-        self._palette = struct.unpack(palette_fmt, s_palette)
+        s_palette = self._fp.read(self._palette_length)
+        s_palette += '\x00'*(self._palette_length - len(s_palette))
 
-    def _read_data(self):
-        #read data
-        data_string = self._fp.read()
+        # Palette stored in BGRA order in BMP
+        palette = np.frombuffer(s_palette, dtype=np.uint8).reshape(256, 4)
+        self._palette = palette[:, [2, 1, 0, 3]]
+        self._palette.flags.writeable = False
 
-        self._data = np.fromstring(data_string, np.int8)
+    def _map_data(self):
+        #map data
+        data = np.memmap(self.filename, dtype=np.uint8, mode='r',
+                         offset=self._header[4],
+                         shape=(self._rows, self._stride))
 
-        self._data = self._data.reshape(self._header[7], self._header[6])
+        # Drop the row padding
+        data = data[:, :self._cols]
 
         # Bitmap data origin is stored at bottom left
-        self._data = np.flipud(self._data)
+        if self._bottom_up:
+            data = data[::-1]
+
+        self._data = data
 
     # API methods
     def header(self):
@@ -104,25 +131,160 @@ class BMPFile:
         Returns the colour palette entries in a list of RGBA tuples.
 
         """
-        colour_palette = []
-        i = 0
-        while i < len(self._palette):
-            # Palette stored in BGRA order in BMP
-            blue = self._palette[i]
-            green = self._palette[i+1]
-            red = self._palette[i+2]
-            alpha = self._palette[i+3]
+        return [tuple(colour) for colour in self._palette.tolist()]
 
-            colour_palette.append((red, green, blue, alpha))
+    def palette_lut(self):
+        """Return the palette as a lookup table.
 
-            i += 4
+        Returns the colour palette as a read-only (256, 4) uint8 numpy
+        array of RGBA values, which can be indexed by the image data.
 
-        return colour_palette
+        """
+        return self._palette
 
     def data(self):
         """Return the data portion of the image.
 
-        Returns the image data as an 8-bit integer 2D numpy array.
+        Returns the image data as an 8-bit unsigned integer 2D numpy
+        array, with the first row at the top of the image. The array
+        is a read-only view of a memory map of the file, so pixels are
+        only read from disk as they are accessed.
 
         """
+        if self._data is None:
+            self._map_data()
+
         return self._data
+
+    def read_rows(self, start, stop):
+        """Read a range of image rows.
+
+        Returns a copy of rows `start` to `stop` (counted from the top
+        of the image, `stop` exclusive) as an 8-bit unsigned integer
+        2D numpy array. Only the requested rows are read from the file.
+
+        """
+        start, stop, step = slice(start, stop).indices(self._rows)
+        nrows = max(stop - start, 0)
+
+        if self._bottom_up:
+            first = self._rows - stop
+        else:
+            first = start
+
+        with open(self.filename, 'rb') as fp:
+            fp.seek(self._header[4] + first*self._stride)
+            data = np.fromfile(fp, dtype=np.uint8,
+                               count=nrows*self._stride)
+
+        data = data.reshape(nrows, self._stride)[:, :self._cols]
+        if self._bottom_up:
+            data = data[::-1]
+
+        return np.ascontiguousarray(data)
+
+    def rgba(self, out=None):
+        """Return the image as RGBA colours.
+
+        The image data are mapped through the palette with a single
+        lookup, returning a (rows, cols, 4) uint8 array. The result is
+        written into `out` if it is given.
+
+        """
+        return np.take(self._palette, self.data(), axis=0, out=out)
+
+    def values(self, lut, out=None):
+        """Map the image data to physical values.
+
+        Parameters
+        ----------
+        lut : array_like
+            A lookup table with 256 entries along its first axis, giving
+            the value (e.g. rain rate) for each palette index.
+        out : ndarray, optional
+            An array to write the result into, with shape
+            (rows, cols) + lut.shape[1:] and the same dtype as `lut`.
+
+        Returns
+        -------
+        values : ndarray
+            The image data mapped through `lut`.
+
+        """
+        lut = np.asarray(lut)
+        if lut.shape[0] != 256:
+            raise ValueError('lut must have 256 entries, not %d' %
+                             lut.shape[0])
+
+        return np.take(lut, self.data(), axis=0, out=out)
+
+def read_sequence(filenames, out=None, memmap_fname=None, threads=4):
+    """Read a sequence of 8-bit BMP files into a 3D array.
+
+    The files must all have the same dimensions. Only the headers are
+    read to check this before the pixel data are copied into a single
+    (time, rows, cols) array, using a pool of `threads` threads for the
+    file I/O.
+
+    Parameters
+    ----------
+    filenames : sequence of strings
+        The names of the BMP files, in time order.
+    out : ndarray, optional
+        A uint8 array with shape (len(filenames), rows, cols) to fill
+        with the image data.
+    memmap_fname : string, optional
+        If given (and `out` is None) the data are written to a memory
+        mapped array backed by this file, rather than held in memory.
+    threads : int, optional
+        The number of threads used to read the files. Default is 4.
+
+    Returns
+    -------
+    data : ndarray
+        A uint8 (time, rows, cols) array of image data.
+    palette : ndarray
+        The palette shared by all the files as a (256, 4) RGBA lookup
+        table (see `BMPFile.palette_lut`), or None if the palettes
+        differ between files.
+
+    """
+    bmp_files = [BMPFile(fname) for fname in filenames]
+    if len(bmp_files) == 0:
+        raise ValueError('No files to read')
+
+    shape = (len(bmp_files), bmp_files[0]._rows, bmp_files[0]._cols)
+    for bmp_file in bmp_files[1:]:
+        if (bmp_file._rows, bmp_file._cols) != shape[1:]:
+            raise ValueError('%s has dimensions %s, expected %s' %
+                             (bmp_file.filename,
+                              (bmp_file._rows, bmp_file._cols), shape[1:]))
+
+    if out is None:
+        if memmap_fname is None:
+            out = np.empty(shape, dtype=np.uint8)
+        else:
+            out = np.memmap(memmap_fname, dtype=np.uint8, mode='w+',
+                            shape=shape)
+    elif out.shape != shape or out.dtype != np.uint8:
+        raise ValueError('out must be a uint8 array with shape %s' %
+                         (shape,))
+
+    def read_image(i):
+        out[i] = bmp_files[i].data()
+        # release the memory map
+        bmp_files[i]._data = None
+
+    pool = ThreadPool(threads)
+    try:
+        pool.map(read_image, range(len(bmp_files)))
+    finally:
+        pool.close()
+        pool.join()
+
+    palette = None
+    if all(np.array_equal(bmp_file._palette, bmp_files[0]._palette)
+           for bmp_file in bmp_files[1:]):
+        palette = bmp_files[0].palette_lut()
+
+    return out, palette
@@ -2,57 +2,29 @@
 
 This module contains some simple functions to make it easier
 to read and plot the Meteosat-8 cloud mask produced by EUMETSAT.
-The data are provied in GRIB2 files and the module currently
-relies on Wesley Ebisuzaki's wgrib2 programme being somewhere
-on your systems path. If you don't have wgrib2 it can be
-obtained from:
+The data are provied in GRIB2 files, which are decoded in Python
+by the grib module, giving the same values as Wesley Ebisuzaki's
+wgrib2 programme. If you want wgrib2 it can be obtained from:
 
 http://www.cpc.ncep.noaa.gov/products/wesley/wgrib2/
 
 """
 
-import os
-import sys
-
 import numpy as np
 from numpy import ma
-from scipy import io
-
-import pylab as pl
-
-def execute(command):
-    """Execute a system command passed as a string."""
-    
-    print 'Running:', command
-    os.system(command)
-    print 'Done----------------\n'
-    
-def read_bin_data(fname):
-    """Read data from a floating point binary file into an array.
-    
-    Read the data from a binary file created by wgrib2 into
-    a Numpy array. This assumes that wgrib2 has output the data
-    in 32bit floating point format and seems to work for the
-    cloud mask data that are being sent via EumetCast and
-    processed by David Taylors MDM software. The binary file
-    is assumed to have no FORTRAN headers.
-
-    """
-
-    data = np.fromfile(fname, dtype=np.float32)    
-##    data = data[1:-1] # trim invalid values if FORTRAN headers are present
 
-    if sys.byteorder == 'big':#assumes that the data was written in little endian format
-        data = data.byteswap()
+import grib
+import arcfltgrid
 
-    return data
+# The ArcGIS grid of the MSG full disk, as used by the cloud mask and
+# MPE products
+_arcgis_grid = {'x0': -5565000, 'y0': -5565000, 'cellsize': 3000}
 
 def read(grb_name):
     """Read the cloud mask data from a grib file into an array.
 
-    This function uses wgrib2 to write and then read the cloud mask
-    data via an intermediate binary file, which is later
-    deleted. The regions flagged as no data are masked. Although the
+    The field is decoded directly from the GRIB2 file. The
+    regions flagged as no data are masked. Although the
     data are in floating point three integer numbers define the mask
     as follows:
 
@@ -63,39 +35,208 @@ def read(grb_name):
       3   | Space/No data
 
     """
-    
-    rows = 3712 # fixed for MPE grid
-    cols = 3712 # fixed for MPE grid
 
-    bin_name = grb_name[0:-4] + '.bin'
+    # the wgrib2 default output order
+    field, a = grib.read(grb_name, order='we:sn')
+
+    return _cloud_mask(a)
+
+def read_many(grb_names, threads=4, wgrib2=None, timeout=None):
+    """Read the cloud mask data from a sequence of grib files.
 
-    exec_str = 'wgrib2 -no_f77 ' + '-bin ' + bin_name + ' ' + grb_name # spaces are N.B.
+    The files are converted concurrently by `threads` worker threads
+    and the arrays, as returned by `read`, are yielded in the same
+    order as `grb_names`. If `wgrib2` is given, each file is converted
+    by running that wgrib2 executable with its binary output piped
+    back, and a failed or timed out conversion raises grib.WgribError.
+    See grib.read_many.
 
-    execute(exec_str)
-    a = read_bin_data(bin_name)
-    os.remove(bin_name)
+    """
+    for a in grib.read_many(grb_names, order='we:sn', threads=threads,
+                            wgrib2=wgrib2, timeout=timeout):
+        yield _cloud_mask(a)
+
+def _cloud_mask(a):
+    """Orient and mask the values decoded from a cloud mask file."""
+    rows = 3712 # fixed for MPE grid
+    cols = 3712 # fixed for MPE grid
 
     a = a.reshape(rows, cols)
 
-    # data in grib file are oriented EW:SN
-    # need to check that this is correct, the plots look fine...
+    # EUMETSAT's files declare scanning mode 0 (west to east, north to
+    # south) but store the disk from its south-eastern corner, so the
+    # WE:SN reordering puts north at the top and east on the left.
+    # Flipping left to right gives the north up, west left grid of
+    # msggrid.
     a = np.fliplr(a)
-##    a = np.flipud(a)
 
     # mask no-data regions
     a = ma.masked_values(a, 3)
 
     return a
 
+def read_compact(grb_name, packed=False):
+    """Read the cloud mask from a grib file as a compact uint8 array.
+
+    The classes are those returned by `read`, oriented the same way,
+    with points missing from the file set to 3 (space/no data). The
+    array is a quarter of the size of the float32 array returned by
+    `read`, and no mask array is needed.
+
+    Parameters
+    ----------
+    grb_name : string
+        The name of the cloud mask GRIB2 file.
+    packed : bool, optional
+        If True, return the classes packed four to a byte, see `pack`.
+
+    Returns
+    -------
+    mask : ndarray
+        A uint8 array of the classes, of shape (rows, cols), or a 1D
+        array of the packed classes.
+
+    """
+
+    buf = grib.open_grib(grb_name)
+    try:
+        field = next(grib.iter_fields(buf))
+        values = grib.decode_field(buf, field, missing=3)
+    finally:
+        buf.close()
+
+    np.rint(values, out=values)
+
+    # flipped left to right from WE:SN to north up, west left, see read
+    mask = grib.we_sn(values, field)[:, ::-1].astype(np.uint8)
+
+    if packed:
+        return pack(mask)
+
+    return mask
+
+def pack(mask):
+    """Pack a cloud mask of classes 0-3 into 2 bits per pixel.
+
+    The pixels are packed four to a byte in C order, the first pixel
+    in the most significant bits, and the last byte is padded with
+    class 3 (no data). Use `unpack` to restore the array.
+
+    """
+    flat = np.ravel(mask).astype(np.uint8)
+    padded = np.empty(-(-flat.size//4)*4, dtype=np.uint8)
+    padded[:flat.size] = flat
+    padded[flat.size:] = 3
+
+    packed = padded[0::4] << 6
+    packed |= padded[1::4] << 4
+    packed |= padded[2::4] << 2
+    packed |= padded[3::4]
+
+    return packed
+
+def unpack(packed, shape=(3712, 3712)):
+    """Unpack a cloud mask packed by `pack` into a uint8 array."""
+    packed = np.asarray(packed, dtype=np.uint8)
+
+    mask = np.empty(packed.size*4, dtype=np.uint8)
+    mask[0::4] = packed >> 6
+    mask[1::4] = (packed >> 4) & 3
+    mask[2::4] = (packed >> 2) & 3
+    mask[3::4] = packed & 3
+
+    return mask[:np.prod(shape)].reshape(shape)
+
+class CloudFrequency():
+    """Per-pixel counts of the cloud mask classes over many slots.
+
+    The counts are kept as uint16 arrays, so memory use does not grow
+    with the number of slots added. Once 65535 slots (about two years
+    of 15 minute slots) have been added the counts are widened to
+    uint32, doubling their memory use, rather than let them wrap.
+
+    Parameters
+    ----------
+    shape : tuple, optional
+        The shape of the cloud mask grid.
+
+    """
+    def __init__(self, shape=(3712, 3712)):
+        self.shape = shape
+        self.nslots = 0
+        self.cloud = np.zeros(shape, dtype=np.uint16)
+        self.clear_land = np.zeros(shape, dtype=np.uint16)
+        self.clear_water = np.zeros(shape, dtype=np.uint16)
+
+    # Internal methods
+
+    def _frequency(self, counts, valid):
+        freq = counts.astype(np.float32)
+        np.divide(freq, valid, out=freq, where=valid > 0)
+
+        return ma.masked_array(freq, mask=valid == 0)
+
+    # API methods
+
+    def add(self, mask):
+        """Add a cloud mask, as returned by `read_compact`, packed or not."""
+        if mask.shape != self.shape:
+            mask = unpack(mask, self.shape)
+
+        if self.nslots >= np.iinfo(self.cloud.dtype).max:
+            # the counts would wrap around
+            self.cloud = self.cloud.astype(np.uint32)
+            self.clear_land = self.clear_land.astype(np.uint32)
+            self.clear_water = self.clear_water.astype(np.uint32)
+
+        self.cloud += mask == 2
+        self.clear_land += mask == 1
+        self.clear_water += mask == 0
+        self.nslots += 1
+
+    def valid(self):
+        """The number of slots with data at each pixel."""
+        return self.cloud + self.clear_land + self.clear_water
+
+    def frequencies(self):
+        """The cloud, clear land and clear water frequencies.
+
+        Returns
+        -------
+        cloud, clear_land, clear_water : MaskedArray
+            float32 arrays of the fraction of the valid slots in each
+            class, masked where no slots had data.
+
+        """
+        valid = self.valid()
+
+        return (self._frequency(self.cloud, valid),
+                self._frequency(self.clear_land, valid),
+                self._frequency(self.clear_water, valid))
+
+def cloud_frequency(grb_names, shape=(3712, 3712)):
+    """Cloud, clear land and clear water frequencies of many slots.
+
+    The cloud mask files are read one at a time with `read_compact`
+    and counted with CloudFrequency, so the memory use does not depend
+    on the number of files. Returns the CloudFrequency object, see
+    CloudFrequency.frequencies.
+
+    """
+    counter = CloudFrequency(shape)
+    for grb_name in grb_names:
+        counter.add(read_compact(grb_name))
+
+    return counter
+
 def write_arcgis_fltfile(grb_name):
     """Write the cloud mask data to a binary file suitable for ArcGIS.
 
-    This function uses wgrib2 to write and then read the cloud mask
-    data via an intermediate binary file, which is later
-    deleted. The data is properly oriented and written to a binary
+    The field is decoded directly from the GRIB2 file. The
+    data is properly oriented and written to a binary
     file as 32-bit floats with the extension '.flt'. A suitable header
-    is also written with the extension '.hdr'. The file may then be
-    imported into ArcGIS.
+    is also written with the extension '.hdr' (see arcfltgrid.write).
+    The file may then be imported into ArcGIS.
 
     Although the data are in floating point three integer numbers
     define the mask as follows:
@@ -106,46 +247,32 @@ def write_arcgis_fltfile(grb_name):
       2   | Cloud
       3   | Space/No data
 
+    Returns the name of the '.flt' file.
+
     """
-    
-    rows = 3712 # fixed for MPE grid
-    cols = 3712 # fixed for MPE grid
 
-    bin_name = grb_name[0:-4] + '.bin'
-    flt_name = grb_name[0:-4] + '.flt'
-    hdr_name = grb_name[0:-4] + '.hdr'
+    bingrid_name = grb_name[0:-4]
 
-    exec_str = 'wgrib2 -no_f77 ' + '-bin ' + bin_name + ' ' + grb_name # spaces are N.B.
+    a = read(grb_name)
+    arcfltgrid.write(bingrid_name, a, nodata_value=3, **_arcgis_grid)
 
-    execute(exec_str)
-    a = read_bin_data(bin_name)
-    os.remove(bin_name)
+    return bingrid_name + '.flt'
 
-    a = a.reshape(rows, cols)
+def write_arcgis_directory(directory, pattern='*.grb', processes=None):
+    """Convert all the cloud mask files in a directory for ArcGIS.
 
-    # data in grib file are oriented EW:SN
-    # need to check that this is correct, the plots look fine...
-    a = np.fliplr(a)
-##    a = np.flipud(a)
-
-    f = open(flt_name, 'wb')    
-    io.fwrite(f, a.size, a, 'f')
-    f.close()
-
-    f = open(hdr_name, 'w')
-    hdr_string = """ncols         3712
-nrows         3712
-xllcenter     -5565000
-yllcenter     -5565000
-cellsize      3000
-NODATA_value  3
-byteorder     LSBFIRST"""
-    f.write(hdr_string)
-    f.close()    
+    Runs `write_arcgis_fltfile` on each file matching `pattern` in a
+    pool of worker processes, see arcfltgrid.convert_directory.
+    Returns the names of the '.flt' files.
+
+    """
+    return arcfltgrid.convert_directory(write_arcgis_fltfile, directory,
+                                        pattern, processes)
 
 def plot(grb_name, fig_name, title='GRIB Plot'):
     """Create a plot of the data in a GRIB2 file."""
-    
+    import pylab as pl
+
     a = read(grb_name)
 
     pl.clf()
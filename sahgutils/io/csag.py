@@ -4,15 +4,262 @@ files provided by the University of Cape Town's Climate Systems
 Analysis Group.
 
 """
-__all__ = ['CSAGStationReader']
+__all__ = ['CSAGStationReader', 'CSAGArchive', 'CSAGStationIndex']
 
+import os
+import re
+import zlib
 from datetime import datetime
+from glob import glob
+from multiprocessing import Pool
 
 import numpy as np
 
+_data_dtype = [('ID', 'S9'), ('SOUID', 'S8'), ('DATE', 'S8'),
+               ('VAR', 'f8'), ('QC', 'S4'), ('EC', 'S4')]
+
+# The column header line which starts the data section
+_columns_pattern = re.compile(r'\s*ID\s*,\s*SOUID\s*,\s*DATE\s*,')
+
+def _read_header(fp, max_rows=None):
+    """Parse the header of an open CSAG station file.
+
+    Reads the `KEY | value` lines at the top of the file, skipping
+    comments and blank lines, until the column header of the data
+    section (ID, SOUID, DATE, ...) is found. Header values may contain
+    spaces and commas. Returns the header dictionary and
+    the byte offset of the column header line. The file pointer is
+    left at that offset so the data section can be parsed from the
+    same file handle.
+
+    """
+    header = {}
+
+    line_indx = 0
+    while True:
+        offset = fp.tell()
+        line = fp.readline()
+        if not line:
+            break
+
+        if line[0] != '#':
+            if _columns_pattern.match(line):
+                # start of the data section
+                break
+
+            if max_rows is None or line_indx < max_rows:
+                if '|' in line:
+                    key, value = line.split('|', 1)
+                    header[key.strip()] = value.strip()
+                else:
+                    items = line.split()
+
+                    if len(items) >= 1:
+                        header[items[0]] = items[-1]
+
+        line_indx += 1
+
+    fp.seek(offset)
+
+    # convert floats
+    keys = ['ALTITUDE', 'LATITUDE', 'LONGITUDE']
+
+    for key in keys:
+        if key in header.keys():
+            val = float(header[key])
+            header[key] = val
+
+    # convert ints
+    keys = ['CLEANING']
+
+    for key in keys:
+        if key in header.keys():
+            val = int(header[key])
+            header[key] = val
+
+    # convert dates
+    keys = ['CREATED', 'START_DATE', 'END_DATE']
+
+    for key in keys:
+        if key in header.keys():
+            val = datetime.strptime(header[key], '%Y%m%d')
+            header[key] = val
+
+    return header, offset
+
+def _parse_data(buf, names=True):
+    """Parse the data section of a CSAG station file.
+
+    `buf` contains the data section starting at the column header
+    line, or at the first data line if `names` is False.
+
+    """
+    lines = [line for line in buf.splitlines() if line.strip()]
+    if len(lines) == 0 or (names and len(lines) == 1):
+        return np.empty(0, dtype=_data_dtype)
+
+    data = np.genfromtxt(lines, delimiter=',', dtype=_data_dtype,
+                         autostrip=True, names=names or None)
+    data = np.atleast_1d(data)
+
+    # Mask no-data values (defined as -999.0)
+    data['VAR'][data['VAR'] < 0] = np.nan
+
+    return data
+
+def _checksum(buf, crc=0):
+    """Running CRC-32 of the data section of a station file."""
+    return zlib.crc32(buf, crc) & 0xffffffff
+
+def _read_tail(fp, data_offset, data_end, checksum, last_date=None,
+               max_rows=None):
+    """Parse the records appended to an open CSAG station file.
+
+    The file is assumed to have been parsed up to byte `data_end`
+    previously, with `checksum` the CRC-32 of the data section up to
+    that offset. Only records following `data_end` and dated after
+    `last_date` (a YYYYMMDD string) are parsed.
+
+    Returns the header, the new records and the new `data_end` and
+    `checksum` values. None is returned if the header length changed
+    or the data section before `data_end` was modified, in which case
+    the file needs to be read in full.
+
+    """
+    header, offset = _read_header(fp, max_rows)
+    if offset != data_offset:
+        return None
+
+    # Reading the old records is cheap, it's parsing them that isn't
+    crc = 0
+    remaining = data_end - data_offset
+    while remaining > 0:
+        buf = fp.read(min(remaining, 1 << 20))
+        if not buf:
+            return None
+
+        crc = _checksum(buf, crc)
+        remaining -= len(buf)
+
+    if crc != checksum:
+        return None
+
+    buf = fp.read()
+    data = _parse_data(buf, names=False)
+    if last_date is not None:
+        data = data[data['DATE'] > last_date]
+
+    return header, data, data_end + len(buf), _checksum(buf, crc)
+
+_index_dtype = [('id', 'S16'), ('name', 'S64'),
+                ('lat', 'f8'), ('lon', 'f8'), ('alt', 'f8'),
+                ('start', 'M8[D]'), ('end', 'M8[D]'),
+                ('filename', 'S256'), ('mtime', 'f8'), ('size', 'i8')]
+
+_earth_radius = 6371.0 # km
+
+def _parse_dates(date_strings):
+    """Convert an array of YYYYMMDD strings to datetime64[D]."""
+    iso = ['%s-%s-%s' % (ds[:4], ds[4:6], ds[6:8]) for ds in date_strings]
+
+    return np.array(iso, dtype='M8[D]')
+
+def _read_station(args):
+    """Read or refresh a station file for CSAGArchive.
+
+    Module level so that it can be used by a multiprocessing Pool.
+    `args` is a (filename, state) tuple, where state is None to read
+    the whole file, or the (data_offset, data_end, checksum, last_date)
+    of a previous read to only parse the records appended since then.
+
+    Returns a dictionary with the station ID, the observation dates as
+    datetime64[D], the observations as float32, the new file state and
+    whether only the tail of the file was parsed.
+
+    """
+    filename, state = args
+
+    tail = None
+    if state is not None:
+        with open(filename, 'rb') as fp:
+            tail = _read_tail(fp, *state)
+
+    if tail is None:
+        csag_reader = CSAGStationReader(filename)
+
+        header = csag_reader.header()
+        data = csag_reader._data
+        state = csag_reader._state()
+    else:
+        header, data, data_end, checksum = tail
+
+        last_date = state[3]
+        if len(data) > 0:
+            last_date = data['DATE'][-1]
+
+        state = (state[0], data_end, checksum, last_date)
+
+    return {'station': header.get('ID', os.path.basename(filename)),
+            'dates': _parse_dates(data['DATE']),
+            'values': data['VAR'].astype(np.float32),
+            'state': state,
+            'tail': tail is not None}
+
+def _cached_state(index, j):
+    """Return the state of station `j` in a CSAGArchive cache index."""
+    return (int(index['data_offsets'][j]), int(index['data_ends'][j]),
+            int(index['checksums'][j]), str(index['last_dates'][j]) or None)
+
+def _replace(src, dst):
+    """Rename `src` to `dst`, replacing `dst` if it exists."""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows won't rename over an existing file
+        os.remove(dst)
+        os.rename(src, dst)
+
+def _read_station_header(filename):
+    """Read the header of a station file for CSAGStationIndex.
+
+    Only the header block is read, the data section is never parsed.
+    Returns a record matching `_index_dtype`.
+
+    """
+    with open(filename, 'rb') as fp:
+        header, offset = _read_header(fp)
+
+    stat = os.stat(filename)
+
+    def to_date(key):
+        if key in header:
+            return np.datetime64(header[key], 'D')
+        return np.datetime64('NaT', 'D')
+
+    return (header.get('ID', ''), header.get('NAME', ''),
+            header.get('LATITUDE', np.nan),
+            header.get('LONGITUDE', np.nan),
+            header.get('ALTITUDE', np.nan),
+            to_date('START_DATE'), to_date('END_DATE'),
+            os.path.basename(filename), stat.st_mtime, stat.st_size)
+
+def _distance(lat, lon, lats, lons):
+    """Great circle distance (km) from (lat, lon) to each of lats, lons."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+
+    a = np.sin(0.5*(lats - lat))**2 + \
+        np.cos(lat)*np.cos(lats)*np.sin(0.5*(lons - lon))**2
+
+    return 2*_earth_radius*np.arcsin(np.sqrt(a))
+
 class CSAGStationReader():
     """Class for read operations on CSAG rainfall station files.
 
+    The header and data sections are parsed in a single pass over the
+    file. The start of the data section is detected from the column
+    header line, so files with different header lengths are handled.
+
     Example Usage:
 
     >>> from sahgutils.io import CSAGStationReader
@@ -22,63 +269,60 @@ class CSAGStationReader():
     >>> precip = csag_reader.data()
 
     """
-    def __init__(self, filename, header_rows=65):
+    def __init__(self, filename, header_rows=None):
         self.filename = filename
         self._header_rows = header_rows
-        self._read_header()
 
-        self._data_read = False
+        with open(self.filename, 'rb') as fp:
+            self._read(fp)
+
+    # Internal methods
+
+    def _read(self, fp):
+        self._header, self._data_offset = _read_header(fp,
+                                                       self._header_rows)
 
-    def _read_header(self):
-        fp = open(self.filename)
+        buf = fp.read()
+        self._data = _parse_data(buf)
+        self._data_end = self._data_offset + len(buf)
+        self._checksum = _checksum(buf)
 
-        self._header = {}
+    def _state(self):
+        if len(self._data) > 0:
+            last_date = self._data['DATE'][-1]
+        else:
+            last_date = None
 
-        line_indx = 0
-        while line_indx  < self._header_rows:
-            line = fp.readline()
-            if line[0] != '#':
-                items = line.split()
+        return self._data_offset, self._data_end, self._checksum, last_date
 
-                if len(items) >= 1:
-                    self._header[items[0]] = items[-1]
+    # API methods
 
-            line_indx += 1
+    def refresh(self):
+        """Read any records appended to the file since the last read.
 
-        fp.close()
+        Only the file header and the records following the byte offset
+        reached by the previous read are parsed. If the file was
+        modified before that offset the whole file is read again.
 
-        # convert floats
-        keys = ['ALTITUDE', 'LATITUDE', 'LONGITUDE']
+        Returns the number of records parsed.
 
-        for key in keys:
-            if key in self._header.keys():
-                val = float(self._header[key])
-                self._header[key] = val
+        """
+        data_offset, data_end, checksum, last_date = self._state()
 
-        # convert ints
-        keys = ['CLEANING']
+        with open(self.filename, 'rb') as fp:
+            tail = _read_tail(fp, data_offset, data_end, checksum, last_date,
+                              self._header_rows)
 
-        for key in keys:
-            if key in self._header.keys():
-                val = int(self._header[key])
-                self._header[key] = val
+            if tail is None:
+                fp.seek(0)
+                self._read(fp)
 
-        # convert dates
-        keys = ['CREATED', 'START_DATE', 'END_DATE']
+                return len(self._data)
 
-        for key in keys:
-            if key in self._header.keys():
-                val = datetime.strptime(self._header[key], '%Y%m%d')
-                self._header[key] = val
+        self._header, data, self._data_end, self._checksum = tail
+        self._data = np.concatenate((self._data, data))
 
-    def _read_data(self):
-        self._data = np.genfromtxt(self.filename, delimiter=',',skip_header=66,
-                                   dtype=['S9', 'S8', 'S8',
-                                          'f8', 'S4', 'S4'],
-                                   autostrip=True, names=True)
-        # Mask no-data values (defined as -999.0)
-        self._data['VAR'][self._data['VAR'] < 0] = np.nan
-        self._data_read = True
+        return len(data)
 
     def header(self):
         """Return the file header in a dictionary"""
@@ -86,18 +330,401 @@ class CSAGStationReader():
 
     def data(self):
         """Return the station data as an array"""
-        if not self._data_read:
-            self._read_data()
-
         return self._data['VAR']
 
     def dates(self):
         """Return a list of observation dates"""
-        if not self._data_read:
-            self._read_data()
-
         _dates = []
         for ds in self._data['DATE']:
             _dates.append(datetime.strptime(ds, '%Y%m%d'))
 
         return _dates
+
+class CSAGArchive():
+    """Class for bulk read operations on a directory of CSAG station files.
+
+    All station files matching `pattern` in `directory` are parsed
+    (in parallel using `processes` worker processes) and aligned on a
+    common daily time axis. The result is a float32 (station, day)
+    array, with NaN on days that a station has no observation.
+
+    The assembled array is cached in `cache_dir` (default: a
+    '.csag_cache' sub-directory of `directory`) along with the
+    modification time and size of every station file. If none of the
+    station files have changed, later loads memory map the cached
+    array instead of parsing the text files again. Station files that
+    have grown since the cache was written only have their appended
+    records parsed, see `CSAGStationReader.refresh`.
+
+    Example Usage:
+
+    >>> from sahgutils.io import CSAGArchive
+    >>> archive = CSAGArchive('data/CSAG')
+    >>> stations = archive.stations()
+    >>> dates = archive.dates()
+    >>> precip = archive.data()
+    >>> precip.shape == (len(stations), len(dates))
+    True
+
+    """
+    def __init__(self, directory, pattern='*.txt', cache_dir=None,
+                 processes=None):
+        self.directory = directory
+        self.pattern = pattern
+
+        if cache_dir is None:
+            cache_dir = os.path.join(directory, '.csag_cache')
+        self.cache_dir = cache_dir
+
+        self._processes = processes
+
+        self._index_name = os.path.join(self.cache_dir, 'index.npz')
+        self._data_name = os.path.join(self.cache_dir, 'data.npy')
+
+        self._load()
+
+    # Internal methods
+
+    def _scan(self):
+        filenames = sorted(glob(os.path.join(self.directory, self.pattern)))
+
+        mtimes = np.empty(len(filenames), dtype=np.float64)
+        sizes = np.empty(len(filenames), dtype=np.int64)
+        for i, fname in enumerate(filenames):
+            stat = os.stat(fname)
+            mtimes[i] = stat.st_mtime
+            sizes[i] = stat.st_size
+
+        return filenames, mtimes, sizes
+
+    def _read_index(self):
+        if not (os.path.exists(self._index_name) and
+                os.path.exists(self._data_name)):
+            return None
+
+        index = np.load(self._index_name)
+        try:
+            if 'starts' not in index.files:
+                # written by an older version
+                return None
+
+            return dict((key, index[key]) for key in index.files)
+        finally:
+            index.close()
+
+    def _write_cache(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        names = [os.path.basename(f) for f in self._filenames]
+        offsets, data_ends, checksums, last_dates = zip(*self._states) or \
+                                                  ((), (), (), ())
+        last_dates = [ld or '' for ld in last_dates]
+        starts, ends = zip(*self._spans) or ((), ())
+
+        # Write to temporary files first, the previous cache may still
+        # be memory mapped
+        tmp_name = self._data_name + '.tmp'
+        with open(tmp_name, 'wb') as fp:
+            np.save(fp, self._data)
+        _replace(tmp_name, self._data_name)
+
+        tmp_name = self._index_name + '.tmp'
+        with open(tmp_name, 'wb') as fp:
+            np.savez(fp, filenames=np.array(names, dtype=np.str_),
+                     mtimes=self._mtimes, sizes=self._sizes,
+                     stations=self._stations, dates=self._dates,
+                     data_offsets=np.array(offsets, dtype=np.int64),
+                     data_ends=np.array(data_ends, dtype=np.int64),
+                     checksums=np.array(checksums, dtype=np.int64),
+                     last_dates=np.array(last_dates, dtype='S8'),
+                     starts=np.array(starts, dtype='M8[D]'),
+                     ends=np.array(ends, dtype='M8[D]'))
+        _replace(tmp_name, self._index_name)
+
+    def _map(self, tasks):
+        if self._processes == 1 or len(tasks) < 2:
+            return [_read_station(task) for task in tasks]
+
+        pool = Pool(self._processes)
+        try:
+            return pool.map(_read_station, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _load(self):
+        self._filenames, self._mtimes, self._sizes = self._scan()
+        names = [os.path.basename(f) for f in self._filenames]
+
+        index = self._read_index()
+        if (index is not None and
+            list(index['filenames']) == names and
+            np.array_equal(index['mtimes'], self._mtimes) and
+            np.array_equal(index['sizes'], self._sizes)):
+            self._stations = index['stations']
+            self._dates = index['dates']
+            self._states = [_cached_state(index, j)
+                            for j in range(len(names))]
+            self._spans = zip(index['starts'], index['ends'])
+            self._data = np.load(self._data_name, mmap_mode='r')
+            return
+
+        if index is None:
+            index = {'filenames': [], 'dates': np.array([], dtype='M8[D]')}
+        cached = dict((name, j) for j, name in enumerate(index['filenames']))
+
+        # Unchanged files are copied from the cache, files that have
+        # grown only have their new records parsed and the rest are
+        # read in full
+        plan = []
+        for i, (fname, name) in enumerate(zip(self._filenames, names)):
+            j = cached.get(name)
+
+            if j is None:
+                plan.append((None, (fname, None)))
+            elif (index['mtimes'][j] == self._mtimes[i] and
+                  index['sizes'][j] == self._sizes[i]):
+                plan.append((j, None))
+            elif index['sizes'][j] < self._sizes[i]:
+                plan.append((j, (fname, _cached_state(index, j))))
+            else:
+                plan.append((None, (fname, None)))
+
+        tasks = [task for j, task in plan if task is not None]
+        results = iter(self._map(tasks))
+
+        stations = []
+        states = []
+        updates = []
+        for j, task in plan:
+            if task is None:
+                result = None
+
+                stations.append(index['stations'][j])
+                states.append(_cached_state(index, j))
+            else:
+                result = next(results)
+                if not result['tail']:
+                    # changed before the end of the cached records
+                    j = None
+
+                stations.append(result['station'])
+                states.append(result['state'])
+
+            updates.append((j, result))
+
+        # First and last day of each station's records
+        spans = []
+        for j, result in updates:
+            bounds = []
+            if j is not None:
+                bounds.extend([index['starts'][j], index['ends'][j]])
+            if result is not None and len(result['dates']) > 0:
+                bounds.extend([result['dates'].min(), result['dates'].max()])
+
+            bounds = [day for day in bounds if not np.isnat(day)]
+            if len(bounds) > 0:
+                spans.append((min(bounds), max(bounds)))
+            else:
+                spans.append((np.datetime64('NaT', 'D'),)*2)
+
+        # Common daily axis spanning all the stations
+        bounds = [day for span in spans for day in span
+                  if not np.isnat(day)]
+        if len(bounds) > 0:
+            start = min(bounds)
+            self._dates = np.arange(start, max(bounds) + 1, dtype='M8[D]')
+        else:
+            start = None
+            self._dates = np.array([], dtype='M8[D]')
+
+        self._data = np.empty((len(updates), len(self._dates)),
+                              dtype=np.float32)
+        self._data.fill(np.nan)
+
+        if any(j is not None for j, result in updates):
+            cache_data = np.load(self._data_name, mmap_mode='r')
+
+            for i, (j, result) in enumerate(updates):
+                if j is None or np.isnat(index['starts'][j]):
+                    continue
+
+                c0 = int((index['starts'][j] - index['dates'][0]).astype(int))
+                c1 = int((index['ends'][j] - index['dates'][0]).astype(int))
+                n0 = int((index['starts'][j] - start).astype(int))
+                self._data[i, n0:n0+c1-c0+1] = cache_data[j, c0:c1+1]
+
+            del cache_data
+
+        for i, (j, result) in enumerate(updates):
+            if result is not None:
+                days = (result['dates'] - start).astype(np.int64)
+                self._data[i, days] = result['values']
+
+        self._stations = np.array(stations, dtype=np.str_)
+        self._states = states
+        self._spans = spans
+
+        self._write_cache()
+
+    # API methods
+
+    def refresh(self):
+        """Update the archive with new or changed station files.
+
+        Only the records appended to station files since the last load
+        are parsed, unless a file was modified before the end of its
+        previously parsed records.
+
+        """
+        self._load()
+
+    def filenames(self):
+        """Return a list of the station file names"""
+        return self._filenames
+
+    def stations(self):
+        """Return an array of station IDs"""
+        return self._stations
+
+    def dates(self):
+        """Return the common daily time axis as datetime64[D] values"""
+        return self._dates
+
+    def data(self):
+        """Return the (station, day) array of observations"""
+        return self._data
+
+class CSAGStationIndex():
+    """Class for spatial and temporal queries on CSAG station metadata.
+
+    The ID, NAME, LATITUDE, LONGITUDE, ALTITUDE, START_DATE and
+    END_DATE header fields of every station file matching `pattern`
+    in `directory` are collected into a structured array. Only the
+    file headers are read, and all queries are answered from the
+    array without touching the data sections.
+
+    The index is cached as 'stations.npy' in `cache_dir` (default: a
+    '.csag_cache' sub-directory of `directory`). On later loads only
+    the headers of new or changed files (by modification time and
+    size) are scanned again.
+
+    Example Usage:
+
+    >>> from sahgutils.io import CSAGStationIndex
+    >>> index = CSAGStationIndex('data/CSAG')
+    >>> near = index.radius(-29.6, 30.4, 50)
+    >>> print(near['id'], near['name'])
+    >>> closest = index.nearest(-29.6, 30.4, k=5)
+
+    """
+    def __init__(self, directory, pattern='*.txt', cache_dir=None):
+        self.directory = directory
+        self.pattern = pattern
+
+        if cache_dir is None:
+            cache_dir = os.path.join(directory, '.csag_cache')
+        self.cache_dir = cache_dir
+
+        self._index_name = os.path.join(self.cache_dir, 'stations.npy')
+
+        self._load()
+
+    # Internal methods
+
+    def _load(self):
+        cached = {}
+        if os.path.exists(self._index_name):
+            for rec in np.load(self._index_name):
+                cached[rec['filename']] = rec
+
+        filenames = sorted(glob(os.path.join(self.directory, self.pattern)))
+
+        self._records = np.empty(len(filenames), dtype=_index_dtype)
+        changed = len(filenames) != len(cached)
+        for i, fname in enumerate(filenames):
+            stat = os.stat(fname)
+            rec = cached.get(os.path.basename(fname))
+
+            if (rec is not None and rec['mtime'] == stat.st_mtime and
+                rec['size'] == stat.st_size):
+                self._records[i] = rec
+            else:
+                self._records[i] = _read_station_header(fname)
+                changed = True
+
+        if changed:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            with open(self._index_name, 'wb') as fp:
+                np.save(fp, self._records)
+
+    # API methods
+
+    def records(self):
+        """Return the station metadata as a structured array"""
+        return self._records
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Return the stations located inside a bounding box."""
+        lats = self._records['lat']
+        lons = self._records['lon']
+
+        inside = (min_lat <= lats) & (lats <= max_lat) & \
+                 (min_lon <= lons) & (lons <= max_lon)
+
+        return self._records[inside]
+
+    def radius(self, lat, lon, distance):
+        """Return the stations within `distance` km of a location.
+
+        The stations are ordered by increasing distance.
+
+        """
+        dist = _distance(lat, lon,
+                         self._records['lat'], self._records['lon'])
+
+        indx = np.nonzero(dist <= distance)[0]
+        indx = indx[np.argsort(dist[indx])]
+
+        return self._records[indx]
+
+    def nearest(self, lat, lon, k=1):
+        """Return the `k` stations closest to a location.
+
+        The stations are ordered by increasing distance.
+
+        """
+        dist = _distance(lat, lon,
+                         self._records['lat'], self._records['lon'])
+        dist[np.isnan(dist)] = np.inf
+
+        k = min(k, len(dist))
+        if k < len(dist):
+            indx = np.argpartition(dist, k - 1)[:k]
+        else:
+            indx = np.arange(len(dist))
+        indx = indx[np.argsort(dist[indx])]
+
+        return self._records[indx]
+
+    def covering(self, start, end=None):
+        """Return the stations with records covering a date range.
+
+        Stations are selected if their START_DATE is on or before
+        `start` and their END_DATE is on or after `end` (`start` if
+        `end` is None). Dates may be datetime or datetime64 values.
+
+        """
+        if end is None:
+            end = start
+
+        start = np.datetime64(start, 'D')
+        end = np.datetime64(end, 'D')
+
+        covers = (self._records['start'] <= start) & \
+                 (self._records['end'] >= end)
+
+        return self._records[covers]
@@ -0,0 +1,888 @@
+"""Utilities for decoding GRIB1 and GRIB2 files.
+
+This module contains a small GRIB decoder written in Python and
+Numpy. It handles the grid point data used by the SAWS Unified Model
+(GRIB1), and EUMETSAT's MPE and cloud mask products (GRIB2), which
+are simple packed with an optional bitmap. Other packing methods
+raise NotImplementedError.
+
+The packed values are unpacked with vectorised array operations,
+directly from a memory map of the file, so no external programme or
+intermediate file is needed. The decoded fields match the binary
+output of Wesley Ebisuzaki's wgrib/wgrib2 programmes: float32 values,
+with points missing from the bitmap set to UNDEFINED.
+
+The inventory of a file, the offset and header values of every record,
+is cached alongside it by `inventory`, so records can be selected by
+number or by parameter and level and read without scanning the file.
+
+For files the decoder cannot handle, `read_many` can also convert
+batches of files with wgrib2, running several conversions at once and
+reading the binary output through a pipe.
+
+"""
+import os
+import mmap
+import signal
+import struct
+from collections import deque
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from sahgutils.sysutil import exec_command
+
+# Value given to points missing from the bitmap, as wgrib/wgrib2
+UNDEFINED = 9.999e20
+
+# Number of values unpacked at a time, limits the temporary arrays
+_chunk_size = 1 << 20
+
+# Inventory of the records in a GRIB file, one row per field. param is
+# the GRIB1 table 2 code or the GRIB2 parameter number, and missing
+# values are -1 (NaN for level).
+_index_dtype = [('offset', np.int64), ('length', np.int64),
+                ('field', np.int32), ('edition', np.int8),
+                ('discipline', np.int16), ('category', np.int16),
+                ('param', np.int16), ('level_type', np.int16),
+                ('level', np.float64), ('time_unit', np.int16),
+                ('forecast_time', np.int32)]
+
+class WgribError(RuntimeError):
+    """A wgrib2 conversion failed or timed out.
+
+    The name of the GRIB file, the wgrib2 return code and its standard
+    error output are available as the `grb_name`, `returncode` and
+    `stderr` attributes.
+
+    """
+    def __init__(self, grb_name, returncode, stderr):
+        self.grb_name = grb_name
+        self.returncode = returncode
+        self.stderr = stderr
+
+        msg = 'wgrib2 failed on %s with return code %d' % (grb_name,
+                                                          returncode)
+        if stderr.strip():
+            msg += ': ' + stderr.strip()
+        RuntimeError.__init__(self, msg)
+
+def _uint(buf, offset, nbytes):
+    """Unsigned big-endian integer from `nbytes` bytes of `buf`."""
+    value = 0
+    for char in buf[offset:offset+nbytes]:
+        value = (value << 8) | ord(char)
+
+    return value
+
+def _sint(buf, offset, nbytes):
+    """Signed integer, GRIB sign and magnitude representation."""
+    value = _uint(buf, offset, nbytes)
+    sign = 1 << (8*nbytes - 1)
+    if value & sign:
+        return -(value & ~sign)
+
+    return value
+
+def _ibm_float(buf, offset):
+    """IBM single precision float, as used for GRIB1 reference values."""
+    value = _uint(buf, offset, 4)
+
+    sign = -1.0 if value & 0x80000000 else 1.0
+    exponent = (value >> 24) & 0x7f
+    mantissa = value & 0xffffff
+
+    return sign*mantissa*16.0**(exponent - 64)/2**24
+
+def _ieee_float(buf, offset):
+    """IEEE single precision float, as used by GRIB2."""
+    return struct.unpack('>f', buf[offset:offset+4])[0]
+
+def _unpack(buf, offset, nbits, count, out, first=0):
+    """Unpack `count` unsigned `nbits` integers starting at `offset`.
+
+    The integers, starting with integer number `first` of those packed
+    at `offset`, are written to the float64 array `out`.
+
+    """
+    if nbits == 0:
+        out[:count] = 0
+        return
+
+    if nbits in (8, 16, 32):
+        dtype = {8: '>u1', 16: '>u2', 32: '>u4'}[nbits]
+        out[:count] = np.frombuffer(buf, dtype=dtype, count=count,
+                                    offset=offset + first*nbits//8)
+        return
+
+    if nbits > 32:
+        raise NotImplementedError('%d bit packing is not supported' % nbits)
+
+    nbytes = ((first + count)*nbits + 7)//8
+    data = np.frombuffer(buf, dtype=np.uint8, count=nbytes, offset=offset)
+
+    for start in range(0, count, _chunk_size):
+        stop = min(start + _chunk_size, count)
+        bitpos = np.arange(first + start, first + stop, dtype=np.uint64)*nbits
+        out[start:stop] = _bits_at(data, bitpos, nbits)
+
+def _bits_at(data, bitpos, nbits):
+    """The `nbits` unsigned integers at bit positions `bitpos` of `data`.
+
+    `data` is a uint8 array, `bitpos` a uint64 array. Every value (and
+    its offset into the first byte) fits within the 5 bytes from its
+    first byte, bytes beyond the end of `data` only contribute bits
+    which are shifted out.
+
+    """
+    byte = (bitpos >> 3).astype(np.intp)
+    last = len(data) - 1
+    clip = len(byte) > 0 and byte.max() + 4 > last
+
+    word = np.zeros(len(bitpos), dtype=np.uint64)
+    for i in range(5):
+        index = byte + i
+        if clip:
+            np.minimum(index, last, out=index)
+        word <<= 8
+        word |= data[index]
+
+    shift = 40 - nbits - (bitpos & 7)
+
+    return (word >> shift) & ((1 << nbits) - 1)
+
+def _scale(ints, ref, bin_scale, dec_scale):
+    """Apply the GRIB simple packing scaling in place."""
+    ints *= 2.0**bin_scale
+    ints += ref
+    ints /= 10.0**dec_scale
+
+def _grib1_fields(buf, start, length):
+    """Describe the field in the GRIB1 message at `start`."""
+    pos = start + 8
+
+    # Product definition section
+    pds_len = _uint(buf, pos, 3)
+    flag = ord(buf[pos+7])
+
+    century = ord(buf[pos+24])
+    year = (century - 1)*100 + ord(buf[pos+12])
+    month, day, hour, minute = [ord(c) for c in buf[pos+13:pos+17]]
+
+    time_range = ord(buf[pos+20])
+    if time_range == 10:
+        forecast_time = _uint(buf, pos+18, 2)
+    else:
+        forecast_time = ord(buf[pos+18])
+
+    field = {'edition': 1,
+             'offset': start,
+             'length': length,
+             'param': ord(buf[pos+8]),
+             'level_type': ord(buf[pos+9]),
+             'level': _uint(buf, pos+10, 2),
+             'reference_time': datetime(year, month, day, hour, minute),
+             'time_unit': ord(buf[pos+17]),
+             'forecast_time': forecast_time,
+             'time_range': time_range,
+             'dec_scale': _sint(buf, pos+26, 2),
+             'nx': None, 'ny': None, 'scan_mode': 0,
+             'bitmap_offset': None}
+    pos += pds_len
+
+    # Grid description section
+    if flag & 0x80:
+        gds_len = _uint(buf, pos, 3)
+        grid_type = ord(buf[pos+5])
+
+        # lat/lon, Mercator, Gaussian, polar stereographic, Lambert
+        # and space view grids all start with Ni, Nj
+        if grid_type in (0, 1, 3, 4, 5, 10, 90):
+            field['nx'] = _uint(buf, pos+6, 2)
+            field['ny'] = _uint(buf, pos+8, 2)
+            field['scan_mode'] = ord(buf[pos+27])
+        pos += gds_len
+
+    # Bitmap section
+    if flag & 0x40:
+        bms_len = _uint(buf, pos, 3)
+        if _uint(buf, pos+4, 2) != 0:
+            raise NotImplementedError('Predefined bitmaps are not '
+                                      'supported')
+        field['bitmap_offset'] = pos + 6
+        pos += bms_len
+
+    # Binary data section
+    bds_len = _uint(buf, pos, 3)
+    bds_flag = ord(buf[pos+3])
+    if bds_flag & 0xc0:
+        raise NotImplementedError('Only grid point data with simple '
+                                  'packing are supported')
+
+    field['bin_scale'] = _sint(buf, pos+4, 2)
+    field['ref'] = _ibm_float(buf, pos+6)
+    field['nbits'] = ord(buf[pos+10])
+    field['data_offset'] = pos + 11
+
+    if field['nx'] is not None:
+        field['npoints'] = field['nx']*field['ny']
+    elif field['nbits'] > 0:
+        field['npoints'] = ((bds_len - 11)*8 - (bds_flag & 0x0f)) // \
+                           field['nbits']
+    else:
+        raise NotImplementedError('Cannot find the number of points')
+
+    if field['bitmap_offset'] is None:
+        field['nvalues'] = field['npoints']
+    else:
+        field['nvalues'] = None # counted from the bitmap
+
+    yield field
+
+def _grib2_fields(buf, start, length):
+    """Describe the fields in the GRIB2 message at `start`."""
+    discipline = ord(buf[start+6])
+    end = start + length - 4
+
+    grid = {}
+    product = {}
+    packing = {}
+    bitmap_offset = None
+    reference_time = None
+
+    pos = start + 16
+    while pos < end:
+        sec_len = _uint(buf, pos, 4)
+        sec_num = ord(buf[pos+4])
+
+        if sec_num == 1:
+            # Identification section
+            month, day, hour, minute, second = \
+                   [ord(c) for c in buf[pos+14:pos+19]]
+            reference_time = datetime(_uint(buf, pos+12, 2), month, day,
+                                      hour, minute, second)
+        elif sec_num == 3:
+            # Grid definition section
+            grid = {'npoints': _uint(buf, pos+6, 4),
+                    'nx': None, 'ny': None, 'scan_mode': 0}
+            template = _uint(buf, pos+12, 2)
+            if template in (0, 90):
+                grid['nx'] = _uint(buf, pos+30, 4)
+                grid['ny'] = _uint(buf, pos+34, 4)
+                if template == 0:
+                    grid['scan_mode'] = ord(buf[pos+71])
+                else:
+                    grid['scan_mode'] = ord(buf[pos+63])
+        elif sec_num == 4:
+            # Product definition section
+            product = {'category': ord(buf[pos+9]),
+                       'number': ord(buf[pos+10]),
+                       'time_unit': None, 'forecast_time': None,
+                       'level_type': None, 'level': None}
+            template = _uint(buf, pos+7, 2)
+            if template in (0, 1, 8, 11):
+                product['time_unit'] = ord(buf[pos+17])
+                product['forecast_time'] = _uint(buf, pos+18, 4)
+                product['level_type'] = ord(buf[pos+22])
+                level_scale = _sint(buf, pos+23, 1)
+                product['level'] = _uint(buf, pos+24, 4)/10.0**level_scale
+        elif sec_num == 5:
+            # Data representation section
+            if _uint(buf, pos+9, 2) != 0:
+                raise NotImplementedError('Only simple packing is '
+                                          'supported')
+            packing = {'nvalues': _uint(buf, pos+5, 4),
+                       'ref': _ieee_float(buf, pos+11),
+                       'bin_scale': _sint(buf, pos+15, 2),
+                       'dec_scale': _sint(buf, pos+17, 2),
+                       'nbits': ord(buf[pos+19])}
+        elif sec_num == 6:
+            # Bitmap section
+            indicator = ord(buf[pos+5])
+            if indicator == 0:
+                bitmap_offset = pos + 6
+            elif indicator == 255:
+                bitmap_offset = None
+            elif indicator != 254: # 254 re-uses the previous bitmap
+                raise NotImplementedError('Predefined bitmaps are not '
+                                          'supported')
+        elif sec_num == 7:
+            # Data section, completes a field
+            field = {'edition': 2,
+                     'offset': start,
+                     'length': length,
+                     'discipline': discipline,
+                     'reference_time': reference_time,
+                     'bitmap_offset': bitmap_offset,
+                     'data_offset': pos + 5}
+            field.update(grid)
+            field.update(product)
+            field.update(packing)
+            yield field
+
+        pos += sec_len
+
+def iter_messages(buf):
+    """Iterate over the GRIB messages in a buffer.
+
+    Yields the (offset, length, edition) of each message in `buf`,
+    which may be a string or a memory mapped file.
+
+    """
+    pos = buf.find('GRIB')
+    while pos >= 0 and pos + 16 <= len(buf):
+        edition = ord(buf[pos+7])
+        if edition == 1:
+            length = _uint(buf, pos+4, 3)
+        elif edition == 2:
+            length = _uint(buf, pos+8, 8)
+        else:
+            raise ValueError('Unknown GRIB edition %d at offset %d' %
+                             (edition, pos))
+
+        yield pos, length, edition
+
+        pos = buf.find('GRIB', pos + length)
+
+def iter_fields(buf):
+    """Iterate over the fields in a buffer of GRIB messages.
+
+    Yields a dictionary describing each field, in the order that
+    wgrib/wgrib2 number the records (a GRIB2 message may contain
+    several fields). The dictionary holds the parameter, level and
+    time information as well as the packing details needed by
+    `decode_field`.
+
+    """
+    for offset, length, edition in iter_messages(buf):
+        if edition == 1:
+            fields = _grib1_fields(buf, offset, length)
+        else:
+            fields = _grib2_fields(buf, offset, length)
+
+        for field in fields:
+            yield field
+
+def we_sn(values, field):
+    """View decoded values as a grid in WE:SN order.
+
+    Returns a (ny, nx) view of the 'raw' ordered `values` of `field`,
+    with rows from south to north and columns from west to east. This
+    is the wgrib2 default order, obtained without copying the data.
+
+    """
+    nx, ny, scan_mode = field['nx'], field['ny'], field['scan_mode']
+    if nx is None:
+        raise ValueError('The grid dimensions of the field are unknown')
+
+    if scan_mode & 0x10:
+        raise NotImplementedError('Boustrophedonic scanning is not '
+                                  'supported')
+
+    if scan_mode & 0x20:
+        # adjacent points in j direction are consecutive
+        grid = values.reshape(nx, ny).T
+    else:
+        grid = values.reshape(ny, nx)
+
+    if scan_mode & 0x80:
+        # points scan in the -i direction (east to west)
+        grid = grid[:, ::-1]
+    if not scan_mode & 0x40:
+        # points scan in the -j direction (north to south)
+        grid = grid[::-1]
+
+    return grid
+
+def we_sn_indices(field, rows, cols):
+    """Raw order indices of points of the WE:SN grid of a field.
+
+    The inverse of `we_sn` for selected points: the value at
+    ``we_sn(values, field)[rows, cols]`` is ``values[indices]``.
+    Computed from the strides of the view, in O(1) per point.
+
+    """
+    # never written, so no memory is actually used
+    base = np.empty(field['npoints'], dtype=np.uint8)
+    grid = we_sn(base, field)
+
+    offset = grid.__array_interface__['data'][0] - \
+             base.__array_interface__['data'][0]
+
+    return (offset + np.asarray(rows)*grid.strides[0] +
+            np.asarray(cols)*grid.strides[1])
+
+def decode_field(buf, field, order='raw', out=None, missing=UNDEFINED):
+    """Decode the values of a GRIB field.
+
+    Parameters
+    ----------
+    buf : string or mmap
+        The buffer containing the GRIB message.
+    field : dict
+        The field description from `iter_fields`.
+    order : {'raw', 'we:sn'}, optional
+        Return the values in the order they are stored in the file
+        (like wgrib and 'wgrib2 -order raw'), or reordered from west to
+        east and south to north (the wgrib2 default).
+    out : ndarray, optional
+        An array with `field['npoints']` elements to hold the result
+        (in 'raw' order only). It may be a non-contiguous view, such
+        as a flipped plane of a larger array, and the values are
+        written into it without an intermediate copy.
+    missing : float, optional
+        The value of points missing from the bitmap, UNDEFINED by
+        default.
+
+    Returns
+    -------
+    values : ndarray
+        A 1D float32 array of values, or `out`.
+
+    """
+    if order not in ('raw', 'we:sn'):
+        raise ValueError('Invalid parameter passed for order: %s' % order)
+    if order == 'we:sn' and out is not None:
+        raise ValueError("out is only supported with order='raw'")
+
+    npoints = field['npoints']
+
+    if out is None:
+        values = np.empty(npoints, dtype=np.float32)
+    else:
+        values = out
+
+    # Decode a block of rows at a time, so the float64 scratch space
+    # and the unpacked bitmap never exceed _chunk_size points
+    ncols = values.shape[-1] if values.ndim > 1 else 1
+    grid = values.view()
+    grid.shape = (-1, ncols)
+
+    block_rows = max(1, _chunk_size//ncols)
+    scratch = np.empty(min(block_rows*ncols, npoints), dtype=np.float64)
+
+    value = 0 # number of the next packed value
+    for row in range(0, grid.shape[0], block_rows):
+        block = grid[row:row + block_rows]
+        start = row*ncols
+
+        if field['bitmap_offset'] is None:
+            count = block.size
+        else:
+            first_byte = start//8
+            nbytes = (start + block.size + 7)//8 - first_byte
+            bits = np.frombuffer(buf, dtype=np.uint8, count=nbytes,
+                                 offset=field['bitmap_offset'] + first_byte)
+            shift = start - 8*first_byte
+            mask = np.unpackbits(bits)[shift:shift + block.size]
+            mask = mask.view(bool).reshape(block.shape)
+            count = int(mask.sum())
+
+        ints = scratch[:count]
+        _unpack(buf, field['data_offset'], field['nbits'], count, ints,
+                first=value)
+        _scale(ints, field['ref'], field['bin_scale'], field['dec_scale'])
+        value += count
+
+        if field['bitmap_offset'] is None:
+            block[...] = ints.reshape(block.shape)
+        else:
+            block.fill(missing)
+            block[mask] = ints
+
+    if order == 'we:sn' and field['nx'] is not None:
+        return we_sn(values, field).ravel()
+
+    return values
+
+# Number of bits set in each byte value
+_popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None],
+                          axis=1).sum(axis=1)
+
+def decode_points(buf, field, indices, missing=UNDEFINED):
+    """Decode the values of a GRIB field at selected points.
+
+    Only the packed values of the points are unpacked, found directly
+    from their positions, so extracting a few points is much faster
+    than decoding the whole field.
+
+    Parameters
+    ----------
+    buf : string or mmap
+        The buffer containing the GRIB message.
+    field : dict
+        The field description from `iter_fields`.
+    indices : array_like
+        The indices of the points in 'raw' order.
+    missing : float, optional
+        The value of points missing from the bitmap.
+
+    Returns
+    -------
+    values : ndarray
+        A float32 array of the values at `indices`.
+
+    """
+    indices = np.asarray(indices, dtype=np.intp)
+    npoints = field['npoints']
+    if indices.size and (indices.min() < 0 or indices.max() >= npoints):
+        raise IndexError('Point indices must be between 0 and %d' %
+                         (npoints - 1))
+
+    present = np.ones(indices.shape, dtype=bool)
+    positions = indices
+    if field['bitmap_offset'] is not None:
+        nbytes = (npoints + 7)//8
+        bitmap = np.frombuffer(buf, dtype=np.uint8, count=nbytes,
+                               offset=field['bitmap_offset'])
+
+        byte = indices >> 3
+        bit = indices & 7
+        bits = bitmap[byte].astype(np.intp)
+        present = (bits >> (7 - bit)) & 1 == 1
+
+        # the position of a value is the number of points before it
+        # in the bitmap
+        before = np.zeros(nbytes + 1, dtype=np.int64)
+        np.cumsum(_popcount[bitmap], out=before[1:])
+        positions = before[byte] + _popcount[bits >> (8 - bit)]
+
+    values = np.zeros(indices.shape, dtype=np.float64)
+    nbits = field['nbits']
+    if nbits > 32:
+        raise NotImplementedError('%d bit packing is not supported' % nbits)
+    if nbits > 0 and present.any():
+        nvalues = int(before[-1]) if field['bitmap_offset'] is not None \
+                  else npoints
+        data = np.frombuffer(buf, dtype=np.uint8,
+                             count=(nvalues*nbits + 7)//8,
+                             offset=field['data_offset'])
+        bitpos = positions[present].astype(np.uint64)*nbits
+        values[present] = _bits_at(data, bitpos, nbits)
+
+    _scale(values, field['ref'], field['bin_scale'], field['dec_scale'])
+
+    values = values.astype(np.float32)
+    values[~present] = missing
+
+    return values
+
+def open_grib(grb_name):
+    """Return a read-only memory map of a GRIB file."""
+    with open(grb_name, 'rb') as fp:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _index_name(grb_name):
+    return grb_name + '.idx.npz'
+
+def _build_index(buf):
+    """Scan the record headers in `buf` into an inventory array."""
+    rows = []
+    field_num = 0
+    last_offset = None
+    for field in iter_fields(buf):
+        if field['offset'] == last_offset:
+            field_num += 1
+        else:
+            field_num = 0
+            last_offset = field['offset']
+
+        if field['edition'] == 1:
+            discipline, category, param = -1, -1, field['param']
+        else:
+            discipline = field['discipline']
+            category = field['category']
+            param = field['number']
+
+        level = field['level']
+        rows.append((field['offset'], field['length'], field_num,
+                     field['edition'], discipline, category, param,
+                     _missing(field['level_type']),
+                     np.nan if level is None else level,
+                     _missing(field['time_unit']),
+                     _missing(field['forecast_time'])))
+
+    return np.array(rows, dtype=_index_dtype)
+
+def _missing(value):
+    return -1 if value is None else value
+
+def inventory(grb_name, persist=True):
+    """The inventory of the records in a GRIB file.
+
+    The message boundaries and section headers of the file are scanned
+    once. Unless `persist` is False, the inventory is saved alongside
+    the file (as grb_name + '.idx.npz') and re-used until the file's
+    size or modification time changes. Files in read-only directories
+    are simply scanned each time.
+
+    Returns
+    -------
+    index : ndarray
+        A record array with a row for each record (field), giving the
+        `offset` and `length` of its message, the `field` number within
+        the message, the `edition`, `discipline`, `category`, `param`,
+        `level_type`, `level`, `time_unit` and `forecast_time`.
+
+    """
+    stat = os.stat(grb_name)
+    idx_name = _index_name(grb_name)
+
+    if persist and os.path.exists(idx_name):
+        try:
+            with np.load(idx_name) as cache:
+                if cache['size'] == stat.st_size and \
+                   cache['mtime'] == stat.st_mtime:
+                    return cache['index']
+        except (IOError, KeyError, ValueError):
+            pass # rebuild a damaged index
+
+    buf = open_grib(grb_name)
+    try:
+        index = _build_index(buf)
+    finally:
+        buf.close()
+
+    if persist:
+        tmp_name = idx_name + '.tmp'
+        try:
+            with open(tmp_name, 'wb') as fp:
+                np.savez(fp, index=index, size=stat.st_size,
+                         mtime=stat.st_mtime)
+            os.rename(tmp_name, idx_name)
+        except (IOError, OSError):
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+    return index
+
+def select(index, **criteria):
+    """Select records from an inventory by their header values.
+
+    For example ``select(index, param=11, level=850)``. Criteria that
+    are None are ignored.
+
+    Returns
+    -------
+    records : ndarray
+        The matching record numbers, counting from 1.
+
+    """
+    match = np.ones(len(index), dtype=bool)
+    for name, value in criteria.items():
+        if name not in index.dtype.names:
+            raise ValueError('Unknown record selection: %s' % name)
+        if value is not None:
+            match &= index[name] == value
+
+    return np.flatnonzero(match) + 1
+
+def _indexed_field(buf, row):
+    """The field description of an inventory row."""
+    if row['edition'] == 1:
+        fields = _grib1_fields(buf, row['offset'], row['length'])
+    else:
+        fields = _grib2_fields(buf, row['offset'], row['length'])
+
+    for i, field in enumerate(fields):
+        if i == row['field']:
+            return field
+
+def read_records(grb_name, records, order='raw', index=None, out=None,
+                 missing=UNDEFINED):
+    """Read selected records from a GRIB file.
+
+    Each message is located through the inventory, so only the
+    selected records are scanned and decoded. The file is read once,
+    in the order of `records`.
+
+    Parameters
+    ----------
+    grb_name : string
+        The name of the GRIB1 or GRIB2 file.
+    records : sequence of ints
+        The record numbers, counting from 1.
+    order : {'raw', 'we:sn'}, optional
+        The order of the returned values, see `decode_field`.
+    index : ndarray, optional
+        The inventory of the file, by default from `inventory`.
+    out : sequence of ndarrays, optional
+        Arrays (or views) to decode each record into, see
+        `decode_field`.
+    missing : float, optional
+        The value of points missing from the bitmap.
+
+    Returns
+    -------
+    fields : generator
+        Yields (field, values) for each record, as `read`.
+
+    """
+    if index is None:
+        index = inventory(grb_name)
+
+    for record in records:
+        if not 1 <= record <= len(index):
+            raise IndexError('%s has no record %d' % (grb_name, record))
+
+    buf = open_grib(grb_name)
+    try:
+        for i, record in enumerate(records):
+            field = _indexed_field(buf, index[record-1])
+            if out is None:
+                yield field, decode_field(buf, field, order,
+                                          missing=missing)
+            else:
+                yield field, decode_field(buf, field, order, out[i],
+                                          missing)
+    finally:
+        buf.close()
+
+def read(grb_name, record=1, order='raw', index=None):
+    """Read a field from a GRIB file.
+
+    Parameters
+    ----------
+    grb_name : string
+        The name of the GRIB1 or GRIB2 file.
+    record : int, optional
+        The record (field) number, counting from 1 as wgrib/wgrib2 do.
+        Default is the first record.
+    order : {'raw', 'we:sn'}, optional
+        The order of the returned values, see `decode_field`.
+    index : ndarray, optional
+        The inventory of the file. By default the first record is read
+        directly and later records are located through `inventory`,
+        which is saved alongside the file so repeated reads skip the
+        scan.
+
+    Returns
+    -------
+    field : dict
+        The field description, see `iter_fields`.
+    values : ndarray
+        A 1D float32 array of the field values.
+
+    """
+    if index is None and record != 1:
+        index = inventory(grb_name)
+    if index is not None and not 1 <= record <= len(index):
+        raise IndexError('%s has no record %d' % (grb_name, record))
+
+    buf = open_grib(grb_name)
+    try:
+        if index is not None:
+            field = _indexed_field(buf, index[record-1])
+            return field, decode_field(buf, field, order)
+
+        for field in iter_fields(buf):
+            return field, decode_field(buf, field, order)
+    finally:
+        buf.close()
+
+    raise IndexError('%s has no record %d' % (grb_name, record))
+
+def wgrib2_read(grb_name, record=1, order='we:sn', wgrib2='wgrib2',
+                timeout=None):
+    """Read a field from a GRIB2 file with wgrib2.
+
+    wgrib2 writes the field as binary floats to a pipe, which is read
+    directly into an array, so no intermediate file is written.
+
+    Parameters
+    ----------
+    grb_name : string
+        The name of the GRIB2 file.
+    record : int, optional
+        The record number, counting from 1.
+    order : {'we:sn', 'raw'}, optional
+        The order of the returned values, see `decode_field`.
+    wgrib2 : string, optional
+        The name or path of the wgrib2 executable.
+    timeout : float, optional
+        Kill wgrib2 if it runs for longer than this many seconds.
+
+    Returns
+    -------
+    values : ndarray
+        A 1D float32 array of the field values.
+
+    Raises
+    ------
+    WgribError
+        If wgrib2 fails or is killed after the timeout.
+
+    """
+    args = [wgrib2, grb_name, '-d', str(record), '-order', order,
+            '-inv', os.devnull, '-no_header', '-bin', '-']
+
+    try:
+        stdout, stderr, retcode = exec_command(args, timeout)
+    except OSError as e:
+        raise WgribError(grb_name, -1, 'cannot run %s: %s' % (wgrib2, e))
+
+    if retcode != 0:
+        if timeout is not None and retcode == -signal.SIGKILL:
+            stderr = 'killed after %g s timeout\n%s' % (timeout, stderr)
+        raise WgribError(grb_name, retcode, stderr)
+
+    return np.frombuffer(stdout, dtype=np.float32)
+
+def _read_values(args):
+    """Thread worker for read_many, decodes one file natively."""
+    grb_name, record, order = args
+    return read(grb_name, record, order)[1]
+
+def read_many(grb_names, record=1, order='raw', threads=4, wgrib2=None,
+              timeout=None):
+    """Read a field from each of a sequence of GRIB files.
+
+    The files are converted by a bounded pool of worker threads, and
+    the field values yielded in the same order as `grb_names`. At most
+    twice `threads` results are held in memory at once.
+
+    Parameters
+    ----------
+    grb_names : iterable of strings
+        The names of the GRIB files.
+    record : int, optional
+        The record number to read from each file, counting from 1.
+    order : {'raw', 'we:sn'}, optional
+        The order of the returned values, see `decode_field`.
+    threads : int, optional
+        The number of files converted concurrently.
+    wgrib2 : string, optional
+        If given, each file is converted by running this wgrib2
+        executable, see `wgrib2_read`. By default the files are
+        decoded in Python.
+    timeout : float, optional
+        The time limit in seconds for each wgrib2 conversion.
+
+    Returns
+    -------
+    values : generator
+        Yields a 1D float32 array for each file. A failed wgrib2
+        conversion raises WgribError when its result is reached.
+
+    """
+    if wgrib2 is None:
+        func = _read_values
+        tasks = ((grb_name, record, order) for grb_name in grb_names)
+    else:
+        func = lambda grb_name: wgrib2_read(grb_name, record, order,
+                                            wgrib2, timeout)
+        tasks = grb_names
+
+    pool = ThreadPool(threads)
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= 2*threads:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
@@ -2,21 +2,22 @@
 
 This module contains some simple functions to make it easier
 to read and plot the data from MDV files produced
-by SAWS. The module relies on Scott Sinclair's
-mdv2ASCII programme being somewhere on your systems path.
+by SAWS. The files are decoded in Python by the MDVFile class, so
+Scott Sinclair's mdv2ASCII programme is no longer needed.
 
-If you don't have mdv2ASCII it can be obtained from:
-
-http://www.??????
+The MDV format is described in the documentation of NCAR's Mdvx
+library. Only gridded fields with 8-bit, 16-bit or 32-bit float
+encodings, stored uncompressed or compressed with zlib or gzip, are
+supported.
 
 """
 
 import os
-import sys
+import time
+import struct
+import zlib
 
 import numpy as np
-import pylab as pl
-import matplotlib as mpl
 
 my_dict = {'red':   ((0    , 1 , 1  ),
                     (0.35 , 0  , 0  ),
@@ -35,44 +36,440 @@ my_dict = {'red':   ((0    , 1 , 1  ),
                     (0.65 ,0   , 0  ),
                     (1    , 0  , 0  ))}
 
-def execute(command):
-    """Execute a command passed as a string."""
-    
-    print '\nRunning:', command
-    os.system(command)
-    print 'Done----------------\n'
-    
+# Header layouts, all values are big endian
+_master_fmt = '>28I8iI5i6f3f12f512s128s128sI'
+_master_names = [
+    'record_len1', 'struct_id', 'revision_number', 'time_gen',
+    'user_time', 'time_begin', 'time_end', 'time_centroid',
+    'time_expire', 'num_data_times', 'index_number', 'data_dimension',
+    'data_collection_type', 'user_data', 'native_vlevel_type',
+    'vlevel_type', 'vlevel_included', 'grid_orientation',
+    'data_ordering', 'nfields', 'max_nx', 'max_ny', 'max_nz', 'nchunks',
+    'field_hdr_offset', 'vlevel_hdr_offset', 'chunk_hdr_offset',
+    'field_grids_differ'] + \
+    ['user_data_si32_%d' % i for i in range(8)] + \
+    ['time_written'] + \
+    ['unused_si32_%d' % i for i in range(5)] + \
+    ['user_data_fl32_%d' % i for i in range(6)] + \
+    ['sensor_lon', 'sensor_lat', 'sensor_alt'] + \
+    ['unused_fl32_%d' % i for i in range(12)] + \
+    ['data_set_info', 'data_set_name', 'data_set_source', 'record_len2']
+
+_field_fmt = '>17I10i9I4i31f64s16s16s16s16sI'
+_field_names = [
+    'record_len1', 'struct_id', 'field_code', 'user_time1',
+    'forecast_delta', 'user_time2', 'user_time3', 'forecast_time',
+    'user_time4', 'nx', 'ny', 'nz', 'proj_type', 'encoding_type',
+    'data_element_nbytes', 'field_data_offset', 'volume_size'] + \
+    ['user_data_si32_%d' % i for i in range(10)] + \
+    ['compression_type', 'transform_type', 'scaling_type',
+     'native_vlevel_type', 'vlevel_type', 'dz_constant',
+     'data_dimension', 'zoom_clipped', 'zoom_no_overlap'] + \
+    ['unused_si32_%d' % i for i in range(4)] + \
+    ['proj_origin_lat', 'proj_origin_lon'] + \
+    ['proj_param_%d' % i for i in range(8)] + \
+    ['vert_reference', 'grid_dx', 'grid_dy', 'grid_dz', 'grid_minx',
+     'grid_miny', 'grid_minz', 'scale', 'bias', 'bad_data_value',
+     'missing_data_value', 'proj_rotation'] + \
+    ['user_data_fl32_%d' % i for i in range(4)] + \
+    ['min_value', 'max_value', 'min_value_orig_vol',
+     'max_value_orig_vol', 'unused_fl32',
+     'field_name_long', 'field_name', 'units', 'transform',
+     'unused_char', 'record_len2']
+
+_vlevel_fmt = '>2I122I4I122f5fI'
+_max_vlevels = 122
+
+_master_struct_id = 14152
+_field_struct_id = 14153
+
+# Field encodings and the corresponding (big endian) data types
+ENCODING_INT8 = 1
+ENCODING_INT16 = 2
+ENCODING_FLOAT32 = 5
+_encoding_dtypes = {ENCODING_INT8: np.dtype('>u1'),
+                    ENCODING_INT16: np.dtype('>u2'),
+                    ENCODING_FLOAT32: np.dtype('>f4')}
+
+COMPRESSION_NONE = 0
+
+# Compressed planes start with a 24 byte header, whose first word
+# identifies the compression
+_compress_hdr_fmt = '>4I2I'
+_compress_hdr_length = 24
+_zlib_cookies = (0xf5f5f5f5, 0xf7f7f7f7) # zlib and gzip
+# Not compressed, and the *_NOT_COMPRESSED cookies of LZO, bzip2,
+# zlib and gzip, used when compression would not save space
+_raw_cookies = (0x2f2f2f2f, 0xf2f2f2f2, 0xf4f4f4f4, 0xf6f6f6f6, 0xf8f8f8f8)
+
+def _decompress(buf):
+    """Decompress a plane stored with a compression header."""
+    magic, nbytes_uncompressed, nbytes_compressed, nbytes_coded = \
+        struct.unpack('>4I', buf[:16])
+    coded = buf[_compress_hdr_length:_compress_hdr_length + nbytes_coded]
+
+    if magic in _zlib_cookies:
+        # Accept either a zlib or a gzip stream
+        return zlib.decompress(coded, 32 + zlib.MAX_WBITS)
+    elif magic in _raw_cookies:
+        return coded
+    else:
+        raise NotImplementedError('Unsupported MDV compression '
+                                  '(magic cookie 0x%08x)' % magic)
+
+class MDVFile():
+    """Class for read operations on MDV files.
+
+    The master, field and vlevel headers are read when the file is
+    opened. The planes of a field are decoded from the file when
+    requested.
+
+    Example usage:
+
+    >>> mdv_file = MDVFile(filename)
+
+    >>> print(mdv_file.header()['nfields'])
+    >>> print(mdv_file.field_names())
+    >>> print(mdv_file.vlevels(0))
+
+    >>> dbz = mdv_file.read_plane('DBZ', level=0)
+    >>> volume = mdv_file.read_volume(['DBZ', 'VEL'])
+    >>> colmax = mdv_file.column_max('DBZ')
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as fp:
+            self._read_headers(fp)
+
+        # The plane offsets and sizes of each field, read on first use
+        self._plane_index = {}
+
+    # Internal methods
+
+    def _read_headers(self, fp):
+        buf = fp.read(struct.calcsize(_master_fmt))
+        self._header = dict(zip(_master_names,
+                                struct.unpack(_master_fmt, buf)))
+
+        if self._header['struct_id'] != _master_struct_id:
+            raise ValueError('%s is not an MDV file' % self.filename)
+
+        nfields = self._header['nfields']
+
+        fp.seek(self._header['field_hdr_offset'])
+        size = struct.calcsize(_field_fmt)
+        self._field_headers = []
+        for i in range(nfields):
+            values = struct.unpack(_field_fmt, fp.read(size))
+            hdr = dict(zip(_field_names, values))
+            for key in ('field_name_long', 'field_name', 'units',
+                        'transform', 'unused_char'):
+                hdr[key] = hdr[key].split('\0', 1)[0]
+            self._field_headers.append(hdr)
+
+        fp.seek(self._header['vlevel_hdr_offset'])
+        size = struct.calcsize(_vlevel_fmt)
+        self._vlevel_types = []
+        self._vlevels = []
+        for i in range(nfields):
+            values = struct.unpack(_vlevel_fmt, fp.read(size))
+            nz = self._field_headers[i]['nz']
+            self._vlevel_types.append(np.array(values[2:2 + nz]))
+            start = 2 + _max_vlevels + 4
+            self._vlevels.append(np.array(values[start:start + nz],
+                                          dtype=np.float32))
+
+        for key in ('data_set_info', 'data_set_name', 'data_set_source'):
+            self._header[key] = self._header[key].split('\0', 1)[0]
+
+    def _field_number(self, field):
+        """The index of a field given by number or by name."""
+        if isinstance(field, basestring):
+            names = self.field_names()
+            if field not in names:
+                raise KeyError('No field %s in %s' % (field, self.filename))
+            return names.index(field)
+
+        if not 0 <= field < len(self._field_headers):
+            raise IndexError('Field %d out of range' % field)
+
+        return field
+
+    def _planes(self, fp, field):
+        """File offsets and sizes of the planes of a field."""
+        if field not in self._plane_index:
+            hdr = self._field_headers[field]
+            nz = hdr['nz']
+            plane_bytes = hdr['nx']*hdr['ny']*hdr['data_element_nbytes']
+            start = hdr['field_data_offset']
+
+            if hdr['compression_type'] == COMPRESSION_NONE and \
+               hdr['volume_size'] == nz*plane_bytes:
+                # Planes stored back to back without compression headers
+                offsets = start + plane_bytes*np.arange(nz)
+                nbytes = np.repeat(plane_bytes, nz)
+                headed = False
+            else:
+                # Plane offsets (relative to the end of the offset
+                # and size arrays) and sizes precede the planes
+                fp.seek(start)
+                table = np.fromfile(fp, dtype='>u4', count=2*nz)
+                offsets = start + 8*nz + table[:nz].astype(np.int64)
+                nbytes = table[nz:].astype(np.int64)
+                headed = True
+
+            self._plane_index[field] = (offsets, nbytes, headed)
+
+        return self._plane_index[field]
+
+    def _read_raw(self, fp, field, level):
+        """The stored values of a plane as a 2-D array."""
+        hdr = self._field_headers[field]
+        if not 0 <= level < hdr['nz']:
+            raise IndexError('Level %d out of range' % level)
+
+        dtype = _encoding_dtypes.get(hdr['encoding_type'])
+        if dtype is None:
+            raise NotImplementedError('Unsupported MDV encoding %d' %
+                                      hdr['encoding_type'])
+
+        offsets, nbytes, headed = self._planes(fp, field)
+
+        fp.seek(offsets[level])
+        buf = fp.read(nbytes[level])
+        if headed:
+            buf = _decompress(buf)
+
+        return np.frombuffer(buf, dtype=dtype).reshape(hdr['ny'], hdr['nx'])
+
+    def _decode(self, field, raw, out):
+        """Scale stored values into `out`, return the mask of invalid values."""
+        hdr = self._field_headers[field]
+
+        invalid = (raw == hdr['bad_data_value'])
+        invalid |= (raw == hdr['missing_data_value'])
+
+        out[...] = raw
+        if hdr['encoding_type'] != ENCODING_FLOAT32:
+            out *= hdr['scale']
+            out += hdr['bias']
+
+        return invalid
+
+    # API methods
+
+    def header(self):
+        """The master header as a dict."""
+        return self._header
+
+    def field_header(self, field):
+        """The header of a field, given by number or name, as a dict."""
+        return self._field_headers[self._field_number(field)]
+
+    def field_names(self):
+        """The (short) names of the fields in the file."""
+        return [hdr['field_name'] for hdr in self._field_headers]
+
+    def vlevels(self, field=0):
+        """The vertical levels of a field."""
+        return self._vlevels[self._field_number(field)]
+
+    def read_plane(self, field=0, level=0):
+        """Read one plane of a field.
+
+        Parameters
+        ----------
+        field : int or string, optional
+            The number or name of the field.
+        level : int, optional
+            The index of the vertical level.
+
+        Returns
+        -------
+        data : MaskedArray
+            A float32 array of shape (ny, nx), with the first row at
+            grid_miny (south up for the usual grid orientation). Bad
+            and missing values are masked.
+
+        """
+        field = self._field_number(field)
+
+        with open(self.filename, 'rb') as fp:
+            raw = self._read_raw(fp, field, level)
+
+        data = np.empty(raw.shape, dtype=np.float32)
+        invalid = self._decode(field, raw, data)
+
+        return np.ma.masked_array(data, mask=invalid)
+
+    def iter_planes(self, field=0, levels=None):
+        """Iterate over the planes of a field, one level at a time.
+
+        The file is opened once and only the current plane is held in
+        memory, so reductions over the levels (see `column_max` and
+        `echo_top`) need not load the whole volume.
+
+        Parameters
+        ----------
+        field : int or string, optional
+            The number or name of the field.
+        levels : sequence of int, optional
+            The indices of the levels, by default all of them.
+
+        Yields
+        ------
+        level, data : int, MaskedArray
+            The level index and the plane, as `read_plane`.
+
+        """
+        field = self._field_number(field)
+        if levels is None:
+            levels = range(self._field_headers[field]['nz'])
+
+        with open(self.filename, 'rb') as fp:
+            for level in levels:
+                raw = self._read_raw(fp, field, level)
+                data = np.empty(raw.shape, dtype=np.float32)
+                invalid = self._decode(field, raw, data)
+
+                yield level, np.ma.masked_array(data, mask=invalid)
+
+    def read_volume(self, fields=None, levels=None, out=None):
+        """Read the levels of several fields into one array.
+
+        The file is opened once and each plane is decoded straight
+        into its slot of the output array.
+
+        Parameters
+        ----------
+        fields : sequence of int or string, optional
+            The numbers or names of the fields, by default all of
+            them. The fields must share the same grid.
+        levels : sequence of int, optional
+            The indices of the levels, by default all levels of the
+            first field.
+        out : ndarray, optional
+            A floating point array of shape (field, level, ny, nx) to
+            fill, for example a float32 memmap.
+
+        Returns
+        -------
+        data : ndarray
+            A float32 array of shape (field, level, ny, nx), NaN where
+            the values are bad or missing.
+
+        """
+        if fields is None:
+            fields = range(len(self._field_headers))
+        fields = [self._field_number(field) for field in fields]
+
+        shapes = set((self._field_headers[field]['ny'],
+                      self._field_headers[field]['nx']) for field in fields)
+        if len(shapes) != 1:
+            raise ValueError('The fields are not on the same grid')
+        ny, nx = shapes.pop()
+
+        if levels is None:
+            levels = range(self._field_headers[fields[0]]['nz'])
+
+        shape = (len(fields), len(levels), ny, nx)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape or \
+             not np.issubdtype(out.dtype, np.floating):
+            raise ValueError('out is a %s array of shape %s, expected a '
+                             'floating point array of shape %s' %
+                             (out.dtype, out.shape, shape))
+
+        with open(self.filename, 'rb') as fp:
+            for i, field in enumerate(fields):
+                for j, level in enumerate(levels):
+                    raw = self._read_raw(fp, field, level)
+                    invalid = self._decode(field, raw, out[i, j])
+                    out[i, j][invalid] = np.nan
+
+        return out
+
+    def column_max(self, field=0, levels=None):
+        """The maximum of a field over the levels (e.g. column max dBZ).
+
+        The planes are read one at a time. Columns without valid
+        values are masked.
+
+        """
+        result = None
+        for level, data in self.iter_planes(field, levels):
+            if result is None:
+                result = data.filled(-np.inf)
+            else:
+                np.maximum(result, data.filled(-np.inf), out=result)
+
+        return np.ma.masked_equal(result, -np.inf)
+
+    def echo_top(self, field=0, threshold=18.0):
+        """The height of the highest level where the field reaches a threshold.
+
+        The planes are read one at a time, and the heights are the
+        vlevels of the field. Columns which never reach the threshold
+        are masked.
+
+        """
+        heights = self.vlevels(field)
+
+        result = None
+        for level, data in self.iter_planes(field):
+            if result is None:
+                result = np.full(data.shape, np.nan, dtype=np.float32)
+            reached = data.filled(-np.inf) >= threshold
+            result[reached] = heights[level]
+
+        return np.ma.masked_invalid(result)
+
 def read_mdv(mdv_name, field=0, level=0):
     """Read the data field from an MDV file into an array.
 
-    This function uses mdv2ASCII to write and then read the MDV
-    data to an intermediate ascii format, which is later
-    deleted.
+    The plane is decoded directly from the MDV file, see
+    MDVFile.read_plane.
 
     """
-    
-    txt_name = mdv_name[0:-4] + '.txt'
+    return MDVFile(mdv_name).read_plane(field, level)
 
-    exec_str = 'mdv2ASCII %s %d %d %s' % (mdv_name, field, level, txt_name)
+# The colormap is built on first use, see colormap()
+_colormap = None
 
-    execute(exec_str)
-    a = pl.load(txt_name)
-    os.remove(txt_name)
+def colormap():
+    """The colormap used for radar reflectivity plots.
 
-    return a
+    The colormap is built from `my_dict` on the first call and reused
+    afterwards.
+
+    """
+    global _colormap
+
+    if _colormap is None:
+        import matplotlib as mpl
+        _colormap = mpl.colors.LinearSegmentedColormap('my_colormap',
+                                                       my_dict, 256)
+
+    return _colormap
+
+def _default_title(mdv_name):
+    """The scan time (HH:MM:SS) from a file name like 20100101_120500.mdv"""
+    return '%s:%s:%s' % (mdv_name[-10:-8], mdv_name[-8:-6], mdv_name[-6:-4])
 
 def mdv_plot(mdv_name, fig_name, title=None, field=0, level=0):
     """Create a plot of the data in an MDV file."""
+    import pylab as pl
 
     if title == None:
-        title = '%s:%s:%s' % (mdv_name[-10:-8], mdv_name[-8:-6], mdv_name[-6:-4])
-        
+        title = _default_title(mdv_name)
+
     a = read_mdv(mdv_name, field, level)
 
-    my_cmap = mpl.colors.LinearSegmentedColormap('my_colormap', my_dict, 256)
-     
-##    pl.imshow(np.flipud(a), interpolation='nearest')
-    pl.imshow(a, cmap=my_cmap, interpolation='nearest')
+    # The first row of the plane is the southern edge of the grid
+    pl.imshow(a, cmap=colormap(), interpolation='nearest', origin='lower')
     pl.clim(0, 60)
 ##    pl.clim(-30, 55)
     pl.grid()
@@ -81,3 +478,144 @@ def mdv_plot(mdv_name, fig_name, title=None, field=0, level=0):
     pl.savefig(fig_name)
     pl.close()
 
+class MDVRenderer():
+    """Render planes of MDV files to image files with one figure.
+
+    The figure, axes, colorbar and colour normalisation are created
+    for the first file, and each later file only replaces the image
+    data and the title before the figure is saved. The figure is
+    drawn with the Agg backend, so no display is needed.
+
+    Example usage:
+
+    >>> renderer = MDVRenderer(field='DBZ')
+    >>> for mdv_name, fig_name in zip(mdv_names, fig_names):
+    ...     renderer.render(mdv_name, fig_name)
+
+    """
+    def __init__(self, field=0, level=0, vmin=0, vmax=60, dpi=100):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.colors import Normalize
+        from matplotlib.figure import Figure
+
+        self.field = field
+        self.level = level
+        self.dpi = dpi
+
+        self._fig = Figure()
+        self._canvas = FigureCanvasAgg(self._fig)
+        self._ax = self._fig.add_subplot(111)
+        self._ax.grid(True)
+        self._norm = Normalize(vmin, vmax)
+        self._title = self._ax.set_title('')
+
+        # Created when the first plane is rendered
+        self._image = None
+        self._shape = None
+
+    # API methods
+
+    def render(self, mdv_name, fig_name, title=None):
+        """Plot a plane of an MDV file and save the figure to fig_name."""
+        if title is None:
+            title = _default_title(mdv_name)
+
+        data = read_mdv(mdv_name, self.field, self.level)
+        ny, nx = data.shape
+
+        if self._image is None:
+            # The first row of the plane is the southern edge of the grid
+            self._image = self._ax.imshow(data, cmap=colormap(),
+                                          norm=self._norm,
+                                          interpolation='nearest',
+                                          origin='lower')
+            self._fig.colorbar(self._image, ax=self._ax)
+        else:
+            self._image.set_data(data)
+            if data.shape != self._shape:
+                self._image.set_extent((-0.5, nx - 0.5, -0.5, ny - 0.5))
+        self._shape = data.shape
+
+        self._title.set_text(title)
+        self._canvas.print_figure(fig_name, dpi=self.dpi)
+
+def _render_files(args):
+    """Render a list of files with one renderer (in a worker process)."""
+    mdv_names, fig_names, field, level = args
+
+    renderer = MDVRenderer(field, level)
+    for mdv_name, fig_name in zip(mdv_names, fig_names):
+        renderer.render(mdv_name, fig_name)
+
+    return len(mdv_names)
+
+def render_batch(mdv_names, fig_dir=None, field=0, level=0, processes=1,
+                 verbose=True):
+    """Render a plane of each of a list of MDV files to PNG images.
+
+    Each process renders a contiguous share of the files with a single
+    MDVRenderer, so the figure is only set up once per process.
+
+    Parameters
+    ----------
+    mdv_names : list of strings
+        The MDV files, e.g. a day of 5 minute scans.
+    fig_dir : string, optional
+        The directory for the images, by default the directory of each
+        MDV file. The images are named after the MDV files, with the
+        extension .png.
+    field : int or string, optional
+        The number or name of the field to plot.
+    level : int, optional
+        The index of the level to plot.
+    processes : int, optional
+        The number of worker processes, None for one per CPU.
+    verbose : bool, optional
+        If True, report the number of frames rendered per second.
+
+    Returns
+    -------
+    fig_names : list of strings
+        The names of the images written.
+
+    """
+    from multiprocessing import Pool, cpu_count
+
+    if len(mdv_names) == 0:
+        return []
+
+    fig_names = []
+    for mdv_name in mdv_names:
+        base = os.path.splitext(mdv_name)[0] + '.png'
+        if fig_dir is not None:
+            base = os.path.join(fig_dir, os.path.basename(base))
+        fig_names.append(base)
+
+    if fig_dir is not None and not os.path.isdir(fig_dir):
+        os.makedirs(fig_dir)
+
+    if processes is None:
+        processes = cpu_count()
+    processes = max(1, min(processes, len(mdv_names)))
+
+    size = -(-len(mdv_names)//processes)
+    chunks = [(mdv_names[i:i + size], fig_names[i:i + size], field, level)
+              for i in range(0, len(mdv_names), size)]
+
+    start = time.time()
+    if processes == 1:
+        frames = sum(_render_files(chunk) for chunk in chunks)
+    else:
+        pool = Pool(processes)
+        try:
+            frames = sum(pool.map(_render_files, chunks))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    if verbose and frames > 0:
+        print('Rendered %d frames in %.1f s (%.1f frames/s)' %
+              (frames, elapsed, frames/max(elapsed, 1e-6)))
+
+    return fig_names
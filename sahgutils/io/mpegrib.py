@@ -3,78 +3,72 @@
 This module contains some simple functions to make it easier
 to read and plot the Multisensor Precipitation Estimate (MPE)
 data produced by EUMETSAT. The data are provied in GRIB2 files
-and the module currently relies on Wesley Ebisuzaki's
-wgrib2 programme being somewhere on your systems path. If you
-don't have wgrib2 it can be obtained from:
+which are decoded in Python by the grib module, giving the
+same values as Wesley Ebisuzaki's wgrib2 programme. If you want
+wgrib2 it can be obtained from:
 
 http://www.cpc.ncep.noaa.gov/products/wesley/wgrib2/
 
 """
 
 import os
-import sys
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
 
 import numpy as np
 from numpy import ma
-from scipy import io
-
-import pylab as pl
-
-def execute(command):
-    """Execute a system command passed as a string."""
-    
-    print 'Running:', command
-    os.system(command)
-    print 'Done----------------\n'
-    
-def read_bin_data(fname):
-    """Read data from a floating point binary file into an array.
-    
-    Read the data from a binary file created by wgrib2 into
-    a Numpy array. This assumes that wgrib2 has output the data
-    in 32bit floating point format and seems to work for the
-    MPE data that are being sent via EumetCast and processed by
-    David Taylors MDM software. The first and last values
-    read from the file are trimmed since they are superflous
-    FORTRAN headers.
 
-    """
-    
-    data = np.fromfile(fname, dtype=np.float32)    
-##    data = data[1:-1] # trim invalid values if FORTRAN headers are present
-
-    if sys.byteorder == 'big':#assumes that the data was written in little endian format
-        data = data.byteswap()
+import grib
+import msggrid
+import arcfltgrid
 
-    return data
+# The ArcGIS grid of the MSG full disk, as used by the cloud mask and
+# MPE products
+_arcgis_grid = {'x0': -5565000, 'y0': -5565000, 'cellsize': 3000}
 
 def read(grb_name):
     """Read the MPE data from a grib file into an array.
 
-    This function uses wgrib2 to write and then read the MPE
-    data via an intermediate binary file, which is later
-    deleted. The non-raining regions are masked and the data
+    The field is decoded directly from the GRIB2 file. The
+    non-raining regions are masked and the data
     converted into mm/hr.
 
     """
-    
-    rows = 3712 # fixed for MPE grid
-    cols = 3712 # fixed for MPE grid
 
-    bin_name = grb_name[0:-4] + '.bin'
+    # the wgrib2 default output order
+    field, a = grib.read(grb_name, order='we:sn')
 
-    exec_str = 'wgrib2 -no_f77 ' + '-bin ' + bin_name + ' ' + grb_name # spaces are N.B.
+    return _rain_rate(a)
+
+def read_many(grb_names, threads=4, wgrib2=None, timeout=None):
+    """Read the MPE data from a sequence of grib files.
+
+    The files are converted concurrently by `threads` worker threads
+    and the arrays, as returned by `read`, are yielded in the same
+    order as `grb_names`. If `wgrib2` is given, each file is converted
+    by running that wgrib2 executable with its binary output piped
+    back, and a failed or timed out conversion raises grib.WgribError.
+    See grib.read_many.
+
+    """
+    for a in grib.read_many(grb_names, order='we:sn', threads=threads,
+                            wgrib2=wgrib2, timeout=timeout):
+        yield _rain_rate(a)
 
-    execute(exec_str)
-    a = read_bin_data(bin_name)
-    os.remove(bin_name)
+def _rain_rate(a):
+    """Orient, mask and scale the values decoded from an MPE file."""
+    rows = 3712 # fixed for MPE grid
+    cols = 3712 # fixed for MPE grid
 
     a = a.reshape(rows, cols)
 
-    # data in grib file are oriented EW:SN
-    # need to check that this is correct, the plots look fine...
+    # EUMETSAT's files declare scanning mode 0 (west to east, north to
+    # south) but store the disk from its south-eastern corner, so the
+    # WE:SN reordering puts north at the top and east on the left.
+    # Flipping left to right gives the north up, west left grid of
+    # msggrid.
     a = np.fliplr(a)
-##    a = np.flipud(a)
 
     # mask
     a = ma.masked_greater(a, 9E20)
@@ -84,69 +78,330 @@ def read(grb_name):
 
     return a
 
+class MPEAccumulator():
+    """Accumulate MPE rain rates into hourly, daily or dekadal totals.
+
+    Slots are added in time order with `add`. Each slot is decoded
+    into a single reusable buffer and added to float32 sum and valid
+    count arrays, so only one slot and the accumulators are in memory
+    at a time. When a slot falls in a new window the previous window
+    is closed and its total returned.
+
+    The total of a window is the mean of the valid rain rates (in
+    mm/hr) times the length of the window in hours, so missing slots
+    and points masked in some slots do not bias the totals. Points
+    with no valid slots in a window are masked.
+
+    Parameters
+    ----------
+    period : {'hourly', 'daily', 'dekadal'}, optional
+        The accumulation window. Dekads start on the 1st, 11th and
+        21st of each month.
+    rows, cols : int, optional
+        The size of the MPE grid.
+
+    """
+    def __init__(self, period='daily', rows=3712, cols=3712):
+        if period not in ('hourly', 'daily', 'dekadal'):
+            raise ValueError('Invalid parameter passed for period: %s' %
+                             period)
+
+        self.period = period
+        self.rows = rows
+        self.cols = cols
+
+        self._buffer = np.empty(rows*cols, dtype=np.float32)
+        self._sum = np.zeros((rows, cols), dtype=np.float32)
+        self._count = np.zeros((rows, cols), dtype=np.uint16)
+        self._start = None
+
+    # Internal methods
+
+    def _window_start(self, slot_time):
+        if self.period == 'hourly':
+            return slot_time.replace(minute=0, second=0, microsecond=0)
+
+        start = datetime(slot_time.year, slot_time.month, slot_time.day)
+        if self.period == 'dekadal':
+            start = start.replace(day=min(start.day - 1, 20)//10*10 + 1)
+
+        return start
+
+    def _window_hours(self, start):
+        if self.period == 'hourly':
+            return 1.0
+        elif self.period == 'daily':
+            return 24.0
+
+        if start.day < 21:
+            end = start + timedelta(days=10)
+        else:
+            end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+        return (end - start).days*24.0
+
+    def _read_rate(self, grb_name):
+        """Decode a slot into the buffer, oriented as `read`."""
+        buf = grib.open_grib(grb_name)
+        try:
+            field = next(grib.iter_fields(buf))
+            grib.decode_field(buf, field, out=self._buffer, missing=np.nan)
+        finally:
+            buf.close()
+
+        # flipped like read, values still in mm/s
+        return grib.we_sn(self._buffer, field)[:, ::-1]
+
+    def _close(self):
+        scale = np.float32(3600*self._window_hours(self._start))
+
+        valid = self._count > 0
+        total = np.zeros((self.rows, self.cols), dtype=np.float32)
+        np.divide(self._sum, self._count, out=total, where=valid)
+        total *= scale
+        total = ma.masked_array(total, mask=~valid)
+
+        window = (self._start, total)
+
+        self._sum[:] = 0
+        self._count[:] = 0
+        self._start = None
+
+        return window
+
+    # API methods
+
+    def add(self, slot_time, grb_name):
+        """Add the MPE slot at `slot_time` from the file `grb_name`.
+
+        Returns the (window start, total) of the previous window if this
+        slot starts a new one, otherwise None. A `grb_name` of None
+        marks a missing slot.
+
+        """
+        start = self._window_start(slot_time)
+
+        window = None
+        if self._start is not None and start != self._start:
+            if start < self._start:
+                raise ValueError('MPE slots must be added in time order, '
+                                 '%s is before %s' % (slot_time,
+                                                      self._start))
+            window = self._close()
+
+        self._start = start
+
+        if grb_name is not None:
+            rate = self._read_rate(grb_name)
+            valid = ~np.isnan(rate)
+            np.add(self._sum, rate, out=self._sum, where=valid)
+            self._count += valid
+
+        return window
+
+    def flush(self):
+        """Close the current window, returning (window start, total).
+
+        Returns None if no slots have been added since the last window
+        was closed.
+
+        """
+        if self._start is None:
+            return None
+
+        return self._close()
+
+def accumulate(slots, period='daily', rows=3712, cols=3712):
+    """Accumulate a time ordered stream of MPE files into totals.
+
+    Parameters
+    ----------
+    slots : iterable
+        (datetime, grb_name) pairs in time order, e.g. a generator over
+        a directory of MPE files. A grb_name of None marks a missing
+        slot.
+    period : {'hourly', 'daily', 'dekadal'}, optional
+        The accumulation window, see MPEAccumulator.
+    rows, cols : int, optional
+        The size of the MPE grid.
+
+    Returns
+    -------
+    totals : generator
+        Yields (window start, total) as each window closes, where the
+        total is a float32 masked array of rainfall in mm. Windows
+        without any slots are skipped.
+
+    """
+    accumulator = MPEAccumulator(period, rows, cols)
+
+    for slot_time, grb_name in slots:
+        window = accumulator.add(slot_time, grb_name)
+        if window is not None:
+            yield window
+
+    window = accumulator.flush()
+    if window is not None:
+        yield window
+
+def _extract_slot(args):
+    """Worker for extract_stations, the rain rates at pixels of a file."""
+    grb_name, rows, cols = args
+
+    try:
+        buf = grib.open_grib(grb_name)
+    except (IOError, OSError, ValueError):
+        return None # missing or empty file
+
+    try:
+        field = next(grib.iter_fields(buf))
+        # oriented as read, flipped left to right from WE:SN to north
+        # up, west left
+        indices = grib.we_sn_indices(field, rows, field['nx'] - 1 - cols)
+        values = grib.decode_points(buf, field, indices, missing=np.nan)
+    finally:
+        buf.close()
+
+    return 3600*values
+
+def _load_checkpoint(checkpoint, grb_names, rows, cols):
+    with np.load(checkpoint) as saved:
+        if list(saved['grb_names']) != list(grb_names) or \
+           not np.array_equal(saved['rows'], rows) or \
+           not np.array_equal(saved['cols'], cols):
+            raise ValueError('The checkpoint %s is for different files or '
+                             'stations' % checkpoint)
+
+        return saved['values'], saved['done']
+
+def _save_checkpoint(checkpoint, grb_names, rows, cols, values, done):
+    tmp_name = checkpoint + '.tmp'
+    with open(tmp_name, 'wb') as fp:
+        np.savez(fp, grb_names=np.array(grb_names, dtype=np.str_),
+                 rows=rows, cols=cols, values=values, done=done)
+    try:
+        os.rename(tmp_name, checkpoint)
+    except OSError:
+        # Windows won't rename over an existing file
+        os.remove(checkpoint)
+        os.rename(tmp_name, checkpoint)
+
+def extract_stations(grb_names, lons, lats, processes=None, checkpoint=None,
+                     checkpoint_every=100, verbose=True):
+    """Extract MPE rain rates at stations from a sequence of files.
+
+    The pixels of the stations are found once (see msggrid.pixel_index)
+    and only the values at those pixels are decoded from each file, so
+    the full grid is never held in memory. The files are processed in
+    parallel by a pool of worker processes.
+
+    Parameters
+    ----------
+    grb_names : sequence of strings
+        The MPE GRIB2 files, one per time step.
+    lons, lats : array_like
+        The longitudes and latitudes of the stations in degrees.
+    processes : int, optional
+        The number of worker processes, by default one per CPU.
+    checkpoint : string, optional
+        The name of a .npz file in which progress is saved every
+        `checkpoint_every` files. If it exists, the extraction carries
+        on from where it was stopped.
+    checkpoint_every : int, optional
+        The number of files between checkpoints.
+    verbose : bool, optional
+        Print progress.
+
+    Returns
+    -------
+    values : ndarray
+        A float32 array of shape (time, station) of the rain rates in
+        mm/hr, as `read`. Masked points, missing files and stations off
+        the disk are NaN.
+
+    """
+    grb_names = list(grb_names)
+    rows, cols = msggrid.pixel_index(lons, lats)
+    rows, cols = np.atleast_1d(rows), np.atleast_1d(cols)
+    on_disk = rows != -999
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        values, done = _load_checkpoint(checkpoint, grb_names, rows, cols)
+    else:
+        values = np.empty((len(grb_names), len(rows)), dtype=np.float32)
+        values.fill(np.nan)
+        done = np.zeros(len(grb_names), dtype=bool)
+
+    todo = np.flatnonzero(~done)
+    tasks = [(grb_names[i], rows[on_disk], cols[on_disk]) for i in todo]
+
+    pool = None
+    if processes == 1 or len(tasks) < 2:
+        results = (_extract_slot(task) for task in tasks)
+    else:
+        pool = Pool(processes)
+        results = pool.imap(_extract_slot, tasks, chunksize=4)
+
+    start = time.time()
+    try:
+        for n, i in enumerate(todo):
+            result = next(results)
+            if result is not None:
+                values[i, on_disk] = result
+            done[i] = True
+
+            if checkpoint is not None and (n + 1) % checkpoint_every == 0:
+                _save_checkpoint(checkpoint, grb_names, rows, cols, values,
+                                 done)
+            if verbose and ((n + 1) % 100 == 0 or n + 1 == len(todo)):
+                elapsed = time.time() - start
+                print('Extracted %d of %d remaining files (%.1f files/s)' %
+                      (n + 1, len(todo), (n + 1)/max(elapsed, 1e-6)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if checkpoint is not None:
+        _save_checkpoint(checkpoint, grb_names, rows, cols, values, done)
+
+    return values
+
 def write_arcgis_fltfile(grb_name):
-    """Write the cloud mask data to a binary file suitable for ArcGIS.
+    """Write the MPE data to a binary file suitable for ArcGIS.
 
-    This function uses wgrib2 to write and then read the cloud mask
-    data via an intermediate binary file, which is later
-    deleted. The data is properly oriented and written to a binary
+    The field is decoded directly from the GRIB2 file. The data is
+    properly oriented, converted into mm/hr and written to a binary
     file as 32-bit floats with the extension '.flt'. A suitable header
-    is also written with the extension '.hdr'. The file may then be
-    imported into ArcGIS.
-
-    Although the data are in floating point three integer numbers
-    define the mask as follows:
+    is also written with the extension '.hdr' (see arcfltgrid.write).
+    The file may then be imported into ArcGIS. Regions with no data
+    are set to -1.
 
-    Value | Class
-      0   | Cloud free ocean or water body
-      1   | Cloud free land surface
-      2   | Cloud
-      3   | Space/No data
+    Returns the name of the '.flt' file.
 
     """
-    
-    rows = 3712 # fixed for MPE grid
-    cols = 3712 # fixed for MPE grid
 
-    bin_name = grb_name[0:-4] + '.bin'
-    flt_name = grb_name[0:-4] + '.flt'
-    hdr_name = grb_name[0:-4] + '.hdr'
+    bingrid_name = grb_name[0:-4]
 
-    exec_str = 'wgrib2 -no_f77 ' + '-bin ' + bin_name + ' ' + grb_name # spaces are N.B.
+    a = read(grb_name)
+    arcfltgrid.write(bingrid_name, a, nodata_value=-1, **_arcgis_grid)
 
-    execute(exec_str)
-    a = read_bin_data(bin_name)
-    os.remove(bin_name)
+    return bingrid_name + '.flt'
 
-    a = a.reshape(rows, cols)
+def write_arcgis_directory(directory, pattern='*.grb', processes=None):
+    """Convert all the MPE files in a directory for ArcGIS.
 
-    # data in grib file are oriented EW:SN
-    # need to check that this is correct, the plots look fine...
-    a = np.fliplr(a)
-##    a = np.flipud(a)
+    Runs `write_arcgis_fltfile` on each file matching `pattern` in a
+    pool of worker processes, see arcfltgrid.convert_directory.
+    Returns the names of the '.flt' files.
 
-    # convert from mm/s to mm/hr (I think...)
-    a = 3600*a
-    a[a > 9E20] = -1
-
-    f = open(flt_name, 'wb')    
-    io.fwrite(f, a.size, a, 'f')
-    f.close()
-
-    f = open(hdr_name, 'w')
-    hdr_string = """ncols         3712
-nrows         3712
-xllcenter     -5565000
-yllcenter     -5565000
-cellsize      3000
-NODATA_value  3
-byteorder     LSBFIRST"""
-    f.write(hdr_string)
-    f.close()    
+    """
+    return arcfltgrid.convert_directory(write_arcgis_fltfile, directory,
+                                        pattern, processes)
 
 def plot(grb_name, fig_name, title='GRIB Plot'):
     """Create a plot of the data in a GRIB2 file."""
-    
+    import pylab as pl
+
     a = read(grb_name)
 
     pl.imshow(a, interpolation='nearest', origin='upper')
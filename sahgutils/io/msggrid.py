@@ -0,0 +1,133 @@
+"""Utilities for working with the MSG SEVIRI full disk grid.
+
+The MPE and cloud mask readers (mpegrib.read, clmgrib.read) return
+arrays on the 3712x3712 pixel, 3 km, MSG full disk grid, in the
+geostationary projection (see sahgutils.spatialtools.geos_forward).
+Row 0 is the northernmost row and column 0 the westernmost column:
+the WE:SN ordered GRIB field is flipped left to right, because
+EUMETSAT's files are stored from the south-eastern corner of the disk
+whatever their scanning mode says. The pixel centres follow GDAL's
+geotransform for the full disk images.
+
+This module finds the pixel of a longitude and latitude directly from
+the projection, in O(1) per point, and computes the longitude and
+latitude of every pixel, which are cached on disk and memory mapped.
+
+"""
+import os
+
+import numpy as np
+
+from sahgutils.spatialtools import geos_forward, geos_inverse
+
+ROWS = 3712
+COLS = 3712
+
+# Pixel size in projection coordinates (m), and the pixel at the
+# sub-satellite point
+RESOLUTION = 3000.403165817
+_centre_row = 1856
+_centre_col = 1856
+
+# Number of rows projected at a time when building the cached grids
+_block_rows = 128
+
+def pixel_coords(rows, cols):
+    """Projection coordinates (m) of the centres of pixels."""
+    x = (np.asarray(cols) - _centre_col)*RESOLUTION
+    y = (_centre_row - np.asarray(rows))*RESOLUTION
+
+    return x, y
+
+def pixel_index(lons, lats, sub_lon=0.0):
+    """Find the pixels containing longitudes and latitudes.
+
+    The pixel is computed directly from the projection, so each point
+    takes constant time however many points there are.
+
+    Parameters
+    ----------
+    lons, lats : array_like
+        Longitudes and latitudes in degrees.
+    sub_lon : float, optional
+        The longitude of the sub-satellite point in degrees.
+
+    Returns
+    -------
+    rows, cols : ndarray
+        The row and column indices. Points which are not visible from
+        the satellite have indices of -999, as arraytools.find_indices.
+
+    """
+    x, y = geos_forward(lons, lats, sub_lon)
+
+    with np.errstate(invalid='ignore'):
+        cols = np.floor(x/RESOLUTION + _centre_col + 0.5)
+        rows = np.floor(_centre_row - y/RESOLUTION + 0.5)
+        outside = ~((rows >= 0) & (rows < ROWS) & (cols >= 0) & (cols < COLS))
+
+    rows = np.where(outside, -999, rows).astype(int)
+    cols = np.where(outside, -999, cols).astype(int)
+
+    return rows, cols
+
+def flat_index(lons, lats, sub_lon=0.0):
+    """Indices of the pixels into a flattened (raveled) grid.
+
+    As `pixel_index`, points not visible from the satellite have an
+    index of -999.
+
+    """
+    rows, cols = pixel_index(lons, lats, sub_lon)
+
+    return np.where(rows == -999, -999, rows*COLS + cols)
+
+def _cache_dir():
+    return os.path.join(os.path.expanduser('~'), '.sahgutils')
+
+def latlon(cache_dir=None, sub_lon=0.0):
+    """The longitude and latitude of every pixel of the full disk.
+
+    The grids are computed once, a block of rows at a time, and saved
+    as .npy files in `cache_dir` (by default ~/.sahgutils). Later
+    calls memory map the saved files, so only the pixels used are
+    read from disk.
+
+    Returns
+    -------
+    lons, lats : memmap
+        Read-only float32 arrays of shape (3712, 3712) in degrees,
+        NaN for pixels off the Earth's disk.
+
+    """
+    if cache_dir is None:
+        cache_dir = _cache_dir()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    names = [os.path.join(cache_dir, 'msg_%s_%+.1f.npy' % (name, sub_lon))
+             for name in ('lons', 'lats')]
+
+    if not all(os.path.exists(name) for name in names):
+        tmp_names = [name + '.tmp' for name in names]
+        grids = [np.lib.format.open_memmap(name, mode='w+',
+                                           dtype=np.float32,
+                                           shape=(ROWS, COLS))
+                 for name in tmp_names]
+
+        cols = np.arange(COLS)
+        for start in range(0, ROWS, _block_rows):
+            rows = np.arange(start, min(start + _block_rows, ROWS))
+            x, y = pixel_coords(rows[:, None], cols[None, :])
+            with np.errstate(invalid='ignore'):
+                lons, lats = geos_inverse(x, y, sub_lon)
+            grids[0][rows[0]:rows[-1]+1] = lons
+            grids[1][rows[0]:rows[-1]+1] = lats
+
+        for grid, tmp_name, name in zip(grids, tmp_names, names):
+            grid.flush()
+            del grid
+            os.rename(tmp_name, name)
+        del grids
+
+    return tuple(np.load(name, mmap_mode='r') for name in names)
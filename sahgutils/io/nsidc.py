@@ -3,11 +3,17 @@
 This module contains functions for reading the data products provided by
 the National Snow and Ice Data Center (http://nsidc.org). The data products
 are distributed in HDF-EOS format and the Python GDAL bindings are used to
-access the data. Numpy is also required.
+access the data. Numpy is also required. The EASE-Grid utilities and
+the time cube builder's bookkeeping only need Numpy.
 
 Author: Scott Sinclair <scott.sinclair.za -at- gmail.com>
 
 """
+import os
+import re
+import time
+from multiprocessing import Pool
+
 import numpy as np
 from numpy import ma
 
@@ -15,10 +21,189 @@ try:
     from osgeo import gdal
     from osgeo.gdalconst import *
 except ImportError:
-    import gdal
-    from gdalconst import *
+    try:
+        import gdal
+        from gdalconst import *
+    except ImportError:
+        gdal = None # the HDF-EOS files can't be read
+
+# The global EASE-Grid (25 km) used by the AMSR-E level 3 land product
+EASE_COLS = 1383
+EASE_ROWS = 586
+_ease_r0 = 691.0
+_ease_s0 = 292.5
+_ease_scale = 6371.228/25.067525 # Earth radius/cell size
+
+def ease_grid_index(lon, lat):
+    """The column and row of the global EASE-Grid cell containing a point.
+
+    Longitudes and latitudes are in degrees, and may be arrays.
+
+    """
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    cos_30 = np.cos(np.radians(30.0))
+
+    col = np.floor(_ease_r0 + _ease_scale*lon*cos_30 + 0.5).astype(int)
+    row = np.floor(_ease_s0 - _ease_scale*np.sin(lat)/cos_30 + 0.5).astype(int)
+
+    return col, row
+
+def ease_grid_window(lon_min, lat_min, lon_max, lat_max):
+    """The pixel window of the global EASE-Grid covering a lon/lat box.
+
+    The box is clipped to the grid.
+
+    Returns
+    -------
+    window : tuple
+        (xoff, yoff, xsize, ysize) as taken by AELand3File.read and
+        GDAL's ReadAsArray.
+
+    """
+    col0, row0 = ease_grid_index(lon_min, lat_max)
+    col1, row1 = ease_grid_index(lon_max, lat_min)
+
+    col0, row0 = max(col0, 0), max(row0, 0)
+    col1, row1 = min(col1, EASE_COLS - 1), min(row1, EASE_ROWS - 1)
+
+    if col1 < col0 or row1 < row0:
+        raise ValueError('The box (%s, %s, %s, %s) is not on the EASE-Grid'
+                         % (lon_min, lat_min, lon_max, lat_max))
+
+    return int(col0), int(row0), int(col1 - col0 + 1), int(row1 - row0 + 1)
+
+class AELand3File():
+    """Class for read operations on AMSR-E level 3 land HDF-EOS files.
+
+    The subdatasets of the file are listed once, when the file is
+    opened, and each subdataset is opened with GDAL on first use and
+    kept open, so that both overpasses and several fields can be read
+    from one AELand3File.
+
+    Example usage:
+
+    >>> ae_file = AELand3File(hdf_fname)
+
+    >>> print(ae_file.fields())
+
+    >>> window = ease_grid_window(10, -35, 41, -15)
+    >>> sm_asc = ae_file.read('asc', 'Soil_Moisture', window)
+    >>> sm_desc = ae_file.read('desc', 'Soil_Moisture', window)
+
+    """
+    def __init__(self, hdf_fname):
+        if gdal is None:
+            raise ImportError('The GDAL Python bindings are needed to '
+                              'read HDF-EOS files')
+
+        self.filename = hdf_fname
+
+        hdf = gdal.Open(hdf_fname)
+        if hdf is None:
+            raise IOError('Unable to open %s' % hdf_fname)
+
+        self._read_subdatasets(hdf)
+        del hdf
+
+        # The GDAL datasets of the subdatasets, opened on first use
+        self._datasets = {}
+
+    # Internal methods
+
+    def _read_subdatasets(self, hdf):
+        # Subdataset names look like
+        # HDF4_EOS:EOS_GRID:"file.hdf":Ascending_Land_Grid:A_Soil_Moisture
+        self._subdatasets = {}
+
+        sdsdict = hdf.GetMetadata('SUBDATASETS')
+        for key in sorted(sdsdict.keys()):
+            if key.endswith('_NAME'):
+                name = sdsdict[key]
+                self._subdatasets[name.split(':')[-1]] = name
+
+    def _field_tag(self, dir, field):
+        if dir == 'asc':
+            field_tag = 'A_' + field
+        elif dir == 'desc':
+            field_tag = 'D_' + field
+        else:
+            raise ValueError('Invalid parameter passed for dir: %s' % (dir))
+
+        if field_tag not in self._subdatasets:
+            # Fall back to the partial matching of read_ae_land3
+            matches = [tag for tag in sorted(self._subdatasets)
+                       if field_tag in tag]
+            if not matches:
+                raise KeyError('No subdataset %s in %s' %
+                               (field_tag, self.filename))
+            field_tag = matches[0]
+
+        return field_tag
+
+    def _dataset(self, field_tag):
+        if field_tag not in self._datasets:
+            sds = gdal.Open(self._subdatasets[field_tag])
+            if sds is None:
+                raise IOError('Unable to open subdataset %s of %s' %
+                              (field_tag, self.filename))
+            self._datasets[field_tag] = sds
+
+        return self._datasets[field_tag]
+
+    # API methods
+
+    def fields(self):
+        """The names of the subdatasets, e.g. A_Soil_Moisture."""
+        return sorted(self._subdatasets.keys())
+
+    def read(self, dir='asc', field='Soil_Moisture', window=None,
+             scale=1000.0, fill_value=9999):
+        """Read a field, or a window of it.
+
+        Parameters
+        ----------
+        dir : string, optional
+            The direction of the overpass, 'asc' for ascending and
+            'desc' for descending.
+        field : string, optional
+            The name of the field without the direction prefix.
+        window : tuple, optional
+            (xoff, yoff, xsize, ysize) in pixels (see
+            ease_grid_window), by default the whole grid.
+        scale : float, optional
+            The stored values are divided by `scale`, the default
+            gives soil moisture in g/cm^3.
+        fill_value : int, optional
+            Stored values of +/-`fill_value` are masked.
+
+        Returns
+        -------
+        data : MaskedArray
+            A float32 array of the window.
+
+        """
+        sds = self._dataset(self._field_tag(dir, field))
 
-def read_ae_land3(hdf_fname, dir='asc', field='Soil_Moisture'):
+        if window is None:
+            raw = sds.ReadAsArray()
+        else:
+            xoff, yoff, xsize, ysize = window
+            raw = sds.ReadAsArray(xoff, yoff, xsize, ysize)
+            if raw is None:
+                raise ValueError('Window %s is outside the grid' %
+                                 (window,))
+
+        invalid = (np.abs(raw) == fill_value)
+        data = np.true_divide(raw, np.float32(scale), dtype=np.float32)
+
+        return ma.masked_array(data, mask=invalid)
+
+    def close(self):
+        """Close the GDAL datasets opened so far."""
+        self._datasets = {}
+
+def read_ae_land3(hdf_fname, dir='asc', field='Soil_Moisture', window=None):
     """Read AMSR-E level 3 land products.
 
     Input parameters:
@@ -27,32 +212,242 @@ def read_ae_land3(hdf_fname, dir='asc', field='Soil_Moisture'):
           required. 'asc' for ascending and 'desc' for descending.
         - field is a string defining the name of a sub-dataset in the
           HDF-EOS file (default 'Soil_Moisture')
+        - window is an optional (xoff, yoff, xsize, ysize) tuple in
+          pixels, to read only part of the grid (see ease_grid_window)
 
     Output:
         - A masked Numpy array containing the data field. Data in the array
           are divided by a factor of 1000 as this yields soil moisture values
           in g/cm^3.
 
+    To read several fields or both overpasses from a file, use an
+    AELand3File directly so that the file is only opened once.
+
     """
-    hdf = gdal.Open(hdf_fname)
+    return AELand3File(hdf_fname).read(dir, field, window)
+
+# The date in the name of a daily file, e.g. AMSR_E_L3_DailyLand_V06_20080101.hdf
+_date_pattern = re.compile(r'(\d{8})')
+
+def file_date(hdf_fname):
+    """The date of a daily AMSR-E file, from its name, as a datetime64."""
+    matches = _date_pattern.findall(os.path.basename(hdf_fname))
+    if not matches:
+        raise ValueError('No date in the file name %s' % hdf_fname)
+
+    date = matches[-1]
+    return np.datetime64('%s-%s-%s' % (date[:4], date[4:6], date[6:]), 'D')
+
+def _read_overpasses(args):
+    """Worker for build_cube, both overpasses of a window of a file."""
+    hdf_fname, field, window = args
+
+    try:
+        ae_file = AELand3File(hdf_fname)
+        return [ae_file.read(dir, field, window).filled(np.nan)
+                for dir in ('asc', 'desc')]
+    except (IOError, KeyError, ValueError):
+        return None # missing or damaged file
+
+def _cube_names(cube_dir):
+    return dict((name, os.path.join(cube_dir, name + ext))
+                for name, ext in [('asc', '.npy'), ('desc', '.npy'),
+                                  ('index', '.npz')])
+
+def _load_cube_index(index_name, field, window):
+    with np.load(index_name) as saved:
+        if str(saved['field']) != field or \
+           not np.array_equal(saved['window'], window):
+            raise ValueError('The cube %s is for a different field or '
+                             'window' % index_name)
+
+        return saved['dates'], saved['ingested']
+
+def _replace(tmp_name, name):
+    """Rename `tmp_name` to `name`, replacing `name` if it exists."""
+    try:
+        os.rename(tmp_name, name)
+    except OSError:
+        # Windows won't rename over an existing file
+        os.remove(name)
+        os.rename(tmp_name, name)
+
+def _save_cube_index(index_name, field, window, dates, ingested):
+    tmp_name = index_name + '.tmp'
+    with open(tmp_name, 'wb') as fp:
+        np.savez(fp, field=np.array(field), window=np.array(window),
+                 dates=dates, ingested=ingested)
+    _replace(tmp_name, index_name)
+
+def _grow_cube(cube_name, old_dates, dates, shape):
+    """Copy a cube to a temporary file with a longer time axis.
+
+    The old days are kept, the new days are NaN. The name of the
+    temporary file, to be renamed to `cube_name` by the caller, is
+    returned.
+
+    """
+    tmp_name = cube_name + '.tmp'
+    cube = np.lib.format.open_memmap(tmp_name, mode='w+', dtype=np.float32,
+                                     shape=(len(dates),) + shape)
+    for t in range(len(dates)):
+        cube[t] = np.nan
+
+    if len(old_dates) > 0:
+        offset = int((old_dates[0] - dates[0]).astype(int))
+        old = np.load(cube_name, mmap_mode='r')
+        for t in range(len(old_dates)):
+            cube[offset + t] = old[t]
+        del old
+
+    cube.flush()
+    del cube
 
-    sdsdict = hdf.GetMetadata('SUBDATASETS')
+    return tmp_name
 
-    sdslist =[sdsdict[k] for k in sdsdict.keys() if '_NAME' in k]
+def _recover_cubes(names, ntimes):
+    """Finish or discard a growth of the cubes which was interrupted.
 
-    if dir == 'asc':
-        field_tag = 'A_' + field
-    elif dir == 'desc':
-        field_tag = 'D_' + field
+    The grown cubes are written to temporary files before the index
+    is saved, and renamed into place afterwards. Temporary cubes which
+    match the index were saved before the interruption, others are
+    left over from before the index was saved.
+
+    """
+    for dir in ('asc', 'desc'):
+        tmp_name = names[dir] + '.tmp'
+        if os.path.exists(tmp_name):
+            try:
+                complete = np.load(tmp_name, mmap_mode='r').shape[0] == ntimes
+            except (IOError, ValueError):
+                complete = False
+
+            if complete:
+                _replace(tmp_name, names[dir])
+            else:
+                os.remove(tmp_name)
+
+def build_cube(hdf_fnames, cube_dir, window, field='Soil_Moisture',
+               processes=None, checkpoint_every=100, verbose=True):
+    """Build (time, row, col) cubes of a field from daily AMSR-E files.
+
+    A window of both overpasses of each file is read (see
+    AELand3File.read) by a pool of worker processes, and written into
+    memory mapped float32 cubes in `cube_dir`: asc.npy and desc.npy,
+    with a daily time axis. The days and the files already ingested
+    are recorded in index.npz, so that a later call with more files
+    only reads the new files, extending the time axis if needed. An
+    interrupted build is resumed by calling build_cube again.
+
+    Parameters
+    ----------
+    hdf_fnames : sequence of strings
+        The daily AMSR-E level 3 land files. The date is taken from
+        the file name (see file_date).
+    cube_dir : string
+        The directory of the cubes, created if needed.
+    window : tuple
+        (xoff, yoff, xsize, ysize) in pixels, see ease_grid_window.
+    field : string, optional
+        The name of the field without the direction prefix.
+    processes : int, optional
+        The number of worker processes, by default one per CPU.
+    checkpoint_every : int, optional
+        The number of files between saves of the index.
+    verbose : bool, optional
+        Print progress.
+
+    Returns
+    -------
+    dates : ndarray
+        The days of the time axis, as datetime64[D].
+    asc, desc : memmap
+        The ascending and descending cubes of shape (time, ysize,
+        xsize). Masked values and days without a file are NaN.
+
+    """
+    window = tuple(int(w) for w in window)
+    shape = (window[3], window[2])
+    names = _cube_names(cube_dir)
+    if not os.path.isdir(cube_dir):
+        os.makedirs(cube_dir)
+
+    if os.path.exists(names['index']):
+        dates, ingested = _load_cube_index(names['index'], field, window)
     else:
-        raise ValueError, 'Invalid parameter passed for dir: %s' % (dir)
+        dates = np.array([], dtype='datetime64[D]')
+        ingested = np.zeros(0, dtype=bool)
+    _recover_cubes(names, len(dates))
+
+    hdf_fnames = list(hdf_fnames)
+    file_dates = [file_date(hdf_fname) for hdf_fname in hdf_fnames]
+
+    if len(dates) == 0 and len(file_dates) == 0:
+        # Nothing ingested yet and nothing to ingest
+        empty = np.empty((0,) + shape, dtype=np.float32)
+        return dates, empty, empty.copy()
+
+    # Extend the time axis to cover the new files. The grown cubes are
+    # only renamed into place once the index for them is saved.
+    first = min(file_dates + list(dates[:1]))
+    last = max(file_dates + list(dates[-1:]))
+    if len(dates) == 0 or first < dates[0] or last > dates[-1]:
+        new_dates = np.arange(first, last + np.timedelta64(1, 'D'))
+        tmp_names = [_grow_cube(names[dir], dates, new_dates, shape)
+                     for dir in ('asc', 'desc')]
+
+        new_ingested = np.zeros(len(new_dates), dtype=bool)
+        if len(dates) > 0:
+            offset = int((dates[0] - first).astype(int))
+            new_ingested[offset:offset + len(dates)] = ingested
+        dates, ingested = new_dates, new_ingested
+        _save_cube_index(names['index'], field, window, dates, ingested)
+
+        for tmp_name, dir in zip(tmp_names, ('asc', 'desc')):
+            _replace(tmp_name, names[dir])
+
+    asc = np.load(names['asc'], mmap_mode='r+')
+    desc = np.load(names['desc'], mmap_mode='r+')
+    if asc.shape != (len(dates),) + shape or asc.shape != desc.shape:
+        raise ValueError('The cubes in %s do not match their index' %
+                         cube_dir)
+
+    days = [int((date - dates[0]).astype(int)) for date in file_dates]
+    todo = [(day, hdf_fname) for day, hdf_fname in zip(days, hdf_fnames)
+            if not ingested[day]]
+    tasks = [(hdf_fname, field, window) for day, hdf_fname in todo]
+
+    pool = None
+    if processes == 1 or len(tasks) < 2:
+        results = (_read_overpasses(task) for task in tasks)
+    else:
+        pool = Pool(processes)
+        results = pool.imap(_read_overpasses, tasks, chunksize=4)
+
+    start = time.time()
+    try:
+        for n, (day, hdf_fname) in enumerate(todo):
+            result = next(results)
+            if result is not None:
+                asc[day], desc[day] = result
+                ingested[day] = True
 
-    name = [k for k in sdslist if field_tag in k][0]
-    sds = gdal.Open(name)
+            if (n + 1) % checkpoint_every == 0:
+                asc.flush()
+                desc.flush()
+                _save_cube_index(names['index'], field, window, dates,
+                                 ingested)
+            if verbose and ((n + 1) % 100 == 0 or n + 1 == len(todo)):
+                elapsed = time.time() - start
+                print('Ingested %d of %d files (%.1f files/s)' %
+                      (n + 1, len(todo), (n + 1)/max(elapsed, 1e-6)))
+    finally:
+        if pool is not None:
+            pool.terminate()
 
-    data = np.asarray(sds.ReadAsArray(), np.float32)
-    data = ma.masked_values(data, -9999)
-    data = ma.masked_values(data, 9999)
-    data /= 1000.0 # Only necessary for Soil Moisture
+        # Keep the progress made, even if interrupted
+        asc.flush()
+        desc.flush()
+        _save_cube_index(names['index'], field, window, dates, ingested)
 
-    return data
+    return dates, asc, desc
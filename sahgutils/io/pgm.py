@@ -1,159 +1,436 @@
-"""Utilities for reading and plotting EUMETSAT Cloud Mask data.
-
-This module contains some simple functions to make it easier
-to read and plot the Multisensor Precipitation Estimate (MPE)
-data produced by EUMETSAT. The data are provied in GRIB2 files
-and the module currently relies on Wesley Ebisuzaki's
-wgrib2 programme being somewhere on your systems path. If you
-don't have wgrib2 it can be obtained from:
-
-http://www.cpc.ncep.noaa.gov/products/wesley/wgrib2/
-
-"""
-
-import os
-import sys
-
-import numpy as np
-from numpy import ma
-
-import pylab as pl
-
-def execute(command):
-    """Execute a system command passed as a string."""
-    
-    print 'Running:', command
-    os.system(command)
-    print '--------------------\n'
-    
-def read_sensor_count(pgm_name):
-    """Read the MPE data from a grib file into an array.
-
-    This function uses wgrib2 to write and then read the MPE
-    data via an intermediate binary file, which is later
-    deleted. The non-raining regions are masked and the data
-    converted into mm/hr.
-
-    """
-
-    bin_name = pgm_name[0:-4] + '.bin'
-    hdr_name = pgm_name[0:-4] + '.hdr'
-
-    exec_str = 'gdal_translate -ot UInt16 -of EHdr ' + pgm_name + ' ' + bin_name # spaces are N.B.
-
-    execute(exec_str)
-    data = np.fromfile(bin_name, dtype=np.uint16)
-    os.remove(bin_name)
-    os.remove(hdr_name)
-
-    # read the pgm header and parse for relevant parameters
-    f = open(pgm_name)
-    pgm_hdr = f.read(120)
-    f.close()
-
-    hdr_elems = pgm_hdr.split()    
-    
-    cols = int(hdr_elems[1]) # fixed if the pgm format spec is followed
-    rows = int(hdr_elems[2]) # fixed if the pgm format spec is followed
-
-    data = np.reshape(data, (rows, cols))
-    data = ma.masked_values(data, 0)
-
-    return data    
-
-def read_radiance(pgm_name):
-    """Read the MPE data from a grib file into an array.
-
-    This function uses wgrib2 to write and then read the MPE
-    data via an intermediate binary file, which is later
-    deleted. The non-raining regions are masked and the data
-    converted into mm/hr.
-
-    """
-
-    bin_name = pgm_name[0:-4] + '.bin'
-    hdr_name = pgm_name[0:-4] + '.hdr'
-
-    exec_str = 'gdal_translate -ot UInt16 -of EHdr ' + pgm_name + ' ' + bin_name # spaces are N.B.
-
-    execute(exec_str)
-    data = np.fromfile(bin_name, dtype=np.uint16)
-    os.remove(bin_name)
-    os.remove(hdr_name)
-
-    # read the pgm header and parse for relevant parameters
-    f = open(pgm_name)
-    pgm_hdr = f.read(120)
-    f.close()
-
-    hdr_elems = pgm_hdr.split()    
-    
-    cols = int(hdr_elems[1]) # fixed if the pgm format spec is followed
-    rows = int(hdr_elems[2]) # fixed if the pgm format spec is followed
-
-    ind = pgm_hdr.find('offset=')
-    offset_str = pgm_hdr[ind:].split('\n')[0]
-    offset_str = offset_str.split()[0]
-    offset = float(offset_str.split('=')[1])
-
-    ind = pgm_hdr.find('slope=')
-    slope_str = pgm_hdr[ind:].split('\n')[0]
-    slope = float(slope_str.split('=')[1])
-
-    data = np.reshape(data, (rows, cols))
-    data = ma.masked_values(data, 0)
-
-    # compute the radiance from the raw sensor counts
-    data = offset + slope*data
-    
-    return data    
-
-def read_btemp(pgm_name):
-    """Read the MPE data from a grib file into an array.
-
-    This function uses wgrib2 to write and then read the MPE
-    data via an intermediate binary file, which is later
-    deleted. The non-raining regions are masked and the data
-    converted into mm/hr.
-
-    """
-
-    data = read_radiance(pgm_name)
-
-    # compute brightness temp from radiance
-    C1 = 1.19104E-5
-    C2 = 1.43877
-
-    if (pgm_name.find('ch09')):
-##    if (pgm_name[17:21] == 'ch09'):
-##        print '%s is channel 09 data' % pgm_name
-        A = 0.9983
-        B = 0.627
-        nu = 930.659
-    elif (pgm_name.find('ch10')):
-##        print '%s is channel 10 data' % pgm_name
-        A = 0.9988
-        B = 0.397
-        nu = 839.661
-    else:
-        print 'Unknown file naming convention'
-
-    data = np.log(((C1*nu**3)/data) + 1) - B        
-    data = ((C2*nu)/data)/A        
-    
-    return data    
-
-def plot(pgm_name, fig_name, title='PGM Plot'):
-    """Create a plot of the data in a GRIB2 file."""
-    
-    a = read_sensor_count(pgm_name)
-
-    pl.clf()
-    pl.axes(axisbg='black')
-    pl.imshow(a, interpolation='nearest', origin='upper')
-    pl.colorbar()
-    pl.title(title)
-    pl.clim(0, 1023)
-    pl.savefig(fig_name)
-    pl.close()
-
+"""Utilities for reading and plotting MSG SEVIRI PGM files.
+
+This module contains some simple functions to make it easier
+to read and plot the Meteosat Second Generation (MSG) SEVIRI
+channel data distributed as 10-bit binary PGM image files. The
+files are read directly using Numpy and the calibration offset
+and slope are taken from the comments in the PGM header.
+
+"""
+
+import os
+import re
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from numpy import ma
+
+# Radiance to brightness temperature conversion constants and
+# per channel coefficients (nu, A, B) for the SEVIRI IR channels on
+# MSG-1, from EUMETSAT's "The Conversion from Effective Radiances to
+# Equivalent Brightness Temperatures" (EUM/MET/TEN/11/0569)
+_C1 = 1.19104E-5
+_C2 = 1.43877
+
+_channel_coeffs = {4: (2567.330, 0.9956, 3.410),
+                   5: (1598.103, 0.9962, 2.218),
+                   6: (1362.081, 0.9991, 0.478),
+                   7: (1149.069, 0.9996, 0.179),
+                   8: (1034.343, 0.9999, 0.060),
+                   9: (930.659, 0.9983, 0.627),
+                   10: (839.661, 0.9988, 0.397),
+                   11: (748.383, 0.9981, 0.561)}
+
+# Calibration lookup tables, see radiance_lut and btemp_lut
+_luts = {}
+
+def _read_header(fp):
+    """Parse the header of a binary (P5) PGM file.
+
+    Returns a dictionary with the image dimensions, maximum grey value,
+    the header comments and the calibration `offset` and `slope` found
+    in them (None if absent), plus the byte offset of the pixel data.
+
+    """
+    buf = ''
+    tokens = []
+    comments = []
+    pos = 0
+    # magic number, width, height and maxval, separated by whitespace
+    # and possibly interleaved with comments
+    while len(tokens) < 4:
+        if pos >= len(buf):
+            chunk = fp.read(1024)
+            if not chunk:
+                raise ValueError('Truncated PGM header')
+            buf += chunk
+
+        char = buf[pos]
+        if char == '#':
+            end = buf.find('\n', pos)
+            if end < 0:
+                chunk = fp.read(1024)
+                if not chunk:
+                    raise ValueError('Truncated PGM header')
+                buf += chunk
+                continue
+            comments.append(buf[pos+1:end].strip())
+            pos = end + 1
+        elif char.isspace():
+            pos += 1
+        else:
+            end = pos
+            while end < len(buf) and not buf[end].isspace():
+                end += 1
+            if end == len(buf):
+                chunk = fp.read(1024)
+                if chunk:
+                    buf += chunk
+                    continue
+            tokens.append(buf[pos:end])
+            pos = end
+
+    if tokens[0] != 'P5':
+        raise ValueError('Not a binary PGM file (magic number %s)' %
+                         tokens[0])
+
+    # a single whitespace character separates maxval from the data
+    header = {'cols': int(tokens[1]),
+              'rows': int(tokens[2]),
+              'maxval': int(tokens[3]),
+              'comments': comments,
+              'dataoffset': pos + 1}
+
+    comment_text = ' '.join(comments)
+    for key in ['offset', 'slope']:
+        match = re.search(key + r'\s*=\s*([-+0-9.eE]+)', comment_text)
+        if match:
+            header[key] = float(match.group(1))
+        else:
+            header[key] = None
+
+    return header
+
+def read_pgm(pgm_name):
+    """Read the header and data from a binary (P5) PGM file.
+
+    The pixel data are memory mapped, rather than read into memory.
+    Images with a maximum grey value above 255 are stored as 16-bit
+    big-endian values.
+
+    Returns
+    -------
+    header : dict
+        The image dimensions ('rows', 'cols'), maximum grey value
+        ('maxval'), header comments ('comments'), calibration 'offset'
+        and 'slope' (None if not in the comments) and the byte offset
+        of the pixel data ('dataoffset').
+    data : memmap
+        A read-only (rows, cols) array of sensor counts.
+
+    """
+    with open(pgm_name, 'rb') as fp:
+        header = _read_header(fp)
+
+    if header['maxval'] > 255:
+        dtype = np.dtype('>u2')
+    else:
+        dtype = np.dtype(np.uint8)
+
+    data = np.memmap(pgm_name, dtype=dtype, mode='r',
+                     offset=header['dataoffset'],
+                     shape=(header['rows'], header['cols']))
+
+    return header, data
+
+def read_sensor_count(pgm_name):
+    """Read the raw sensor counts from a PGM file into an array.
+
+    The PGM file is read directly, see `read_pgm`. Pixels with a
+    count of zero (space) are masked. The counts are returned as
+    native uint16 values.
+
+    """
+    header, data = read_pgm(pgm_name)
+
+    data = data.astype(np.uint16)
+    data = ma.masked_equal(data, 0, copy=False)
+
+    return data    
+
+def channel_number(pgm_name):
+    """Return the SEVIRI channel number from a PGM file name.
+
+    The channel is identified by a 'chNN' tag in the file name, e.g.
+    'ch09'. None is returned if there is no tag.
+
+    """
+    match = re.search(r'ch(\d\d)', os.path.basename(pgm_name))
+    if match:
+        return int(match.group(1))
+
+    return None
+
+def radiance_lut(offset, slope, maxval=1023):
+    """Return a lookup table from sensor counts to radiance.
+
+    Entry `n` of the float32 table holds the radiance for a count of
+    `n`. The zero count (space) maps to NaN. Tables are computed once
+    for each (offset, slope, maxval) and shared between calls.
+
+    """
+    key = ('radiance', offset, slope, maxval)
+    if key not in _luts:
+        lut = offset + slope*np.arange(maxval + 1, dtype=np.float64)
+        lut[0] = np.nan
+
+        lut = lut.astype(np.float32)
+        lut.flags.writeable = False
+        _luts[key] = lut
+
+    return _luts[key]
+
+def btemp_lut(channel, offset, slope, maxval=1023):
+    """Return a lookup table from sensor counts to brightness temperature.
+
+    Entry `n` of the float32 table holds the brightness temperature
+    (K) for a count of `n`, for SEVIRI IR `channel` (4 to 11). Counts
+    giving non-positive radiance, and the zero count, map to NaN.
+    Tables are computed once for each (channel, offset, slope, maxval)
+    and shared between calls.
+
+    """
+    if channel not in _channel_coeffs:
+        raise ValueError('No brightness temperature coefficients for '
+                         'channel %s' % channel)
+
+    key = ('btemp', channel, offset, slope, maxval)
+    if key not in _luts:
+        nu, A, B = _channel_coeffs[channel]
+
+        radiance = radiance_lut(offset, slope, maxval).astype(np.float64)
+
+        lut = np.empty_like(radiance)
+        lut.fill(np.nan)
+        valid = np.nan_to_num(radiance) > 0
+        lut[valid] = (_C2*nu/np.log(_C1*nu**3/radiance[valid] + 1) - B)/A
+
+        lut = lut.astype(np.float32)
+        lut.flags.writeable = False
+        _luts[key] = lut
+
+    return _luts[key]
+
+def read_calibrated(pgm_name, quantity='btemp'):
+    """Read the sensor counts and their calibration lookup table.
+
+    The counts are left as integers, so that calibration can be
+    delayed until it is needed and then applied with a single gather,
+    e.g. ``lut[counts]`` or ``np.take(lut, counts, out=buf)``.
+
+    Parameters
+    ----------
+    pgm_name : string
+        The name of the PGM file.
+    quantity : {'btemp', 'radiance'}
+        The quantity to calibrate to. The channel number is taken
+        from the file name for 'btemp', see `channel_number`.
+
+    Returns
+    -------
+    counts : memmap
+        The (rows, cols) array of sensor counts, see `read_pgm`.
+    lut : ndarray
+        A float32 lookup table indexed by sensor count.
+
+    """
+    header, counts = read_pgm(pgm_name)
+
+    offset = header['offset']
+    slope = header['slope']
+    if offset is None or slope is None:
+        raise ValueError('%s has no calibration offset and slope' %
+                         pgm_name)
+
+    if quantity == 'radiance':
+        lut = radiance_lut(offset, slope, header['maxval'])
+    elif quantity == 'btemp':
+        channel = channel_number(pgm_name)
+        if channel is None:
+            raise ValueError('Unknown file naming convention: %s' %
+                             pgm_name)
+
+        lut = btemp_lut(channel, offset, slope, header['maxval'])
+    else:
+        raise ValueError('Invalid parameter passed for quantity: %s' %
+                         quantity)
+
+    return counts, lut
+
+def read_radiance(pgm_name):
+    """Read the radiance from a PGM file into an array.
+
+    The sensor counts are read directly from the PGM file (see
+    `read_pgm`) and converted to radiance using the offset and slope
+    given in the header comments, via a lookup table. Pixels with a
+    count of zero (space) are masked.
+
+    """
+    counts, lut = read_calibrated(pgm_name, 'radiance')
+
+    data = ma.array(lut.take(counts), mask=(counts == 0))
+
+    return data    
+
+def read_btemp(pgm_name):
+    """Read the brightness temperature from a PGM file into an array.
+
+    The sensor counts are converted to brightness temperature (K) via
+    a lookup table, using the calibration in the PGM header comments
+    and the coefficients of the channel named in the file name (e.g.
+    'ch09'). Pixels with a count of zero (space) or without a valid
+    temperature are masked.
+
+    """
+    counts, lut = read_calibrated(pgm_name, 'btemp')
+
+    data = ma.masked_invalid(lut.take(counts), copy=False)
+
+    return data    
+
+def read_slots(pattern, start, end, channels=(4, 9, 10),
+               step=timedelta(minutes=15), quantity='counts',
+               out=None, memmap_fname=None, threads=4, verbose=True):
+    """Read several channels for a range of MSG slots into one array.
+
+    The PGM files for every slot from `start` to `end` (inclusive) and
+    each channel are decoded concurrently into a single (slot, channel,
+    row, col) array. Calibration lookup tables are shared across slots
+    (see `btemp_lut`).
+
+    Parameters
+    ----------
+    pattern : string
+        The file name pattern. strftime codes are replaced by the slot
+        time and '{channel:02d}' by the channel number, e.g.
+        '/data/msg/%Y%m%d/%Y%m%d%H%M_ch{channel:02d}.pgm'.
+    start, end : datetime
+        The first and last slot times.
+    channels : sequence of ints, optional
+        The SEVIRI channels to read. Default is (4, 9, 10).
+    step : timedelta, optional
+        The time between slots. Default is 15 minutes.
+    quantity : {'counts', 'radiance', 'btemp'}, optional
+        Return the raw sensor counts as uint16 (the default), or the
+        radiance or brightness temperature as float32.
+    out : ndarray, optional
+        An array with shape (slots, channels, rows, cols) and dtype
+        uint16 for counts and float32 otherwise, to hold the result.
+    memmap_fname : string, optional
+        If given (and `out` is None) the result is written to a memory
+        mapped array backed by this file.
+    threads : int, optional
+        The number of threads used to decode the files. Default is 4.
+    verbose : bool, optional
+        Print the decoding throughput in slots per second.
+
+    Returns
+    -------
+    slots : list of datetime
+        The slot times.
+    data : ndarray
+        The (slot, channel, row, col) array. Missing files are filled
+        with zero counts or NaN.
+    available : ndarray
+        A boolean (slot, channel) array, False where a file is missing.
+
+    """
+    if quantity not in ['counts', 'radiance', 'btemp']:
+        raise ValueError('Invalid parameter passed for quantity: %s' %
+                         quantity)
+
+    slots = []
+    slot = start
+    while slot <= end:
+        slots.append(slot)
+        slot += step
+
+    fnames = [[slot.strftime(pattern).format(channel=channel)
+               for channel in channels] for slot in slots]
+    available = np.array([[os.path.exists(fname) for fname in row]
+                          for row in fnames], dtype=bool)
+
+    if not available.any():
+        raise IOError('No files found matching %s' % pattern)
+
+    i, j = np.argwhere(available)[0]
+    header, counts = read_pgm(fnames[i][j])
+    shape = (len(slots), len(channels), header['rows'], header['cols'])
+
+    if quantity == 'counts':
+        dtype = np.dtype(np.uint16)
+        fill = 0
+    else:
+        dtype = np.dtype(np.float32)
+        fill = np.nan
+
+    if out is None:
+        if memmap_fname is None:
+            out = np.empty(shape, dtype=dtype)
+        else:
+            out = np.memmap(memmap_fname, dtype=dtype, mode='w+',
+                            shape=shape)
+    elif out.shape != shape or out.dtype != dtype:
+        raise ValueError('out must be a %s array with shape %s' %
+                         (dtype, shape))
+
+    def read_file(task):
+        i, j = task
+        if not available[i, j]:
+            out[i, j] = fill
+            return
+
+        if quantity == 'counts':
+            header, counts = read_pgm(fnames[i][j])
+            lut = None
+        else:
+            counts, lut = read_calibrated(fnames[i][j], quantity)
+
+        if counts.shape != shape[2:]:
+            raise ValueError('%s has dimensions %s, expected %s' %
+                             (fnames[i][j], counts.shape, shape[2:]))
+
+        if lut is None:
+            out[i, j] = counts
+        else:
+            # Calibrate in blocks of rows to limit the temporary index
+            # arrays used by take
+            for row in range(0, shape[2], 256):
+                np.take(lut, counts[row:row+256],
+                        out=out[i, j, row:row+256], mode='clip')
+
+    tasks = [(i, j) for i in range(len(slots)) for j in range(len(channels))]
+
+    start_time = time.time()
+    pool = ThreadPool(threads)
+    try:
+        pool.map(read_file, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start_time
+
+    if verbose:
+        print('Decoded %d slots x %d channels in %.2f s (%.2f slots/s)' %
+              (len(slots), len(channels), elapsed,
+               len(slots)/max(elapsed, 1e-6)))
+
+    return slots, out, available
+
+def plot(pgm_name, fig_name, title='PGM Plot'):
+    """Create a plot of the data in a PGM file."""
+    import pylab as pl
+    
+    a = read_sensor_count(pgm_name)
+
+    pl.clf()
+    pl.axes(axisbg='black')
+    pl.imshow(a, interpolation='nearest', origin='upper')
+    pl.colorbar()
+    pl.title(title)
+    pl.clim(0, 1023)
+    pl.savefig(fig_name)
+    pl.close()
+
@@ -2,72 +2,162 @@
 
 This module contains some simple functions to make it easier
 to read and plot the data from GRIB(version 1) files produced
-by SAWS Unified Model. The module relies on Wesley Ebisuzaki's
-wgrib programme being somewhere on your systems path. If you
-don't have wgrib it can be obtained from:
+by SAWS Unified Model. The fields are decoded in Python by the
+grib module, so Wesley Ebisuzaki's wgrib programme is no longer
+needed. The output matches that of wgrib, which can be obtained from:
 
 http://www.cpc.ncep.noaa.gov/products/wesley/wgrib.html
 
 """
 
-import os
-import sys
-
 import numpy as np
 
-def execute(command):
-    """Execute a system command passed as a string."""
-    
-    print 'Running:', command
-    os.system(command)
-    print 'Done----------------\n'
-    
-def read_bin_data(fname):
-    """Read data from a binary file into an array.
-    
-    Read the data from a binary file created by wgrib into
-    a Numpy array. This assumes that wgrib has output the data
-    in float format and seems to work for the UM outputs that
-    are being sent to us by SAWS. The first and last values
-    read from the file are trimmed since they are superflous.
+import grib
 
-    """
-    
-    f = open(fname, "rb")
-    raw = f.read()
-    f.close()
-    data = np.fromstring(raw, 'f')
-    data = data[1:-1] # trim invalid values - FORTRAN header
-    if sys.byteorder == 'big':
-        data = data.byteswap()
-
-    return data
-
-def read(grb_name, record=1, rows=401, cols=601):
+def read(grb_name, record=1, rows=401, cols=601, param=None, level=None,
+         forecast_time=None, persist_index=True):
     """Read the data field from a grib file into an array.
 
-    This function uses wgrib to write and then read the GRIB1
-    data to an intermediate binary format, which is later
-    deleted. It is currently very specific to the GRIB1 data
-    files produced by the UM.
+    The GRIB1 record is decoded directly from the file, giving the
+    same values that wgrib writes with the -bin option. It is
+    currently very specific to the GRIB1 data files produced by
+    the UM.
+
+    The record is located through the file's inventory (see
+    grib.inventory). Unless `persist_index` is False the inventory is
+    saved alongside the file, so reading many records from a forecast
+    file only scans it once. Instead of
+    a record number, the record may be selected by any of the `param`
+    (GRIB1 parameter code), `level` and `forecast_time` of its header,
+    which must match exactly one record.
 
     """
-    
-    bin_name = grb_name[0:-5] + '.bin'
 
-    # note that spaces are N.B.
-##    exec_str = 'wgrib ' + grb_name + ' -d ' + record + ' -bin -o ' + bin_name
-    exec_str = 'wgrib %s -v -d %d -bin -o %s' % (grb_name, record, bin_name)
+    index = grib.inventory(grb_name, persist=persist_index)
+
+    if param is not None or level is not None or forecast_time is not None:
+        records = grib.select(index, param=param, level=level,
+                              forecast_time=forecast_time)
+        if len(records) != 1:
+            raise ValueError('%d records in %s match param=%s, level=%s, '
+                             'forecast_time=%s' % (len(records), grb_name,
+                                                   param, level,
+                                                   forecast_time))
+        record = records[0]
 
-    execute(exec_str)
-    a = read_bin_data(bin_name)
-    os.remove(bin_name)
+    field, a = grib.read(grb_name, record, index=index)
 
     a = a.reshape(rows, cols)
     a = np.flipud(a)
 
     return a
 
+def read_many(grb_name, records, rows=401, cols=601, out=None):
+    """Read several records from a grib file into one array.
+
+    The records are decoded in a single pass through the file, straight
+    into the planes of a float32 array of shape (len(records), rows,
+    cols), which are oriented as by `read` (flipped north up) through
+    views rather than copies. Points missing from the bitmap are NaN.
+
+    Parameters
+    ----------
+    grb_name : string
+        The name of the UM GRIB1 file.
+    records : sequence of ints
+        The record numbers, counting from 1.
+    rows, cols : int, optional
+        The size of the UM grid.
+    out : ndarray, optional
+        A float32 array of shape (len(records), rows, cols) to hold the
+        result, e.g. a memmap.
+
+    Returns
+    -------
+    data : ndarray
+        The (record, row, col) array.
+
+    """
+
+    shape = (len(records), rows, cols)
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    elif out.shape != shape or out.dtype != np.float32:
+        raise ValueError('out is a %s array of shape %s, expected float32 '
+                         'of shape %s' % (out.dtype, out.shape, shape))
+
+    records = np.asarray(records)
+    order = np.argsort(records, kind='mergesort') # walk the file forwards
+    planes = [out[i, ::-1] for i in order]
+
+    for field in grib.read_records(grb_name, records[order], out=planes,
+                                   missing=np.nan):
+        pass
+
+    return out
+
+def read_all(grb_name, param, rows=401, cols=601, levels=None,
+             forecast_times=None, persist_index=True):
+    """Read all the records of a parameter into a forecast cube.
+
+    Parameters
+    ----------
+    grb_name : string
+        The name of the UM GRIB1 file.
+    param : int
+        The GRIB1 parameter code, e.g. 11 for temperature.
+    rows, cols : int, optional
+        The size of the UM grid.
+    levels, forecast_times : sequence, optional
+        The levels and forecast times to read, by default all those
+        found in the file for `param`, in increasing order.
+    persist_index : bool, optional
+        Save the file's inventory alongside it (the default), see
+        grib.inventory.
+
+    Returns
+    -------
+    data : ndarray
+        A float32 array of shape (forecast time, level, rows, cols),
+        oriented as by `read`. Combinations not found in the file, and
+        points missing from the bitmap, are NaN.
+    forecast_times : ndarray
+        The forecast times (in the file's time units) of axis 0.
+    levels : ndarray
+        The levels of axis 1.
+
+    """
+
+    index = grib.inventory(grb_name, persist=persist_index)
+    records = grib.select(index, param=param)
+    selected = index[records - 1]
+
+    if levels is None:
+        levels = np.unique(selected['level'])
+    if forecast_times is None:
+        forecast_times = np.unique(selected['forecast_time'])
+    levels = np.asarray(levels)
+    forecast_times = np.asarray(forecast_times)
+
+    data = np.empty((len(forecast_times), len(levels), rows, cols),
+                    dtype=np.float32)
+    data.fill(np.nan)
+
+    wanted = []
+    planes = []
+    for record, row in zip(records, selected):
+        t = np.flatnonzero(forecast_times == row['forecast_time'])
+        l = np.flatnonzero(levels == row['level'])
+        if len(t) and len(l):
+            wanted.append(record)
+            planes.append(data[t[0], l[0], ::-1])
+
+    for field in grib.read_records(grb_name, wanted, index=index,
+                                   out=planes, missing=np.nan):
+        pass
+
+    return data, forecast_times, levels
+
 def plot(grb_name, fig_name, title='GRIB Plot', record=1, rows=401, cols=601):
     """Create a quick and dirty plot of the data in a GRIB1 file."""
     import pylab as pl
@@ -7,6 +7,8 @@ bindings are used to access the data. Numpy is also required.
 
 """
 import os
+import shutil
+import tempfile
 from zipfile import ZipFile
 
 import numpy as np
@@ -16,17 +18,126 @@ try:
     from osgeo import gdal
     import osgeo.gdalconst as gdalc
 except ImportError:
-    import gdal
-    import gdalconst as gdalc
+    try:
+        import gdal
+        import gdalconst as gdalc
+    except ImportError:
+        gdal = None # the NDVI datasets can't be read
 
-from arraytools import Raster
+from arraytools import Raster, find_indices
+
+# The members of the zipped archives
+_log_member = '0001/0001_LOG.TXT'
+_ndvi_member = '0001/0001_NDV.HDF'
+
+def _read_georeference(archive):
+    """The cell size and lower left cell centre from the LOG.TXT file."""
+    metadata = archive.read(_log_member)
+
+    key_val = []
+    for item in metadata.split('\r\n'):
+        splitta = item.split()
+        if len(splitta) > 0:
+            key, value = splitta[:2]
+            key_val.append((key, value))
+
+    metadata = dict(key_val)
+
+    dx = float(metadata['MAP_PROJ_RESOLUTION'])
+    dy = float(metadata['MAP_PROJ_RESOLUTION'])
+
+    x0 = float(metadata['CARTO_LOWER_LEFT_X'])
+    x0 += dx/2.0
+
+    y0 = float(metadata['CARTO_LOWER_LEFT_Y'])
+    y0 += dy/2.0
+
+    return x0, y0, dx, dy
+
+def _subset_window(x0, y0, dx, dy, rows, cols,
+                   min_lat, min_lon, max_lat, max_lon):
+    """The window of a sub-region, as taken by Raster.subset.
+
+    Returns
+    -------
+    window : tuple
+        (xoff, yoff, xsize, ysize) of the sub-region in pixels.
+    origin : tuple
+        (x0, y0) of the lower left cell centre of the sub-region.
+
+    """
+    row_indices, col_indices = find_indices([max_lat, min_lat],
+                                            [min_lon, max_lon],
+                                            y0, x0, dy, dx, rows, cols)
+    min_row, max_row = row_indices
+    min_col, max_col = col_indices
+    if -999 in (min_row, max_row, min_col, max_col):
+        raise ValueError('The sub-region is not inside the NDVI dataset')
+
+    window = (min_col, min_row, max_col - min_col, max_row - min_row)
+    origin = (x0 + min_col*dx, y0 + (rows - 1 - max_row)*dy)
+
+    return window, origin
+
+def _open_dataset(ndvi_fname, archive):
+    """Open the NDVI dataset inside a zipped archive.
+
+    The dataset is opened in place through GDAL's /vsizip/ virtual
+    file system. GDAL's HDF4 driver can only read real files, so if
+    that fails the HDF file is extracted to a uniquely named temporary
+    file, which must be removed by the caller once the dataset is
+    closed.
+
+    Returns
+    -------
+    dataset : gdal.Dataset
+    temp_fname : string or None
+        The name of the temporary file, if one was needed.
+
+    """
+    vsi_name = '/vsizip/%s/%s' % (os.path.abspath(ndvi_fname), _ndvi_member)
+
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    try:
+        dataset = gdal.Open(vsi_name, gdalc.GA_ReadOnly)
+    finally:
+        gdal.PopErrorHandler()
+
+    if dataset is not None:
+        return dataset, None
+
+    fd, temp_fname = tempfile.mkstemp(suffix='.hdf')
+    try:
+        fp = os.fdopen(fd, 'wb')
+        try:
+            member = archive.open(_ndvi_member)
+            shutil.copyfileobj(member, fp)
+            member.close()
+        finally:
+            fp.close()
+
+        dataset = gdal.Open(temp_fname, gdalc.GA_ReadOnly)
+    except:
+        os.remove(temp_fname)
+        raise
+
+    if dataset is None:
+        os.remove(temp_fname)
+
+        raise OSError('GDAL installation does not support HDF. '
+                      'Please rebuild with HDF support.')
+
+    return dataset, temp_fname
 
 def read_ndvi(ndvi_fname, min_lat=None, min_lon=None,
               max_lat=None, max_lon=None, masked=True):
     """Read VGT4Africa NDVI product.
 
     Read the NDVI data into a Numpy masked array, using the GDAL Python
-    bindings.
+    bindings. The dataset is read from the archive without extracting it
+    where GDAL allows (otherwise via a unique temporary file), and only
+    the window of the requested sub-region is read, so the function may
+    be called from several threads at once.
 
     Parameters
     ----------
@@ -53,57 +164,41 @@ def read_ndvi(ndvi_fname, min_lat=None, min_lon=None,
     -------
     ndvi : {MaskedArray, Raster}
         A Numpy Masked Array object or Raster depending on the value of the
-        `masked` parameter.
+        `masked` parameter. The sub-region is the same as that given by
+        Raster.subset on the whole dataset.
 
     """
-    temp_fname = 'curr.hdf'
+    if gdal is None:
+        raise ImportError('The GDAL Python bindings are needed to read '
+                          'NDVI datasets')
 
     archive = ZipFile(ndvi_fname)
-
-    metadata = archive.read('0001/0001_LOG.TXT')
-
-    key_val = []
-    for item in metadata.split('\r\n'):
-        splitta = item.split()
-        if len(splitta) > 0:
-            key, value = splitta[:2]
-            key_val.append((key, value))
-
-    metadata = dict(key_val)
-
-    dx = float(metadata['MAP_PROJ_RESOLUTION'])
-    dy = float(metadata['MAP_PROJ_RESOLUTION'])
-
-    x0 = float(metadata['CARTO_LOWER_LEFT_X'])
-    x0 += dx/2.0
-
-    y0 = float(metadata['CARTO_LOWER_LEFT_Y'])
-    y0 += dy/2.0
-
-    # write a temporary HDF file
-    fp = open(temp_fname, 'wb')
-    fp.write(archive.read('0001/0001_NDV.HDF'))
-    fp.close()
-
-    archive.close()
-
-    dataset = gdal.Open(temp_fname, gdalc.GA_ReadOnly)
-    if dataset == None:
-        os.remove(temp_fname)
-
-        raise OSError, 'GDAL installation does not support HDF. ' \
-              'Please rebuild with HDF support.'
-
-    data = dataset.ReadAsArray()
-
-    if (min_lat is not None
-       and min_lon is not None
-       and max_lat is not None
-       and max_lon is not None):
-        ndvi = Raster(data, x0, y0, dx, dy)
-        ndvi = ndvi.subset(min_lon, min_lat, max_lon, max_lat)
-    else:
-        ndvi = data
+    try:
+        x0, y0, dx, dy = _read_georeference(archive)
+        dataset, temp_fname = _open_dataset(ndvi_fname, archive)
+    finally:
+        archive.close()
+
+    try:
+        rows, cols = dataset.RasterYSize, dataset.RasterXSize
+
+        if (min_lat is not None
+           and min_lon is not None
+           and max_lat is not None
+           and max_lon is not None):
+            window, (sub_x0, sub_y0) = _subset_window(x0, y0, dx, dy,
+                                                      rows, cols,
+                                                      min_lat, min_lon,
+                                                      max_lat, max_lon)
+            data = dataset.ReadAsArray(*window)
+            ndvi = Raster(data, x0=sub_x0, y0=sub_y0, dx=dx, dy=dy)
+        else:
+            data = dataset.ReadAsArray()
+            ndvi = data
+    finally:
+        del dataset
+        if temp_fname is not None:
+            os.remove(temp_fname)
 
     if masked:
         ndvi = ma.masked_equal(ndvi, 0) # mask out sea
@@ -114,8 +209,6 @@ def read_ndvi(ndvi_fname, min_lat=None, min_lon=None,
         if not isinstance(ndvi, Raster):
             ndvi = Raster(data, x0, y0, dx, dy)
 
-    os.remove(temp_fname)
-
     return ndvi
 
 def plot_ndvi(hdf_fname, fig_name,
@@ -1,6 +1,7 @@
 """A collection of tools for spatial data and GIS tasks.
 
 """
+import numpy as np
 
 def point_in_poly(pnt, poly):
     """Calculate whether a point lies inside a polygon
@@ -37,3 +38,95 @@ def point_in_poly(pnt, poly):
         p1x,p1y = p2x,p2y
     return inside
 
+
+# The MSG/SEVIRI geostationary projection (as PROJ's geos with sweep y)
+GEOS_EQ_RADIUS = 6378169.0 # m
+GEOS_POL_RADIUS = 6356583.8 # m
+GEOS_HEIGHT = 35785831.0 # m, satellite height above the equator
+
+def geos_forward(lon, lat, sub_lon=0.0, h=GEOS_HEIGHT,
+                 req=GEOS_EQ_RADIUS, rpol=GEOS_POL_RADIUS):
+    """Project longitudes and latitudes to geostationary coordinates.
+
+    The coordinates are the scanning angles of a geostationary
+    satellite, as seen from `h` metres above the equator at longitude
+    `sub_lon`, multiplied by `h`. This is the projection of the MSG
+    SEVIRI images.
+
+    Parameters
+    ----------
+    lon, lat : array_like
+        Longitudes and latitudes in degrees.
+    sub_lon : float, optional
+        The longitude of the sub-satellite point in degrees.
+    h : float, optional
+        The height of the satellite above the equator in metres.
+    req, rpol : float, optional
+        The equatorial and polar radii of the Earth in metres.
+
+    Returns
+    -------
+    x, y : ndarray
+        The projection coordinates in metres, east and north of the
+        sub-satellite point. Points not visible from the satellite are
+        NaN.
+
+    """
+    lon = np.radians(np.asarray(lon, dtype=np.float64) - sub_lon)
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+
+    # geocentric latitude and distance from the Earth's centre
+    c_lat = np.arctan((rpol/req)**2*np.tan(lat))
+    rl = rpol/np.sqrt(1 - (1 - (rpol/req)**2)*np.cos(c_lat)**2)
+
+    r1 = rl*np.cos(c_lat)*np.cos(lon)
+    r2 = rl*np.cos(c_lat)*np.sin(lon)
+    r3 = rl*np.sin(c_lat)
+
+    dist = (h + req) - r1
+    x = h*np.arctan(r2/dist)
+    y = h*np.arctan(r3/np.hypot(r2, dist))
+
+    # the surface faces the satellite
+    hidden = (h + req)*r1 <= req**2
+    x = np.where(hidden, np.nan, x)
+    y = np.where(hidden, np.nan, y)
+
+    return x, y
+
+def geos_inverse(x, y, sub_lon=0.0, h=GEOS_HEIGHT,
+                 req=GEOS_EQ_RADIUS, rpol=GEOS_POL_RADIUS):
+    """Geostationary projection coordinates to longitudes and latitudes.
+
+    The inverse of `geos_forward`, the parameters are the same.
+
+    Returns
+    -------
+    lon, lat : ndarray
+        Longitudes and latitudes in degrees. Points off the Earth's
+        disk are NaN.
+
+    """
+    x = np.asarray(x, dtype=np.float64)/h
+    y = np.asarray(y, dtype=np.float64)/h
+
+    # the line of sight from the satellite, in units of req
+    sat = (h + req)/req
+    vy = np.tan(x)
+    vz = np.tan(y)*np.hypot(1, vy)
+
+    # intersect with the ellipsoid
+    a = 1 + vy**2 + (vz*req/rpol)**2
+    b = -2*sat
+    det = b**2 - 4*a*(sat**2 - 1)
+    det = np.where(det < 0, np.nan, det)
+    k = (-b - np.sqrt(det))/(2*a)
+
+    vx = sat - k
+    vy = k*vy
+    vz = k*vz
+
+    lon = np.arctan2(vy, vx)
+    lat = np.arctan((req/rpol)**2*vz*np.cos(lon)/vx)
+
+    return np.degrees(lon) + sub_lon, np.degrees(lat)
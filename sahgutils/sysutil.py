@@ -1,7 +1,8 @@
 # System utility functions
 from subprocess import Popen, PIPE
+from threading import Timer
 
-def exec_command(cmd_args):
+def exec_command(cmd_args, timeout=None):
     """Execute a shell command in a subprocess
 
     Convenience wrapper around subprocess to execute a shell command
@@ -16,6 +17,9 @@ def exec_command(cmd_args):
     cmd_args : list of strings
         The args to pass to subprocess. The first arg is the program
         name.
+    timeout : float, optional
+        If given, the process is killed once it has run for this many
+        seconds. The return code is then the negative signal number.
 
     Returns
     -------
@@ -28,7 +32,17 @@ def exec_command(cmd_args):
 
     """
     proc = Popen(cmd_args, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
-    proc.wait()
+
+    timer = None
+    if timeout is not None:
+        timer = Timer(timeout, proc.kill)
+        timer.start()
+
+    try:
+        stdout, stderr = proc.communicate()
+        proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
 
     return stdout, stderr, proc.returncode
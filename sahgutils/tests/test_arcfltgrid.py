@@ -0,0 +1,76 @@
+def write_flt(fname):
+    """Converter for test_convert_directory."""
+    import numpy as np
+
+    from sahgutils.io import arcfltgrid
+
+    data = np.fromfile(fname, dtype=np.float32).reshape(2, 3)
+    arcfltgrid.write(fname[:-4], data, 0, 0, 1)
+
+    return fname[:-4] + '.flt'
+
+def test_write_read(tmpdir):
+    import numpy as np
+    from numpy import ma
+    from numpy.testing import assert_equal
+
+    from sahgutils.io import arcfltgrid
+    from sahgutils.io.arraytools import Raster
+
+    data = np.arange(20, dtype=np.float32).reshape(4, 5)
+    bingrid_name = str(tmpdir.join('grid'))
+
+    arcfltgrid.write(bingrid_name, ma.masked_equal(data, 7), 1000.5,
+                     -2000, 250, byteorder='MSBFIRST')
+
+    header = arcfltgrid.read_header(bingrid_name)
+    assert_equal(header, {'ncols': 5, 'nrows': 4, 'xllcenter': 1000.5,
+                          'yllcenter': -2000, 'cellsize': 250,
+                          'nodata_value': -9999, 'byteorder': 'MSBFIRST'})
+
+    # big endian on disk, honoured when reading
+    raw = np.fromfile(bingrid_name + '.flt', dtype='>f4').reshape(4, 5)
+    assert_equal(raw, np.where(data == 7, -9999, data))
+
+    a, li_headers = arcfltgrid.read(bingrid_name)
+    assert_equal(a, raw)
+    assert_equal(li_headers[:2], [5, 4])
+
+    result = arcfltgrid.read_raster(bingrid_name)
+    assert_equal((result.x0, result.y0, result.dx), (1000.5, -2000, 250))
+    assert np.isnan(result[1, 2])
+    result[1, 2] = 7
+    assert_equal(result, data)
+
+    result = arcfltgrid.read_raster(bingrid_name, mmap=True)
+    assert_equal(result, raw)
+
+    arcfltgrid.write(bingrid_name, Raster(data, 1000.5, -2000, 250, 250))
+    result = arcfltgrid.read_raster(bingrid_name)
+    assert_equal((result.x0, result.y0, result.dx), (1000.5, -2000, 250))
+    assert_equal(result, data)
+
+    # the ArcGIS corner convention
+    fp = open(bingrid_name + '.hdr', 'w')
+    fp.write('ncols 5\nnrows 4\nxllcorner 0\nyllcorner 10\n'
+             'cellsize 2\nNODATA_value -9999\n')
+    fp.close()
+    data.astype('<f4').tofile(bingrid_name + '.flt')
+    result = arcfltgrid.read_raster(bingrid_name)
+    assert_equal((result.x0, result.y0), (1, 11))
+    assert_equal(result, data)
+
+def test_convert_directory(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_equal
+
+    from sahgutils.io import arcfltgrid
+
+    for i in range(3):
+        np.arange(6, dtype=np.float32).tofile(str(tmpdir.join('%d.grb' % i)))
+
+    fnames = arcfltgrid.convert_directory(write_flt, str(tmpdir), '*.grb',
+                                          processes=2)
+    assert_equal(fnames, [str(tmpdir.join('%d.flt' % i)) for i in range(3)])
+    a, headers = arcfltgrid.read(str(tmpdir.join('2')))
+    assert_equal(a, np.arange(6).reshape(2, 3))
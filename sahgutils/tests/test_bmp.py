@@ -0,0 +1,126 @@
+def write_bmp(fname, data, palette, top_down=False):
+    """Write an 8-bit paletted bitmap for testing."""
+    import struct
+
+    import numpy as np
+
+    rows, cols = data.shape
+    stride = (cols + 3) & ~3
+
+    padded = np.zeros((rows, stride), dtype=np.uint8)
+    padded[:, :cols] = data
+    if top_down:
+        height = -rows
+    else:
+        height = rows
+        padded = padded[::-1]
+
+    # BGRA order
+    s_palette = np.asarray(palette, dtype=np.uint8)[:, [2, 1, 0, 3]]
+    s_palette = s_palette.tostring()
+
+    dataoffset = 54 + len(s_palette)
+    header = struct.pack('=2sihhiiiihhiiiiii', 'BM',
+                         dataoffset + padded.size, 0, 0, dataoffset,
+                         40, cols, height, 1, 8, 0, padded.size,
+                         2835, 2835, len(palette), 0)
+
+    fp = open(fname, 'wb')
+    fp.write(header + s_palette + padded.tostring())
+    fp.close()
+
+def test_read(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_equal
+
+    from sahgutils.io import BMPFile
+
+    data = np.arange(200, 215, dtype=np.uint8).reshape(3, 5)
+    palette = [(i, 255 - i, i // 2, 0) for i in range(256)]
+
+    for top_down in [False, True]:
+        fname = str(tmpdir.join('test.bmp'))
+        write_bmp(fname, data, palette, top_down)
+
+        bmp_file = BMPFile(fname)
+
+        header = bmp_file.header()
+        assert_equal(header['datawidth'], 5)
+        assert_equal(header['dataoffset'], 1078)
+
+        assert_equal(bmp_file.palette(), palette)
+
+        assert_equal(bmp_file.data().dtype, np.uint8)
+        assert_equal(bmp_file.data(), data)
+        assert_equal(bmp_file.read_rows(1, 3), data[1:3])
+        assert_equal(bmp_file.read_rows(0, 1), data[:1])
+
+        lut = bmp_file.palette_lut()
+        assert_equal(lut.shape, (256, 4))
+        assert_equal(lut.dtype, np.uint8)
+        assert_equal(lut, palette)
+
+        rgba = bmp_file.rgba()
+        assert_equal(rgba, np.array(palette, dtype=np.uint8)[data])
+
+        out = np.empty(data.shape + (4,), dtype=np.uint8)
+        bmp_file.rgba(out=out)
+        assert_equal(out, rgba)
+
+        rain_lut = np.linspace(0, 100, 256).astype(np.float32)
+        out = np.empty(data.shape, dtype=np.float32)
+        bmp_file.values(rain_lut, out=out)
+        assert_equal(out, rain_lut[data])
+
+def test_read_unsupported(tmpdir):
+    import struct
+
+    import pytest
+
+    from sahgutils.io import BMPFile
+
+    # A 24-bit bitmap header
+    fname = str(tmpdir.join('test.bmp'))
+    fp = open(fname, 'wb')
+    fp.write(struct.pack('=2sihhiiiihhiiiiii', 'BM', 54 + 48, 0, 0, 54,
+                         40, 4, 4, 1, 24, 0, 48, 2835, 2835, 0, 0))
+    fp.write('\0'*48)
+    fp.close()
+
+    with pytest.raises(ValueError):
+        BMPFile(fname)
+
+def test_read_sequence(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_equal
+    import pytest
+
+    from sahgutils.io.bmp import read_sequence
+
+    palette = [(i, i, i, 0) for i in range(256)]
+    data = np.random.randint(0, 256, size=(4, 3, 5)).astype(np.uint8)
+
+    fnames = []
+    for i, image in enumerate(data):
+        fnames.append(str(tmpdir.join('%d.bmp' % i)))
+        write_bmp(fnames[-1], image, palette)
+
+    seq, seq_palette = read_sequence(fnames, threads=2)
+    assert_equal(seq, data)
+    assert_equal(seq_palette, np.array(palette, dtype=np.uint8))
+
+    seq, seq_palette = read_sequence(fnames,
+                                     memmap_fname=str(tmpdir.join('seq.dat')))
+    assert isinstance(seq, np.memmap)
+    assert_equal(seq, data)
+
+    # Palettes differ
+    write_bmp(fnames[-1], data[-1], palette[::-1])
+    seq, seq_palette = read_sequence(fnames)
+    assert_equal(seq, data)
+    assert seq_palette is None
+
+    # Dimensions differ
+    write_bmp(fnames[-1], data[-1, :2], palette)
+    with pytest.raises(ValueError):
+        read_sequence(fnames)
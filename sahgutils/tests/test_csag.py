@@ -50,3 +50,178 @@ def test_basic_read():
                                        datetime.datetime(1998, 3, 18, 0, 0),
                                        datetime.datetime(1998, 3, 19, 0, 0),
                                        datetime.datetime(1998, 3, 20, 0, 0)])
+
+def test_header_length():
+    import os
+
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import CSAGStationReader
+
+    ref_reader = CSAGStationReader('0009084_.txt')
+
+    # Drop the comment block, the data section must still be found
+    lines = open('0009084_.txt', 'rb').readlines()
+    lines = [line for line in lines if not line.startswith('#')]
+
+    fname = 'short_header.txt'
+    fp = open(fname, 'wb')
+    fp.writelines(lines)
+    fp.close()
+
+    try:
+        csag_reader = CSAGStationReader(fname)
+
+        assert_equal(csag_reader.header(), ref_reader.header())
+        assert_allclose(csag_reader.data(), ref_reader.data())
+        assert_equal(csag_reader.dates(), ref_reader.dates())
+    finally:
+        os.remove(fname)
+
+def test_header_comma(tmpdir):
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import CSAGStationIndex, CSAGStationReader
+
+    ref_reader = CSAGStationReader('0009084_.txt')
+
+    # Station names often contain commas and spaces
+    content = open('0009084_.txt', 'rb').read()
+    content = content.replace('NAME | KLEINDORP_-_POL',
+                              'NAME | KLEINDORP, POL STATION')
+    fname = tmpdir.join('0009084_.txt')
+    fname.write(content, mode='wb')
+
+    csag_reader = CSAGStationReader(str(fname))
+
+    header = ref_reader.header()
+    header['NAME'] = 'KLEINDORP, POL STATION'
+    assert_equal(csag_reader.header(), header)
+    assert_allclose(csag_reader.data(), ref_reader.data())
+    assert_equal(csag_reader.dates(), ref_reader.dates())
+
+    index = CSAGStationIndex(str(tmpdir))
+    assert_equal(index.records()['name'][0], 'KLEINDORP, POL STATION')
+
+def test_archive(tmpdir):
+    import os
+
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import CSAGArchive, CSAGStationReader
+
+    ref_reader = CSAGStationReader('0009084_.txt')
+
+    # A second station, observed over the following month
+    content = open('0009084_.txt', 'rb').read()
+    tmpdir.join('0009084_.txt').write(content, mode='wb')
+    content = content.replace('0009084_', '0009085_')
+    content = content.replace('199803', '199804')
+    tmpdir.join('0009085_.txt').write(content, mode='wb')
+
+    archive = CSAGArchive(str(tmpdir), processes=2)
+
+    assert_equal(list(archive.stations()), ['0009084_', '0009085_'])
+    assert_equal(archive.dates()[0], np.datetime64('1998-03-01'))
+    assert_equal(archive.dates()[-1], np.datetime64('1998-04-20'))
+
+    data = archive.data()
+    assert_equal(data.shape, (2, 51))
+    assert_equal(data.dtype, np.float32)
+    assert_allclose(data[0, :20], ref_reader.data())
+    assert_allclose(data[1, 31:], ref_reader.data())
+    assert np.isnan(data[0, 20:]).all()
+    assert np.isnan(data[1, :31]).all()
+
+    # Unchanged files are loaded from the cache
+    archive = CSAGArchive(str(tmpdir), processes=1)
+    assert isinstance(archive.data(), np.memmap)
+    assert_allclose(archive.data(), data)
+
+    # Changed files invalidate the cache
+    os.remove(str(tmpdir.join('0009085_.txt')))
+    archive = CSAGArchive(str(tmpdir), processes=1)
+    assert not isinstance(archive.data(), np.memmap)
+    assert_equal(archive.data().shape, (1, 20))
+
+def test_station_index(tmpdir):
+    from datetime import datetime
+
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import CSAGStationIndex
+
+    content = open('0009084_.txt', 'rb').read()
+    tmpdir.join('0009084_.txt').write(content, mode='wb')
+    content = content.replace('0009084_', '0009085_')
+    content = content.replace('199803', '199804')
+    content = content.replace('-36.54', '-29.60')
+    content = content.replace('22.05', '30.40')
+    tmpdir.join('0009085_.txt').write(content, mode='wb')
+
+    index = CSAGStationIndex(str(tmpdir))
+
+    records = index.records()
+    assert_equal(list(records['id']), ['0009084_', '0009085_'])
+    assert_equal(records['name'][0], 'KLEINDORP_-_POL')
+    assert_allclose(records['lat'], [-36.54, -29.60])
+    assert_allclose(records['alt'], [153.0, 153.0])
+
+    assert_equal(list(index.bbox(-35, 20, -25, 35)['id']), ['0009085_'])
+    assert_equal(list(index.radius(-29.5, 30.5, 50)['id']), ['0009085_'])
+    assert_equal(list(index.radius(-29.5, 30.5, 5000)['id']),
+                 ['0009085_', '0009084_'])
+    assert_equal(list(index.nearest(-36, 22, k=1)['id']), ['0009084_'])
+    assert_equal(list(index.nearest(-36, 22, k=5)['id']),
+                 ['0009084_', '0009085_'])
+    assert_equal(list(index.covering(datetime(1998, 3, 5),
+                                     datetime(1998, 3, 10))['id']),
+                 ['0009084_'])
+    assert_equal(len(index.covering(datetime(1998, 3, 15),
+                                    datetime(1998, 4, 5))), 0)
+
+    # Reloading uses the cached index
+    index = CSAGStationIndex(str(tmpdir))
+    assert_equal(index.records(), records)
+
+def test_refresh(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import CSAGArchive, CSAGStationReader
+
+    lines = open('0009084_.txt', 'rb').readlines()
+    fname = tmpdir.join('0009084_.txt')
+    fname.write(''.join(lines[:-5]), mode='wb')
+
+    csag_reader = CSAGStationReader(str(fname))
+    archive = CSAGArchive(str(tmpdir), processes=1)
+    assert_equal(len(csag_reader.data()), 15)
+    assert_equal(archive.data().shape, (1, 15))
+
+    # New days appended to the file
+    fname.write(''.join(lines[-5:]), mode='ab')
+
+    assert_equal(csag_reader.refresh(), 5)
+    assert_equal(csag_reader.refresh(), 0)
+    ref_reader = CSAGStationReader('0009084_.txt')
+    assert_allclose(csag_reader.data(), ref_reader.data())
+    assert_equal(csag_reader.dates(), ref_reader.dates())
+
+    archive.refresh()
+    assert_equal(archive.data().shape, (1, 20))
+    assert_allclose(archive.data()[0], ref_reader.data())
+    assert_equal(archive.dates()[-1], np.datetime64('1998-03-20'))
+
+    # Earlier records changed, the whole file is parsed again
+    content = ''.join(lines).replace('19980301,    0.00', '19980301,    7.00')
+    fname.write(content + lines[-1].replace('19980320', '19980321'),
+                mode='wb')
+
+    assert_equal(csag_reader.refresh(), 21)
+    assert_allclose(csag_reader.data()[0], 7.0)
+
+    archive.refresh()
+    assert_equal(archive.data().shape, (1, 21))
+    assert_allclose(archive.data()[0, 0], 7.0)
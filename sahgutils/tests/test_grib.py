@@ -0,0 +1,643 @@
+import os
+from distutils.spawn import find_executable
+
+import pytest
+
+def pack_bits(ints, nbits):
+    """Pack unsigned integers into a string of `nbits` wide values."""
+    import numpy as np
+
+    ints = np.asarray(ints, dtype=np.uint64)
+    shifts = np.arange(nbits - 1, -1, -1, dtype=np.uint64)
+    bits = ((ints[:, None] >> shifts) & 1).astype(np.uint8)
+
+    return np.packbits(bits.ravel()).tostring()
+
+def uint(value, nbytes):
+    """Big-endian unsigned integer."""
+    return ''.join(chr((value >> 8*i) & 0xff)
+                   for i in range(nbytes - 1, -1, -1))
+
+def sint(value, nbytes):
+    """GRIB sign and magnitude integer."""
+    if value < 0:
+        return uint(-value | (1 << (8*nbytes - 1)), nbytes)
+    return uint(value, nbytes)
+
+def ibm_float(value):
+    """IBM single precision float."""
+    if value == 0:
+        return uint(0, 4)
+
+    sign = 0x80 if value < 0 else 0
+    value = abs(value)
+    exponent = 64
+    while value >= 1:
+        value /= 16.0
+        exponent += 1
+    while value < 1/16.0:
+        value *= 16.0
+        exponent -= 1
+
+    return chr(sign | exponent) + uint(int(value*2**24 + 0.5), 3)
+
+def grib1_message(ints, nx, ny, nbits=12, ref=0.0, bin_scale=0,
+                  dec_scale=0, bitmap=None, param=11, level_type=100,
+                  level=850, forecast_time=0, scan_mode=0):
+    """A GRIB1 message with a simple packed lat/lon grid.
+
+    `ints` are the packed values, only the points set in `bitmap`
+    if one is given.
+
+    """
+    import numpy as np
+
+    flag = 0xc0 if bitmap is not None else 0x80
+    pds = (uint(28, 3) + chr(2) + chr(7) + chr(0) + chr(255) + chr(flag) +
+           chr(param) + chr(level_type) + uint(level, 2) +
+           chr(7) + chr(1) + chr(2) + chr(12) + chr(0) + # 2007-01-02 12:00
+           chr(1) + chr(forecast_time) + chr(0) + chr(0) +
+           uint(0, 2) + chr(0) + chr(21) + chr(0) + sint(dec_scale, 2))
+
+    gds = (uint(32, 3) + chr(0) + chr(255) + chr(0) +
+           uint(nx, 2) + uint(ny, 2) + '\0'*17 + chr(scan_mode) + '\0'*4)
+
+    bms = ''
+    if bitmap is not None:
+        bits = np.packbits(np.asarray(bitmap, dtype=np.uint8)).tostring()
+        bms = uint(6 + len(bits), 3) + chr(0) + uint(0, 2) + bits
+
+    data = pack_bits(ints, nbits)
+    unused = len(data)*8 - len(ints)*nbits
+    bds = (uint(11 + len(data), 3) + chr(unused) + sint(bin_scale, 2) +
+           ibm_float(ref) + chr(nbits) + data)
+
+    body = pds + gds + bms + bds + '7777'
+
+    return 'GRIB' + uint(8 + len(body), 3) + chr(1) + body
+
+def grib2_message(ints, nx, ny, nbits=12, ref=0.0, bin_scale=0,
+                  dec_scale=0, bitmap=None, category=1, number=52,
+                  forecast_time=0, scan_mode=0, template=0):
+    """A GRIB2 message with a simple packed lat/lon or space view grid."""
+    import struct
+
+    import numpy as np
+
+    sec1 = (uint(21, 4) + chr(1) + uint(254, 2) + uint(0, 2) + chr(4) +
+            chr(0) + chr(1) + uint(2007, 2) + chr(1) + chr(2) + chr(12) +
+            chr(15) + chr(0) + chr(0) + chr(1))
+
+    sec3 = (chr(3) + chr(0) + uint(nx*ny, 4) + chr(0) + chr(0) +
+            uint(template, 2) + '\0'*16 + uint(nx, 4) + uint(ny, 4))
+    if template == 0:
+        sec3 += '\0'*33 + chr(scan_mode)
+    else:
+        sec3 += '\0'*25 + chr(scan_mode) + '\0'*16
+    sec3 = uint(4 + len(sec3), 4) + sec3
+
+    sec4 = (uint(34, 4) + chr(4) + uint(0, 2) + uint(0, 2) + chr(category) +
+            chr(number) + '\0'*6 + chr(1) + uint(forecast_time, 4) +
+            chr(1) + chr(0) + uint(0, 4) + chr(255) + '\0'*5)
+
+    sec5 = (uint(21, 4) + chr(5) + uint(len(ints), 4) + uint(0, 2) +
+            struct.pack('>f', ref) + sint(bin_scale, 2) +
+            sint(dec_scale, 2) + chr(nbits) + chr(0))
+
+    if bitmap is None:
+        sec6 = uint(6, 4) + chr(6) + chr(255)
+    else:
+        bits = np.packbits(np.asarray(bitmap, dtype=np.uint8)).tostring()
+        sec6 = uint(6 + len(bits), 4) + chr(6) + chr(0) + bits
+
+    data = pack_bits(ints, nbits)
+    sec7 = uint(5 + len(data), 4) + chr(7) + data
+
+    body = sec1 + sec3 + sec4 + sec5 + sec6 + sec7 + '7777'
+
+    return 'GRIB\0\0' + chr(0) + chr(2) + uint(16 + len(body), 8) + body
+
+def test_decode_grib1(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import grib, umgrib
+
+    nx, ny = 5, 3
+    ints = np.arange(nx*ny)*250 % 4096
+    expected = (-20.5 + ints*2.0**-2)/10.0**1
+
+    bitmap = np.ones(nx*ny, dtype=bool)
+    bitmap[[0, 7, 14]] = False
+    masked = np.where(bitmap, (2.0 + ints*2.0**3), grib.UNDEFINED)
+
+    fname = str(tmpdir.join('test.grb'))
+    fp = open(fname, 'wb')
+    fp.write(grib1_message(ints, nx, ny, ref=-20.5, bin_scale=-2,
+                           dec_scale=1))
+    fp.write(grib1_message(ints[bitmap], nx, ny, nbits=13, ref=2.0,
+                           bin_scale=3, bitmap=bitmap, param=33,
+                           forecast_time=6))
+    fp.close()
+
+    field, values = grib.read(fname)
+    assert_equal(field['edition'], 1)
+    assert_equal(field['param'], 11)
+    assert_equal(field['level'], 850)
+    assert_equal((field['nx'], field['ny']), (nx, ny))
+    assert_equal(values.dtype, np.float32)
+    assert_allclose(values, expected, rtol=1e-6)
+
+    field, values = grib.read(fname, 2)
+    assert_equal(field['param'], 33)
+    assert_equal(field['forecast_time'], 6)
+    assert_allclose(values, masked, rtol=1e-6)
+
+    with pytest.raises(IndexError):
+        grib.read(fname, 3)
+
+    # the UM reader flips the grid to north up
+    a = umgrib.read(fname, 1, rows=ny, cols=nx)
+    assert_allclose(a, np.flipud(expected.reshape(ny, nx)), rtol=1e-6)
+
+def test_decode_grib2(tmpdir, monkeypatch):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import grib
+
+    nx, ny = 4, 6
+    ints = np.random.randint(0, 2**7, size=nx*ny)
+    bitmap = np.random.randint(0, 2, size=nx*ny).astype(bool)
+    expected = np.where(bitmap, (1.5 + ints*2.0**-3)/10.0**-2,
+                        grib.UNDEFINED)
+
+    fname = str(tmpdir.join('test.grb2'))
+    fp = open(fname, 'wb')
+    fp.write(grib2_message(ints[bitmap], nx, ny, nbits=7, ref=1.5,
+                           bin_scale=-3, dec_scale=-2, bitmap=bitmap,
+                           template=90))
+    fp.write(grib2_message(ints, nx, ny, nbits=16, forecast_time=3))
+    fp.close()
+
+    fields = list(grib.iter_fields(grib.open_grib(fname)))
+    assert_equal(len(fields), 2)
+    assert_equal([f['edition'] for f in fields], [2, 2])
+    assert_equal(fields[0]['number'], 52)
+    assert_equal(fields[1]['forecast_time'], 3)
+
+    field, values = grib.read(fname)
+    assert_allclose(values, expected, rtol=1e-6)
+
+    # scanning north to south, wgrib2 reorders to south to north
+    field, values = grib.read(fname, order='we:sn')
+    assert_allclose(values.reshape(ny, nx),
+                    expected.reshape(ny, nx)[::-1], rtol=1e-6)
+
+    field, values = grib.read(fname, 2)
+    assert_equal(values, ints)
+
+    # decoding in blocks which don't start on a byte of the bitmap or
+    # of the packed values, into a flipped view of a 2D array
+    monkeypatch.setattr(grib, '_chunk_size', 5)
+    field, values = grib.read(fname)
+    assert_allclose(values, expected, rtol=1e-6)
+
+    buf = grib.open_grib(fname)
+    field = next(grib.iter_fields(buf))
+    out = np.empty((2, ny, nx), dtype=np.float32)
+    grib.decode_field(buf, field, out=out[1, ::-1])
+    assert_allclose(out[1, ::-1], expected.reshape(ny, nx), rtol=1e-6)
+    buf.close()
+
+@pytest.mark.skipif(find_executable('wgrib2') is None,
+                    reason='wgrib2 is not installed')
+def test_compare_wgrib2(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose
+
+    from sahgutils.io import grib
+
+    nx, ny = 30, 20
+    ints = np.random.randint(0, 2**11, size=nx*ny)
+    bitmap = np.random.randint(0, 2, size=nx*ny).astype(bool)
+
+    fname = str(tmpdir.join('test.grb2'))
+    bin_name = str(tmpdir.join('test.bin'))
+    fp = open(fname, 'wb')
+    fp.write(grib2_message(ints[bitmap], nx, ny, nbits=11, ref=-3.25,
+                           bin_scale=-4, dec_scale=1, bitmap=bitmap))
+    fp.close()
+
+    os.system('wgrib2 -no_f77 -bin %s %s > %s' % (bin_name, fname,
+                                                 os.devnull))
+    expected = np.fromfile(bin_name, dtype=np.float32)
+
+    field, values = grib.read(fname, order='we:sn')
+    assert_allclose(values, expected, rtol=1e-6)
+
+# Stands in for wgrib2, copying the input file to stdout
+FAKE_WGRIB2 = '''#!%s
+import sys
+import time
+
+grb_name = sys.argv[1]
+if 'bad' in grb_name:
+    sys.stderr.write('*** FATAL ERROR: not a grib file ***')
+    sys.exit(8)
+if 'slow' in grb_name:
+    time.sleep(30)
+
+assert sys.argv[-3:] == ['-no_header', '-bin', '-']
+sys.stdout.write(open(grb_name, 'rb').read())
+'''
+
+def test_read_many(tmpdir):
+    import sys
+
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import grib
+
+    wgrib2 = str(tmpdir.join('wgrib2'))
+    fp = open(wgrib2, 'w')
+    fp.write(FAKE_WGRIB2 % sys.executable)
+    fp.close()
+    os.chmod(wgrib2, 0755)
+
+    # the stand-in returns the contents of the file
+    data = np.random.rand(10, 100).astype(np.float32)
+    fnames = []
+    for i, values in enumerate(data):
+        fnames.append(str(tmpdir.join('%02d.grb2' % i)))
+        values.tofile(fnames[-1])
+
+    result = list(grib.read_many(fnames, threads=3, wgrib2=wgrib2,
+                                 timeout=20))
+    assert_equal(result, data)
+
+    fname = str(tmpdir.join('bad.grb2'))
+    data[0].tofile(fname)
+    with pytest.raises(grib.WgribError) as e:
+        list(grib.read_many(fnames[:2] + [fname], wgrib2=wgrib2))
+    assert_equal(e.value.grb_name, fname)
+    assert_equal(e.value.returncode, 8)
+    assert 'not a grib file' in e.value.stderr
+
+    fname = str(tmpdir.join('slow.grb2'))
+    data[0].tofile(fname)
+    with pytest.raises(grib.WgribError) as e:
+        grib.wgrib2_read(fname, wgrib2=wgrib2, timeout=0.5)
+    assert e.value.returncode < 0
+
+    with pytest.raises(grib.WgribError):
+        grib.wgrib2_read(fname, wgrib2=str(tmpdir.join('missing')))
+
+    # decoded natively
+    for i in range(5):
+        fp = open(fnames[i], 'wb')
+        fp.write(grib2_message(np.arange(12)*i, 4, 3))
+        fp.close()
+
+    for i, values in enumerate(grib.read_many(fnames[:5], threads=2)):
+        assert_allclose(values, np.arange(12)*i)
+
+def test_inventory(tmpdir, monkeypatch):
+    import __builtin__
+
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import grib, umgrib
+
+    nx, ny = 4, 3
+    fname = str(tmpdir.join('um.grb'))
+    fp = open(fname, 'wb')
+    for i, (param, level) in enumerate([(11, 850), (11, 500), (33, 850)]):
+        fp.write(grib1_message(np.arange(nx*ny) + 100*i, nx, ny,
+                               param=param, level=level, forecast_time=6))
+    fp.close()
+
+    index = grib.inventory(fname, persist=False)
+    assert not os.path.exists(fname + '.idx.npz')
+
+    # a directory which can't be written to is scanned each time
+    def read_only(name, mode='r', *args):
+        if 'w' in mode:
+            raise IOError(13, 'Permission denied', name)
+        return __builtin__.open(name, mode, *args)
+    monkeypatch.setattr(grib, 'open', read_only, raising=False)
+    assert_equal(grib.inventory(fname), index)
+    assert_equal(os.listdir(str(tmpdir)), ['um.grb'])
+    monkeypatch.undo()
+
+    assert_equal(grib.inventory(fname), index)
+    assert os.path.exists(fname + '.idx.npz')
+    assert_equal(index['param'], [11, 11, 33])
+    assert_equal(index['level'], [850, 500, 850])
+    assert_equal(index['forecast_time'], [6, 6, 6])
+    assert_equal(index['offset'][0], 0)
+    assert_equal(index['offset'][1:], np.cumsum(index['length'])[:-1])
+
+    # the saved inventory is re-used
+    assert_equal(grib.inventory(fname), index)
+
+    assert_equal(grib.select(index, param=11), [1, 2])
+    assert_equal(grib.select(index, param=11, level=500), [2])
+    with pytest.raises(ValueError):
+        grib.select(index, height=2)
+
+    fields = list(grib.read_records(fname, [3, 1], index=index))
+    assert_equal([f['param'] for f, values in fields], [33, 11])
+    assert_allclose(fields[0][1], np.arange(nx*ny) + 200)
+
+    a = umgrib.read(fname, rows=ny, cols=nx, param=11, level=500)
+    assert_allclose(a, np.flipud(np.arange(nx*ny).reshape(ny, nx) + 100))
+    with pytest.raises(ValueError):
+        umgrib.read(fname, rows=ny, cols=nx, param=11)
+
+    # rewriting the file invalidates the saved inventory
+    fp = open(fname, 'ab')
+    fp.write(grib2_message(np.arange(nx*ny), nx, ny))
+    fp.close()
+
+    index = grib.inventory(fname)
+    assert_equal(index['edition'], [1, 1, 1, 2])
+    assert_equal(index['param'][3], 52)
+    assert_equal(index['category'], [-1, -1, -1, 1])
+    assert_allclose(grib.read(fname, 4, index=index)[1], np.arange(nx*ny))
+    assert_allclose(grib.read(fname, 4)[1], np.arange(nx*ny))
+    assert_allclose(grib.read(fname)[1], np.arange(nx*ny))
+    with pytest.raises(IndexError):
+        grib.read(fname, 5)
+
+def test_read_all(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import umgrib
+
+    nx, ny = 5, 4
+    fname = str(tmpdir.join('um.grb'))
+    fp = open(fname, 'wb')
+    expected = {}
+    for forecast_time in [0, 6, 12]:
+        for level in [850, 500]:
+            if (forecast_time, level) == (6, 500):
+                continue # missing record
+            ints = np.random.randint(0, 4096, size=nx*ny)
+            bitmap = np.ones(nx*ny, dtype=bool)
+            bitmap[level % 7] = False
+            fp.write(grib1_message(ints[bitmap], nx, ny, bitmap=bitmap,
+                                   level=level,
+                                   forecast_time=forecast_time))
+            values = np.where(bitmap, ints, np.nan).reshape(ny, nx)
+            expected[forecast_time, level] = np.flipud(values)
+        fp.write(grib1_message(np.zeros(nx*ny), nx, ny, param=33))
+    fp.close()
+
+    data, forecast_times, levels = umgrib.read_all(fname, 11, ny, nx)
+    assert_equal(data.shape, (3, 2, ny, nx))
+    assert_equal(data.dtype, np.float32)
+    assert_equal(forecast_times, [0, 6, 12])
+    assert_equal(levels, [500, 850])
+    for i, forecast_time in enumerate(forecast_times):
+        for j, level in enumerate(levels):
+            if (forecast_time, level) == (6, 500):
+                assert np.isnan(data[i, j]).all()
+            else:
+                assert_allclose(data[i, j], expected[forecast_time, level])
+                # read keeps wgrib's value for missing points
+                a = umgrib.read(fname, rows=ny, cols=nx, param=11,
+                                level=level, forecast_time=forecast_time)
+                assert_allclose(data[i, j], np.where(a > 9e20, np.nan, a))
+
+    data, forecast_times, levels = umgrib.read_all(fname, 11, ny, nx,
+                                                   levels=[850])
+    assert_equal(data.shape, (3, 1, ny, nx))
+    assert_allclose(data[2, 0], expected[12, 850])
+
+    data = umgrib.read_many(fname, [6, 1], ny, nx)
+    assert_allclose(data[0], expected[12, 850])
+    assert_allclose(data[1], expected[0, 850])
+
+    out = np.empty((2, ny, nx), dtype=np.float32)
+    assert umgrib.read_many(fname, [6, 1], ny, nx, out=out) is out
+    assert_allclose(out, data)
+    for bad in [np.empty((2, ny, nx + 1), dtype=np.float32),
+                np.empty((2, ny, nx), dtype=np.float64)]:
+        with pytest.raises(ValueError):
+            umgrib.read_many(fname, [6, 1], ny, nx, out=bad)
+
+def test_mpe_accumulate(tmpdir):
+    from datetime import datetime, timedelta
+
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import mpegrib
+
+    rows, cols = 3, 4
+    rates = np.random.randint(0, 1000, size=(4, rows*cols))
+    bitmap = np.ones((4, rows*cols), dtype=bool)
+    bitmap[1, :3] = False
+
+    slots = []
+    for i, minute in enumerate([0, 15, 45, 60*24 + 30]):
+        fname = str(tmpdir.join('%d.grb2' % i))
+        fp = open(fname, 'wb')
+        fp.write(grib2_message(rates[i][bitmap[i]], cols, rows,
+                               dec_scale=6, bitmap=bitmap[i]))
+        fp.close()
+        slots.append((datetime(2008, 1, 1) + timedelta(minutes=minute),
+                      fname))
+    slots.insert(2, (datetime(2008, 1, 1, 0, 30), None)) # missing slot
+
+    # oriented and scaled as read
+    rates = rates*1e-6*3600
+    rates = rates.reshape(4, rows, cols)[:, ::-1, ::-1]
+    bitmap = bitmap.reshape(4, rows, cols)[:, ::-1, ::-1]
+
+    totals = list(mpegrib.accumulate(slots, 'daily', rows, cols))
+    assert_equal([t[0] for t in totals],
+                 [datetime(2008, 1, 1), datetime(2008, 1, 2)])
+
+    expected = (rates[:3]*bitmap[:3]).sum(axis=0)/bitmap[:3].sum(axis=0)*24
+    assert_equal(totals[0][1].dtype, np.float32)
+    assert_allclose(totals[0][1], expected, rtol=1e-5)
+    assert_allclose(totals[1][1], rates[3]*24, rtol=1e-5)
+
+    totals = list(mpegrib.accumulate(slots, 'dekadal', rows, cols))
+    assert_equal(len(totals), 1)
+    assert_allclose(totals[0][1],
+                    (rates*bitmap).sum(axis=0)/bitmap.sum(axis=0)*240,
+                    rtol=1e-5)
+
+    totals = list(mpegrib.accumulate(slots[:1] + slots[2:3], 'hourly',
+                                     rows, cols))
+    assert_equal(totals[0][1].mask, False)
+
+    accumulator = mpegrib.MPEAccumulator('hourly', rows, cols)
+    accumulator.add(slots[1][0], slots[1][1])
+    with pytest.raises(ValueError):
+        accumulator.add(datetime(2007, 12, 31), None)
+    total = accumulator.flush()[1]
+    assert_equal(total.mask, ~bitmap[1])
+    assert accumulator.flush() is None
+
+def test_cloud_frequency(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import clmgrib
+
+    rows, cols = 5, 3
+    masks = np.random.randint(0, 4, size=(6, rows*cols))
+    fnames = []
+    for i, mask in enumerate(masks):
+        fnames.append(str(tmpdir.join('%d.grb2' % i)))
+        fp = open(fnames[-1], 'wb')
+        fp.write(grib2_message(mask*100, cols, rows, dec_scale=2))
+        fp.close()
+
+    # oriented as read
+    masks = masks.reshape(6, rows, cols)[:, ::-1, ::-1]
+
+    mask = clmgrib.read_compact(fnames[0])
+    assert_equal(mask.dtype, np.uint8)
+    assert_equal(mask, masks[0])
+
+    packed = clmgrib.read_compact(fnames[0], packed=True)
+    assert_equal(packed.nbytes, 4)
+    assert_equal(clmgrib.unpack(packed, (rows, cols)), masks[0])
+
+    counter = clmgrib.cloud_frequency(fnames[:5], (rows, cols))
+    counter.add(clmgrib.pack(masks[5]))
+    assert_equal(counter.nslots, 6)
+
+    valid = (masks != 3).sum(axis=0)
+    assert_equal(counter.valid(), valid)
+
+    cloud, clear_land, clear_water = counter.frequencies()
+    for freq, value in [(cloud, 2), (clear_land, 1), (clear_water, 0)]:
+        assert_equal(freq.mask, valid == 0)
+        expected = (masks == value).sum(axis=0)/np.maximum(valid, 1.0)
+        assert_allclose(freq.filled(0), expected, rtol=1e-6)
+
+    # the counts are widened rather than wrap around
+    counter = clmgrib.CloudFrequency((rows, cols))
+    counter.nslots = 65535
+    counter.cloud[:] = 65535
+    counter.add(np.full((rows, cols), 2, np.uint8))
+    assert_equal(counter.cloud.dtype, np.uint32)
+    assert_equal(counter.cloud, 65536)
+    assert_equal(counter.valid(), 65536)
+    assert_allclose(counter.frequencies()[0], 1.0)
+
+def test_mpe_orientation(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import mpegrib, msggrid
+    from sahgutils.spatialtools import geos_forward
+
+    # Pretoria, south-east of the sub-satellite point
+    lon, lat = 28.2, -25.7
+
+    # EUMETSAT store the disk from its south-eastern corner, scanning
+    # east to west and south to north, under scanning mode 0
+    n = 3712
+    x, y = geos_forward(lon, lat)
+    raw_row = int(np.floor(n/2 - 1 + y/msggrid.RESOLUTION + 0.5))
+    raw_col = int(np.floor(n/2 - 1 - x/msggrid.RESOLUTION + 0.5))
+    raw = np.zeros((n, n), dtype=int)
+    raw[raw_row, raw_col] = 5
+
+    fname = str(tmpdir.join('mpe.grb2'))
+    fp = open(fname, 'wb')
+    fp.write(grib2_message(raw.ravel(), n, n, nbits=4, scan_mode=0))
+    fp.close()
+
+    a = mpegrib.read(fname)
+    rows, cols = np.nonzero(a.filled(0))
+    assert_equal(len(rows), 1)
+    assert rows[0] > n/2 and cols[0] > n/2 # south and east of the centre
+
+    lons, lats = msggrid.latlon(str(tmpdir))
+    assert_allclose((lons[rows[0], cols[0]], lats[rows[0], cols[0]]),
+                    (lon, lat), atol=0.05)
+    assert_equal(msggrid.pixel_index(lon, lat), (rows[0], cols[0]))
+
+    values = mpegrib.extract_stations([fname], [lon], [lat], processes=1,
+                                      verbose=False)
+    assert_allclose(values, a[rows, cols][None], rtol=1e-6)
+
+def test_extract_stations(tmpdir, capsys, monkeypatch):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import mpegrib, msggrid
+
+    lons = np.array([28.2, 18.4, 31.0, -17.5, 150.0])
+    lats = np.array([-25.7, -33.9, -29.9, 14.7, 0.0])
+    rows, cols = msggrid.pixel_index(lons, lats)
+    assert_equal(rows[4], -999) # not visible
+
+    n = 3712
+    rates = np.random.permutation(999)[:12].reshape(3, 4) + 1
+    fnames = []
+    for i in range(3):
+        # oriented as read, only the station pixels have data
+        grid = np.zeros((n, n), dtype=int)
+        grid[rows[:4], cols[:4]] = rates[i]
+        raw = grid[::-1, ::-1].ravel()
+        bitmap = raw > 0
+        if i == 1:
+            bitmap[raw == rates[1, 2]] = False # masked station
+
+        fnames.append(str(tmpdir.join('%d.grb2' % i)))
+        fp = open(fnames[-1], 'wb')
+        fp.write(grib2_message(raw[bitmap], n, n, nbits=10, dec_scale=6,
+                               bitmap=bitmap))
+        fp.close()
+    fnames.insert(1, str(tmpdir.join('missing.grb2')))
+
+    expected = np.empty((4, 5))
+    expected.fill(np.nan)
+    expected[[0, 2, 3], :4] = rates*1e-6*3600
+    expected[2, 2] = np.nan
+
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    values = mpegrib.extract_stations(fnames, lons, lats, processes=2,
+                                      checkpoint=checkpoint,
+                                      checkpoint_every=1, verbose=False)
+    assert_equal(values.dtype, np.float32)
+    assert_allclose(values, expected, rtol=1e-6)
+
+    # restarting from the checkpoint doesn't read the files again
+    os.remove(fnames[0])
+    values = mpegrib.extract_stations(fnames, lons, lats,
+                                      checkpoint=checkpoint, verbose=False)
+    assert_allclose(values, expected, rtol=1e-6)
+
+    # a crash while the checkpoint is saved leaves the previous one
+    def crash(src, dst):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(os, 'rename', crash)
+    with pytest.raises(KeyboardInterrupt):
+        mpegrib.extract_stations(fnames, lons, lats, checkpoint=checkpoint,
+                                 verbose=False)
+    monkeypatch.undo()
+    values = mpegrib.extract_stations(fnames, lons, lats,
+                                      checkpoint=checkpoint, verbose=False)
+    assert_allclose(values, expected, rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        mpegrib.extract_stations(fnames[1:], lons, lats,
+                                 checkpoint=checkpoint, verbose=False)
+
+    values = mpegrib.extract_stations(fnames[2:], lons[:2], lats[:2],
+                                      processes=1, verbose=True)
+    assert_allclose(values, expected[2:, :2], rtol=1e-6)
+    assert 'Extracted 2 of 2 remaining files' in capsys.readouterr()[0]
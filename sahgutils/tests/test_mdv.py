@@ -0,0 +1,260 @@
+def write_mdv(fname, fields):
+    """Write a minimal MDV file for testing.
+
+    `fields` is a list of (name, stored, encoding, scale, bias,
+    compression, vlevels) tuples, where `stored` is an (nz, ny, nx)
+    array of the encoded values and `compression` is None for planes
+    stored back to back, or one of 'raw', 'zlib' or 'gzip'.
+
+    """
+    import gzip
+    import struct
+    import zlib
+    from StringIO import StringIO
+
+    import numpy as np
+
+    from sahgutils.io import mdv
+
+    nfields = len(fields)
+    field_hdr_offset = 1024
+    vlevel_hdr_offset = field_hdr_offset + 416*nfields
+    data_offset = vlevel_hdr_offset + 1024*nfields
+
+    dtypes = {mdv.ENCODING_INT8: '>u1', mdv.ENCODING_INT16: '>u2',
+              mdv.ENCODING_FLOAT32: '>f4'}
+    cookies = {'raw': 0x2f2f2f2f, 'zlib': 0xf5f5f5f5, 'gzip': 0xf7f7f7f7}
+
+    field_hdrs = []
+    vlevel_hdrs = []
+    volumes = []
+    for name, stored, encoding, scale, bias, compression, levels in fields:
+        nz, ny, nx = stored.shape
+        planes = [stored[k].astype(dtypes[encoding]).tostring()
+                  for k in range(nz)]
+
+        if compression is None:
+            volume = ''.join(planes)
+            compression_type = 0
+        else:
+            coded = []
+            for plane in planes:
+                if compression == 'zlib':
+                    body = zlib.compress(plane)
+                elif compression == 'gzip':
+                    sio = StringIO()
+                    gz = gzip.GzipFile(fileobj=sio, mode='wb')
+                    gz.write(plane)
+                    gz.close()
+                    body = sio.getvalue()
+                else:
+                    body = plane
+                coded.append(struct.pack('>4I2I', cookies[compression],
+                                         len(plane), len(body) + 24,
+                                         len(body), 0, 0) + body)
+            offsets = np.cumsum([0] + [len(c) for c in coded[:-1]])
+            nbytes = [len(c) for c in coded]
+            volume = (np.array(offsets, dtype='>u4').tostring() +
+                      np.array(nbytes, dtype='>u4').tostring() +
+                      ''.join(coded))
+            compression_type = 3
+
+        # Leading record length, the volume, trailing record length
+        field_data_offset = data_offset + 4
+        data_offset += len(volume) + 8
+        volumes.append(struct.pack('>I', len(volume)) + volume +
+                       struct.pack('>I', len(volume)))
+
+        ints = [408, 14153, 0, 0, 0, 0, 0, 0, 0, nx, ny, nz, 0, encoding,
+                np.dtype(dtypes[encoding]).itemsize, field_data_offset,
+                len(volume)] + [0]*10 + \
+               [compression_type, 0, 0, 0, 0, 0, 3, 0, 0] + [0]*4
+        floats = [0.0]*31
+        floats[19] = 0.0 # bad_data_value
+        floats[20] = 255.0 if encoding == mdv.ENCODING_INT8 else -9999.0
+        floats[17] = scale
+        floats[18] = bias
+        field_hdrs.append(struct.pack(mdv._field_fmt, *(
+            ints + floats + ['', name, 'dBZ', '', '', 408])))
+
+        types = [0]*122
+        values = list(levels) + [0.0]*(122 - len(levels))
+        vlevel_hdrs.append(struct.pack(mdv._vlevel_fmt, *(
+            [1016, 14154] + types + [0]*4 + values + [0.0]*5 + [1016])))
+
+    master = [1016, 14152, 1] + [0]*16 + [nfields, 0, 0, 0, 0,
+              field_hdr_offset, vlevel_hdr_offset, data_offset, 0] + \
+             [0]*8 + [0] + [0]*5 + [0.0]*6 + [0.0]*3 + [0.0]*12 + \
+             ['', 'test', '', 1016]
+
+    fp = open(fname, 'wb')
+    fp.write(struct.pack(mdv._master_fmt, *master))
+    fp.write(''.join(field_hdrs))
+    fp.write(''.join(vlevel_hdrs))
+    fp.write(''.join(volumes))
+    fp.close()
+
+def test_read_mdv(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+    import pytest
+
+    from sahgutils.io import mdv
+
+    nz, ny, nx = 3, 4, 5
+    dbz = np.random.randint(1, 255, size=(nz, ny, nx))
+    dbz[0, 0, 0] = 0 # bad
+    dbz[1, 2, 3] = 255 # missing
+    vel = np.random.randint(1, 60000, size=(nz, ny, nx))
+    rate = np.random.uniform(0, 50, size=(nz, ny, nx)).astype(np.float32)
+    rate[2, 1, 1] = -9999.0
+    levels = [1.5, 3.0, 4.5]
+
+    fname = str(tmpdir.join('test.mdv'))
+    write_mdv(fname, [
+        ('DBZ', dbz, mdv.ENCODING_INT8, 0.5, -32.0, 'zlib', levels),
+        ('VEL', vel, mdv.ENCODING_INT16, 0.001, -30.0, 'gzip', levels),
+        ('RATE', rate, mdv.ENCODING_FLOAT32, 1.0, 0.0, None, levels),
+        ('RAW', dbz, mdv.ENCODING_INT8, 1.0, 0.0, 'raw', levels)])
+
+    mdv_file = mdv.MDVFile(fname)
+    assert_equal(mdv_file.header()['nfields'], 4)
+    assert_equal(mdv_file.header()['data_set_name'], 'test')
+    assert_equal(mdv_file.field_names(), ['DBZ', 'VEL', 'RATE', 'RAW'])
+    assert_equal(mdv_file.field_header('VEL')['nz'], nz)
+    assert_allclose(mdv_file.vlevels('DBZ'), levels)
+
+    for k in range(nz):
+        data = mdv_file.read_plane('DBZ', k)
+        assert_equal(data.dtype, np.float32)
+        assert_equal(data.mask, (dbz[k] == 0) | (dbz[k] == 255))
+        assert_allclose(data.filled(np.nan)[~data.mask],
+                        0.5*dbz[k][~data.mask] - 32.0)
+
+        data = mdv_file.read_plane(1, k)
+        assert_allclose(data, 0.001*vel[k] - 30.0, atol=1e-5)
+
+        data = mdv.read_mdv(fname, 'RATE', k)
+        assert_equal(data.mask, rate[k] == -9999.0)
+        assert_equal(data.compressed(), rate[k][rate[k] != -9999.0])
+
+        data = mdv_file.read_plane('RAW', k)
+        assert_equal(data.mask, (dbz[k] == 0) | (dbz[k] == 255))
+
+    with pytest.raises(KeyError):
+        mdv_file.read_plane('ZDR')
+    with pytest.raises(IndexError):
+        mdv_file.read_plane(0, nz)
+
+def test_decompress():
+    import struct
+    import zlib
+
+    import pytest
+
+    from sahgutils.io import mdv
+
+    plane = 'radar plane' * 10
+    for cookie in [0x2f2f2f2f, 0xf2f2f2f2, 0xf4f4f4f4, 0xf6f6f6f6,
+                   0xf8f8f8f8]:
+        buf = struct.pack('>4I2I', cookie, len(plane), len(plane) + 24,
+                          len(plane), 0, 0) + plane
+        assert mdv._decompress(buf) == plane
+
+    body = zlib.compress(plane)
+    buf = struct.pack('>4I2I', 0xf5f5f5f5, len(plane), len(body) + 24,
+                      len(body), 0, 0) + body
+    assert mdv._decompress(buf) == plane
+
+    # bzip2 compressed planes are not supported
+    buf = struct.pack('>4I2I', 0xf3f3f3f3, len(plane), len(body) + 24,
+                      len(body), 0, 0) + body
+    with pytest.raises(NotImplementedError):
+        mdv._decompress(buf)
+
+def test_read_volume(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+    import pytest
+
+    from sahgutils.io import mdv
+
+    nz, ny, nx = 4, 3, 5
+    dbz = np.random.randint(1, 255, size=(nz, ny, nx))
+    dbz[:, 0, 0] = 255 # missing column
+    dbz[2, 1, 1] = 0 # bad
+    zdr = np.random.randint(1, 255, size=(nz, ny, nx))
+    levels = [1.0, 2.0, 3.0, 4.0]
+
+    fname = str(tmpdir.join('test.mdv'))
+    write_mdv(fname, [
+        ('DBZ', dbz, mdv.ENCODING_INT8, 0.5, -32.0, 'zlib', levels),
+        ('ZDR', zdr, mdv.ENCODING_INT8, 0.1, -5.0, None, levels),
+        ('SMALL', dbz[:, :2], mdv.ENCODING_INT8, 1.0, 0.0, 'zlib', levels)])
+
+    expected = np.where((dbz == 0) | (dbz == 255), np.nan, 0.5*dbz - 32.0)
+
+    mdv_file = mdv.MDVFile(fname)
+    volume = mdv_file.read_volume(['DBZ', 'ZDR'])
+    assert_equal(volume.shape, (2, nz, ny, nx))
+    assert_equal(volume.dtype, np.float32)
+    assert_allclose(volume[0], expected, rtol=1e-6)
+    assert_allclose(volume[1], 0.1*zdr - 5.0, rtol=1e-5, atol=1e-6)
+
+    out = np.zeros((1, 2, ny, nx), dtype=np.float32)
+    volume = mdv_file.read_volume([0], levels=[3, 1], out=out)
+    assert volume is out
+    assert_allclose(out[0], expected[[3, 1]], rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        mdv_file.read_volume(['DBZ', 'SMALL'])
+    with pytest.raises(ValueError):
+        mdv_file.read_volume([0], out=np.zeros((1, nz, ny, nx), dtype=int))
+    with pytest.raises(ValueError):
+        mdv_file.read_volume([0], out=np.zeros((1, nz, ny, 2)))
+
+    planes = list(mdv_file.iter_planes('DBZ', levels=[2, 0]))
+    assert_equal([level for level, data in planes], [2, 0])
+    assert_allclose(planes[0][1].filled(np.nan), expected[2], rtol=1e-6)
+
+    colmax = mdv_file.column_max('DBZ')
+    assert_equal(colmax.mask, np.isnan(expected).all(axis=0))
+    assert_allclose(colmax.filled(np.nan), np.nanmax(expected, axis=0),
+                    rtol=1e-6)
+
+    top = mdv_file.echo_top('DBZ', threshold=20.0)
+    reached = np.where(np.isnan(expected), -np.inf, expected) >= 20.0
+    assert_equal(top.mask, ~reached.any(axis=0))
+    highest = nz - 1 - np.argmax(reached[::-1], axis=0)
+    assert_equal(top.compressed(),
+                 np.array(levels)[highest][reached.any(axis=0)])
+
+def test_render_batch(tmpdir):
+    import os
+
+    import numpy as np
+    import pytest
+
+    from sahgutils.io import mdv
+
+    assert mdv.render_batch([], verbose=False) == []
+
+    pytest.importorskip('matplotlib')
+
+    dbz = np.random.randint(1, 255, size=(2, 6, 8))
+    mdv_names = []
+    for i in range(3):
+        fname = str(tmpdir.join('20100101_1200%02d.mdv' % (5*i)))
+        write_mdv(fname, [('DBZ', dbz, mdv.ENCODING_INT8, 0.5, -32.0,
+                           'zlib', [1.0, 2.0])])
+        mdv_names.append(fname)
+
+    assert mdv.colormap() is mdv.colormap()
+
+    fig_dir = str(tmpdir.join('figs'))
+    fig_names = mdv.render_batch(mdv_names, fig_dir, field='DBZ',
+                                 processes=2, verbose=False)
+    assert fig_names == [os.path.join(fig_dir, '20100101_1200%02d.png' % m)
+                         for m in (0, 5, 10)]
+    for fig_name in fig_names:
+        assert os.path.getsize(fig_name) > 0
@@ -0,0 +1,54 @@
+def test_geos_projection():
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.spatialtools import geos_forward, geos_inverse
+
+    lons = np.array([0, 20, -30, 60, 28.2, 100])
+    lats = np.array([0, -30, 45, 10, -25.7, 0])
+
+    x, y = geos_forward(lons, lats)
+    assert_equal((x[0], y[0]), (0, 0))
+    assert x[1] > 0 and y[1] < 0
+    assert np.isnan(x[5]) and np.isnan(y[5]) # beyond the limb
+
+    lon, lat = geos_inverse(x[:5], y[:5])
+    assert_allclose(lon, lons[:5], atol=1e-9)
+    assert_allclose(lat, lats[:5], atol=1e-9)
+
+    lon, lat = geos_inverse(6e6, 0) # off the disk
+    assert np.isnan(lon) and np.isnan(lat)
+
+    x, y = geos_forward(3.4, 0, sub_lon=3.4)
+    assert_allclose((x, y), (0, 0), atol=1e-6)
+
+def test_msg_grid(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import msggrid
+
+    lons, lats = msggrid.latlon(str(tmpdir))
+    assert_equal(lons.shape, (3712, 3712))
+    assert_equal(lons.dtype, np.float32)
+    assert isinstance(lons, np.memmap)
+    assert_allclose((lons[1856, 1856], lats[1856, 1856]), (0, 0), atol=1e-6)
+    assert np.isnan(lons[0, 0])
+    assert lats[100, 1856] > 60 and lons[1856, 3000] > 0 # north up, east right
+
+    # the cached grids are re-used
+    lons2, lats2 = msggrid.latlon(str(tmpdir))
+    assert lons2.filename == lons.filename
+
+    rows = np.array([1856, 1000, 3000, 2500])
+    cols = np.array([1856, 1200, 2500, 700])
+    point_lons = np.append(lons[rows, cols], 120)
+    point_lats = np.append(lats[rows, cols], 0)
+
+    r, c = msggrid.pixel_index(point_lons, point_lats)
+    assert_equal(r, np.append(rows, -999))
+    assert_equal(c, np.append(cols, -999))
+
+    index = msggrid.flat_index(point_lons, point_lats)
+    assert_equal(index[:4], rows*3712 + cols)
+    assert_equal(index[4], -999)
@@ -0,0 +1,166 @@
+def test_ease_grid():
+    import numpy as np
+    from numpy.testing import assert_equal
+    import pytest
+
+    from sahgutils.io import nsidc
+
+    assert_equal(nsidc.ease_grid_index(0.0, 1.0), (691, 287))
+    assert_equal(nsidc.ease_grid_index(10.0, -15.0), (729, 368))
+    assert_equal(nsidc.ease_grid_index(41.0, -35.0), (849, 461))
+    assert_equal(nsidc.ease_grid_index(-179.9, 0.5), (0, 290))
+
+    # the centres of the cells map back to the cells
+    cols, rows = np.meshgrid(np.arange(0, nsidc.EASE_COLS, 7),
+                             np.arange(1, nsidc.EASE_ROWS - 1, 5))
+    cos_30 = np.cos(np.radians(30.0))
+    lons = np.degrees((cols - 691.0)/(nsidc._ease_scale*cos_30))
+    lats = np.degrees(np.arcsin((292.5 - rows)*cos_30/nsidc._ease_scale))
+    assert_equal(nsidc.ease_grid_index(lons, lats), (cols, rows))
+
+    assert_equal(nsidc.ease_grid_window(10, -35, 41, -15),
+                 (729, 368, 121, 94))
+
+    # boxes reaching off the grid are clipped
+    assert_equal(nsidc.ease_grid_window(-200, -90, 200, 90),
+                 (0, 0, nsidc.EASE_COLS, nsidc.EASE_ROWS))
+    xoff, yoff, xsize, ysize = nsidc.ease_grid_window(170, -10, 200, 10)
+    assert_equal(xoff + xsize, nsidc.EASE_COLS)
+
+    with pytest.raises(ValueError):
+        nsidc.ease_grid_window(-300, 0, -200, 10) # west of the grid
+    with pytest.raises(ValueError):
+        nsidc.ease_grid_window(20, 0, 10, 10) # empty box
+
+def test_ae_land3_file(tmpdir):
+    import pytest
+
+    pytest.importorskip('osgeo')
+
+    from sahgutils.io import nsidc
+
+    with pytest.raises(IOError):
+        nsidc.AELand3File(str(tmpdir.join('missing.hdf')))
+
+def test_build_cube(tmpdir, monkeypatch):
+    import os
+
+    import numpy as np
+    from numpy.testing import assert_equal
+    import pytest
+
+    from sahgutils.io import nsidc
+
+    window = (729, 368, 4, 3)
+    shape = (3, 4)
+
+    calls = []
+    def read_overpasses(args):
+        hdf_fname, field, window = args
+        calls.append(os.path.basename(hdf_fname))
+        if 'bad' in hdf_fname:
+            raise RuntimeError('interrupted')
+        day = float(nsidc.file_date(hdf_fname).astype(int))
+        return [np.full(shape, day, np.float32),
+                np.full(shape, -day, np.float32)]
+    monkeypatch.setattr(nsidc, '_read_overpasses', read_overpasses)
+
+    def build(days, **kwargs):
+        del calls[:]
+        hdf_fnames = ['AMSR_E_L3_DailyLand_V06_201001%02d.hdf' % day
+                      for day in days]
+        return nsidc.build_cube(hdf_fnames, cube_dir, window, processes=1,
+                                verbose=False, **kwargs)
+
+    def check(dates, asc, desc, first, last, days):
+        assert_equal(dates, np.arange('2010-01-%02d' % first,
+                                      '2010-01-%02d' % (last + 1),
+                                      dtype='datetime64[D]'))
+        assert_equal(asc.shape, (len(dates),) + shape)
+        for t, date in enumerate(dates):
+            if date.astype(object).day in days:
+                assert_equal(asc[t], date.astype(int))
+                assert_equal(desc[t], -date.astype(int))
+            else:
+                assert np.isnan(asc[t]).all() and np.isnan(desc[t]).all()
+
+    # nothing to ingest into a new cube
+    cube_dir = str(tmpdir.join('cube'))
+    dates, asc, desc = build([])
+    assert_equal(len(dates), 0)
+    assert_equal(asc.shape, (0,) + shape)
+    assert_equal(desc.shape, (0,) + shape)
+
+    # a partial run is resumed from its last checkpoint
+    with pytest.raises(RuntimeError):
+        nsidc.build_cube(['AMSR_E_L3_DailyLand_V06_20100110.hdf',
+                          'bad_AMSR_E_L3_DailyLand_V06_20100112.hdf'],
+                         cube_dir, window, processes=1, checkpoint_every=1,
+                         verbose=False)
+    dates, asc, desc = build([10, 12])
+    assert_equal(calls, ['AMSR_E_L3_DailyLand_V06_20100112.hdf'])
+    check(dates, asc, desc, 10, 12, [10, 12])
+    del asc, desc
+
+    # files already ingested are skipped
+    dates, asc, desc = build([10, 12])
+    assert_equal(calls, [])
+    check(dates, asc, desc, 10, 12, [10, 12])
+    del asc, desc
+
+    # the time axis is extended at both ends
+    dates, asc, desc = build([8, 10, 12, 15])
+    assert_equal(calls, ['AMSR_E_L3_DailyLand_V06_20100108.hdf',
+                         'AMSR_E_L3_DailyLand_V06_20100115.hdf'])
+    check(dates, asc, desc, 8, 15, [8, 10, 12, 15])
+    del asc, desc
+
+    # an interruption while growing the cubes leaves them usable
+    save_cube_index = nsidc._save_cube_index
+    def fail(*args):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(nsidc, '_save_cube_index', fail)
+    with pytest.raises(KeyboardInterrupt):
+        build([20])
+    monkeypatch.setattr(nsidc, '_save_cube_index', save_cube_index)
+    dates, asc, desc = build([8])
+    check(dates, asc, desc, 8, 15, [8, 10, 12, 15])
+    del asc, desc
+
+    # and so does one after the index is saved
+    replace = nsidc._replace
+    def fail_desc(tmp_name, name):
+        if name.endswith('desc.npy'):
+            raise KeyboardInterrupt
+        replace(tmp_name, name)
+    monkeypatch.setattr(nsidc, '_replace', fail_desc)
+    with pytest.raises(KeyboardInterrupt):
+        build([20])
+    monkeypatch.setattr(nsidc, '_replace', replace)
+    dates, asc, desc = build([20])
+    assert_equal(calls, ['AMSR_E_L3_DailyLand_V06_20100120.hdf'])
+    check(dates, asc, desc, 8, 20, [8, 10, 12, 15, 20])
+    assert not os.path.exists(os.path.join(cube_dir, 'asc.npy.tmp'))
+    assert not os.path.exists(os.path.join(cube_dir, 'desc.npy.tmp'))
+    del asc, desc
+
+    # a crash while the index is saved leaves the previous index
+    index_name = os.path.join(cube_dir, 'index.npz')
+    rename = os.rename
+    def crash(src, dst):
+        if dst == index_name:
+            raise KeyboardInterrupt
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', crash)
+    with pytest.raises(KeyboardInterrupt):
+        build([22])
+    monkeypatch.setattr(os, 'rename', rename)
+    assert os.path.exists(index_name)
+    dates, asc, desc = build([20])
+    assert_equal(calls, [])
+    check(dates, asc, desc, 8, 20, [8, 10, 12, 15, 20])
+    del asc, desc
+
+    with pytest.raises(ValueError):
+        nsidc.build_cube([], cube_dir, (0, 0, 4, 3), processes=1,
+                         verbose=False)
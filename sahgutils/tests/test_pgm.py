@@ -0,0 +1,128 @@
+def write_pgm(fname, data, maxval=1023, comment='offset=-0.5 slope=0.01'):
+    """Write a binary PGM file for testing."""
+    import numpy as np
+
+    if maxval > 255:
+        raw = np.asarray(data, dtype='>u2').tostring()
+    else:
+        raw = np.asarray(data, dtype=np.uint8).tostring()
+
+    rows, cols = np.shape(data)
+    header = 'P5\n# %s\n%d %d\n%d\n' % (comment, cols, rows, maxval)
+
+    fp = open(fname, 'wb')
+    fp.write(header + raw)
+    fp.close()
+
+def test_read_pgm(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import pgm
+
+    data = np.arange(12, dtype=np.uint16).reshape(3, 4)*90
+    fname = str(tmpdir.join('test.pgm'))
+    write_pgm(fname, data)
+
+    header, counts = pgm.read_pgm(fname)
+    assert_equal(header['rows'], 3)
+    assert_equal(header['cols'], 4)
+    assert_equal(header['maxval'], 1023)
+    assert_equal(header['offset'], -0.5)
+    assert_equal(header['slope'], 0.01)
+    assert_equal(counts, data)
+
+    counts = pgm.read_sensor_count(fname)
+    assert_equal(counts.dtype, np.uint16)
+    assert_equal(counts.mask, data == 0)
+    assert_equal(counts.compressed(), data[data != 0])
+
+    radiance = pgm.read_radiance(fname)
+    assert_equal(radiance.mask, data == 0)
+    assert_allclose(radiance.compressed(), -0.5 + 0.01*data[data != 0])
+
+    # 8-bit data, comments between the header fields
+    fp = open(fname, 'wb')
+    fp.write('P5 4\n# a comment\n3 # another\n255\n' +
+             data.astype(np.uint8).tostring())
+    fp.close()
+
+    header, counts = pgm.read_pgm(fname)
+    assert_equal(header['offset'], None)
+    assert_equal(header['comments'], ['a comment', 'another'])
+    assert_equal(counts, data.astype(np.uint8))
+
+def test_read_btemp(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+    import pytest
+
+    from sahgutils.io import pgm
+
+    data = np.array([[0, 100, 200], [400, 800, 1023]], dtype=np.uint16)
+
+    assert_equal(pgm.channel_number('200701011200_ch09.pgm'), 9)
+    assert_equal(pgm.channel_number('/data/ch10/200701011200.pgm'), None)
+
+    fname = str(tmpdir.join('test.pgm'))
+    write_pgm(fname, data, comment='offset=-5.0 slope=0.2')
+    with pytest.raises(ValueError):
+        pgm.read_btemp(fname)
+
+    fname = str(tmpdir.join('200701011200_ch09.pgm'))
+    write_pgm(fname, data, comment='offset=-5.0 slope=0.2')
+
+    radiance = -5.0 + 0.2*data[data != 0]
+    nu, A, B = 930.659, 0.9983, 0.627
+    expected = (1.43877*nu/np.log(1.19104E-5*nu**3/radiance + 1) - B)/A
+
+    btemp = pgm.read_btemp(fname)
+    assert_equal(btemp.mask, data == 0)
+    assert_allclose(btemp.compressed(), expected, rtol=1e-6)
+
+    counts, lut = pgm.read_calibrated(fname)
+    assert lut is pgm.btemp_lut(9, -5.0, 0.2)
+    assert_allclose(lut[counts][data != 0], expected, rtol=1e-6)
+
+    radiance = pgm.read_radiance(fname)
+    assert_allclose(radiance.compressed(), -5.0 + 0.2*data[data != 0],
+                    rtol=1e-6)
+
+def test_read_slots(tmpdir):
+    from datetime import datetime
+
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+
+    from sahgutils.io import pgm
+
+    pattern = str(tmpdir.join('%Y%m%d%H%M_ch{channel:02d}.pgm'))
+    start = datetime(2007, 1, 1, 12, 0)
+    end = datetime(2007, 1, 1, 12, 30)
+
+    data = np.random.randint(1, 1024, size=(3, 2, 4, 5)).astype(np.uint16)
+    for i, minute in enumerate([0, 15, 30]):
+        for j, channel in enumerate([9, 10]):
+            if (i, j) == (1, 1):
+                continue # missing file
+            fname = datetime(2007, 1, 1, 12, minute).strftime(pattern)
+            write_pgm(fname.format(channel=channel), data[i, j],
+                      comment='offset=-5.0 slope=0.2')
+
+    slots, counts, available = pgm.read_slots(pattern, start, end,
+                                              channels=[9, 10],
+                                              verbose=False)
+    assert_equal(len(slots), 3)
+    assert_equal(slots[1], datetime(2007, 1, 1, 12, 15))
+    assert_equal(counts.dtype, np.uint16)
+    assert_equal(available, [[True, True], [True, False], [True, True]])
+    data[1, 1] = 0
+    assert_equal(counts, data)
+
+    slots, btemp, available = pgm.read_slots(
+        pattern, start, end, channels=[9, 10], quantity='btemp',
+        memmap_fname=str(tmpdir.join('btemp.dat')), threads=2,
+        verbose=False)
+    assert isinstance(btemp, np.memmap)
+    assert_allclose(btemp[0, 1], pgm.btemp_lut(10, -5.0, 0.2)[data[0, 1]])
+    assert np.isnan(btemp[1, 1]).all()
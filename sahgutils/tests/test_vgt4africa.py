@@ -0,0 +1,115 @@
+def write_archive(fname, ndvi=None):
+    """Write a zipped VGT4Africa archive with a LOG.TXT file for testing.
+
+    The grid is that of the continental NDVI product, 1/112 degree
+    cells with the lower left corner at (-26, -35). If `ndvi` is given
+    it is written as the HDF dataset, which requires GDAL.
+
+    """
+    import os
+    from zipfile import ZipFile
+
+    from sahgutils.io import vgt4africa
+
+    log = ['PRODUCT_ID        V2KRNS10__20100101_NDVI__Africa',
+           '',
+           'MAP_PROJ_RESOLUTION     0.008928571',
+           'CARTO_LOWER_LEFT_X      -26.0',
+           'CARTO_LOWER_LEFT_Y      -35.0']
+
+    archive = ZipFile(fname, 'w')
+    archive.writestr(vgt4africa._log_member, '\r\n'.join(log) + '\r\n')
+    if ndvi is not None:
+        from osgeo import gdal
+
+        hdf_fname = fname + '.hdf'
+        driver = gdal.GetDriverByName('HDF4Image')
+        dataset = driver.Create(hdf_fname, ndvi.shape[1], ndvi.shape[0],
+                                1, gdal.GDT_Byte)
+        dataset.GetRasterBand(1).WriteArray(ndvi)
+        del dataset
+        archive.write(hdf_fname, vgt4africa._ndvi_member)
+        os.remove(hdf_fname)
+    archive.close()
+
+def test_read_georeference(tmpdir):
+    from zipfile import ZipFile
+
+    from numpy.testing import assert_allclose
+
+    from sahgutils.io import vgt4africa
+
+    fname = str(tmpdir.join('ndvi.zip'))
+    write_archive(fname)
+
+    archive = ZipFile(fname)
+    x0, y0, dx, dy = vgt4africa._read_georeference(archive)
+    archive.close()
+
+    assert_allclose([dx, dy], [0.008928571, 0.008928571])
+    assert_allclose([x0, y0], [-26.0 + dx/2, -35.0 + dy/2])
+
+def test_subset_window():
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+    import pytest
+
+    from sahgutils.io import vgt4africa
+    from sahgutils.io.arraytools import Raster
+
+    rows, cols = 40, 60
+    x0, y0, dx, dy = 10.25, -35.25, 0.5, 0.5
+    data = np.arange(rows*cols).reshape(rows, cols)
+    raster = Raster(data, x0, y0, dx, dy)
+
+    for box in [(-30.0, 15.0, -25.0, 22.0), (-35.5, 10.0, -15.5, 39.9),
+                (-20.2, 30.3, -16.1, 34.7)]:
+        min_lat, min_lon, max_lat, max_lon = box
+        window, origin = vgt4africa._subset_window(x0, y0, dx, dy,
+                                                   rows, cols, *box)
+        xoff, yoff, xsize, ysize = window
+        expected = raster.subset(min_lon, min_lat, max_lon, max_lat)
+        assert_equal(data[yoff:yoff + ysize, xoff:xoff + xsize], expected)
+        assert_allclose(origin, (expected.x0, expected.y0))
+
+    # areas outside the raster
+    for box in [(-40.0, 15.0, -25.0, 22.0), (-30.0, 15.0, -25.0, 45.0),
+                (10.0, 50.0, 20.0, 60.0)]:
+        with pytest.raises(ValueError):
+            vgt4africa._subset_window(x0, y0, dx, dy, rows, cols, *box)
+
+def test_read_ndvi(tmpdir):
+    import numpy as np
+    from numpy.testing import assert_allclose, assert_equal
+    import pytest
+
+    pytest.importorskip('osgeo')
+
+    from sahgutils.io import vgt4africa
+
+    data = np.random.randint(0, 255, size=(30, 50)).astype(np.uint8)
+    fname = str(tmpdir.join('ndvi.zip'))
+    write_archive(fname, data)
+
+    ndvi = vgt4africa.read_ndvi(fname, masked=False)
+    assert_equal(ndvi, data)
+
+    box = (-34.9, -25.9, -34.8, -25.7)
+    window, origin = vgt4africa._subset_window(-26.0 + 0.008928571/2,
+                                               -35.0 + 0.008928571/2,
+                                               0.008928571, 0.008928571,
+                                               30, 50, *box)
+    xoff, yoff, xsize, ysize = window
+    expected = data[yoff:yoff + ysize, xoff:xoff + xsize]
+
+    ndvi = vgt4africa.read_ndvi(fname, *box)
+    assert_equal(ndvi.mask, expected == 0)
+    assert_allclose(ndvi.compressed(),
+                    (0.004*expected[expected > 0] - 0.1).clip(0, 0.8))
+
+    ndvi = vgt4africa.read_ndvi(fname, *box, masked=False)
+    assert_equal(ndvi, expected)
+    assert_allclose((ndvi.x0, ndvi.y0), origin)
+
+    with pytest.raises(ValueError):
+        vgt4africa.read_ndvi(fname, 0.0, 0.0, 1.0, 1.0)
@@ -0,0 +1,117 @@
+"""
+Benchmark reading MDV radar volumes natively against the old
+mdv2ASCII round trip.
+
+A zlib compressed, 8-bit MDV volume is written to a temporary
+directory and every level is read repeatedly with
+sahgutils.io.mdv.read_mdv. If mdv2ASCII is on the system path the
+previous implementation, which converted each plane to a text file
+and parsed that, is timed as well.
+
+Usage: python bench_mdv.py [repeats]
+
+"""
+import os
+import sys
+import time
+import zlib
+import struct
+import shutil
+import tempfile
+from subprocess import call
+
+import numpy as np
+
+from sahgutils.io import mdv
+
+def write_test_file(mdv_name, nz=18, ny=500, nx=500):
+    data = np.random.randint(0, 255, size=(nz, ny, nx)).astype(np.uint8)
+
+    coded = []
+    for k in range(nz):
+        plane = data[k].tostring()
+        body = zlib.compress(plane)
+        coded.append(struct.pack('>4I2I', 0xf5f5f5f5, len(plane),
+                                 len(body) + 24, len(body), 0, 0) + body)
+    nbytes = [len(c) for c in coded]
+    offsets = np.cumsum([0] + nbytes[:-1])
+    volume = (np.array(offsets, dtype='>u4').tostring() +
+              np.array(nbytes, dtype='>u4').tostring() + ''.join(coded))
+
+    field_data_offset = 1024 + 416 + 1024 + 4
+
+    ints = [408, 14153, 0, 0, 0, 0, 0, 0, 0, nx, ny, nz, 0,
+            mdv.ENCODING_INT8, 1, field_data_offset, len(volume)] + \
+           [0]*10 + [3, 0, 0, 0, 0, 0, 3, 0, 0] + [0]*4
+    floats = [0.0]*31
+    floats[17:21] = [0.5, -32.0, 0.0, 255.0] # scale, bias, bad, missing
+    field_hdr = struct.pack(mdv._field_fmt,
+                            *(ints + floats + ['', 'DBZ', 'dBZ', '', '', 408]))
+
+    levels = [1.5*(k + 1) for k in range(nz)] + [0.0]*(122 - nz)
+    vlevel_hdr = struct.pack(mdv._vlevel_fmt,
+                             *([1016, 14154] + [0]*126 + levels +
+                               [0.0]*5 + [1016]))
+
+    master = [1016, 14152, 1] + [0]*16 + [1, nx, ny, nz, 0, 1024,
+              1024 + 416, field_data_offset - 4, 0] + [0]*14 + \
+             [0.0]*21 + ['', 'bench', '', 1016]
+
+    fp = open(mdv_name, 'wb')
+    fp.write(struct.pack(mdv._master_fmt, *master))
+    fp.write(field_hdr + vlevel_hdr)
+    fp.write(struct.pack('>I', len(volume)) + volume +
+             struct.pack('>I', len(volume)))
+    fp.close()
+
+def read_mdv2ascii(mdv_name, field=0, level=0):
+    """The previous mdv2ASCII based implementation."""
+    txt_name = mdv_name[0:-4] + '.txt'
+
+    devnull = open(os.devnull, 'w')
+    call(['mdv2ASCII', mdv_name, str(field), str(level), txt_name],
+         stdout=devnull)
+    devnull.close()
+    a = np.loadtxt(txt_name)
+    os.remove(txt_name)
+
+    return a
+
+def have_mdv2ascii():
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.exists(os.path.join(path, 'mdv2ASCII')):
+            return True
+
+    return False
+
+def bench(func, mdv_name, repeats, nz=18):
+    start = time.time()
+    for i in range(repeats):
+        for level in range(nz):
+            data = func(mdv_name, 0, level)
+            data.sum()
+    elapsed = (time.time() - start)/repeats
+
+    print('%-20s %8.3f s per volume' % (func.__name__, elapsed))
+
+    return elapsed
+
+if __name__ == '__main__':
+    repeats = 5
+    if len(sys.argv) > 1:
+        repeats = int(sys.argv[1])
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mdv_name = os.path.join(tmp_dir, 'bench_120000.mdv')
+        write_test_file(mdv_name)
+
+        native = bench(mdv.read_mdv, mdv_name, repeats)
+
+        if have_mdv2ascii():
+            old = bench(read_mdv2ascii, mdv_name, repeats)
+            print('Speed up: %.1fx' % (old/native))
+        else:
+            print('mdv2ASCII not found, skipping the old code path')
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,96 @@
+"""
+Benchmark reading MSG PGM files natively against the old
+gdal_translate round trip.
+
+A full disk (3712x3712) 10-bit PGM file is written to a temporary
+directory and read repeatedly with sahgutils.io.pgm.read_sensor_count.
+If gdal_translate is on the system path the previous implementation,
+which converted the file to an EHdr .bin/.hdr pair and read that back,
+is timed as well.
+
+Usage: python bench_pgm.py [repeats]
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+from subprocess import call
+
+import numpy as np
+from numpy import ma
+
+from sahgutils.io import pgm
+
+def write_test_file(pgm_name, rows=3712, cols=3712):
+    data = np.random.randint(0, 1024, size=(rows, cols)).astype('>u2')
+
+    fp = open(pgm_name, 'wb')
+    fp.write('P5\n# offset=-2.55 slope=0.05\n%d %d\n1023\n' % (cols, rows))
+    data.tofile(fp)
+    fp.close()
+
+def read_gdal(pgm_name):
+    """The previous gdal_translate based implementation."""
+    bin_name = pgm_name[0:-4] + '.bin'
+    hdr_name = pgm_name[0:-4] + '.hdr'
+
+    devnull = open(os.devnull, 'w')
+    call(['gdal_translate', '-ot', 'UInt16', '-of', 'EHdr',
+          pgm_name, bin_name], stdout=devnull)
+    devnull.close()
+    data = np.fromfile(bin_name, dtype=np.uint16)
+    os.remove(bin_name)
+    os.remove(hdr_name)
+
+    f = open(pgm_name)
+    pgm_hdr = f.read(120)
+    f.close()
+
+    hdr_elems = pgm_hdr.split()
+    cols = int(hdr_elems[1])
+    rows = int(hdr_elems[2])
+
+    data = np.reshape(data, (rows, cols))
+    data = ma.masked_values(data, 0)
+
+    return data
+
+def have_gdal_translate():
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.exists(os.path.join(path, 'gdal_translate')):
+            return True
+
+    return False
+
+def bench(func, pgm_name, repeats):
+    start = time.time()
+    for i in range(repeats):
+        data = func(pgm_name)
+        data.sum()
+    elapsed = (time.time() - start)/repeats
+
+    print('%-20s %8.3f s per file' % (func.__name__, elapsed))
+
+    return elapsed
+
+if __name__ == '__main__':
+    repeats = 5
+    if len(sys.argv) > 1:
+        repeats = int(sys.argv[1])
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pgm_name = os.path.join(tmp_dir, 'bench_ch09.pgm')
+        write_test_file(pgm_name)
+
+        native = bench(pgm.read_sensor_count, pgm_name, repeats)
+
+        if have_gdal_translate():
+            gdal = bench(read_gdal, pgm_name, repeats)
+            print('Speed up: %.1fx' % (gdal/native))
+        else:
+            print('gdal_translate not found, skipping the old code path')
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,101 @@
+"""
+Benchmark reading VGT4Africa NDVI archives with windowed reads against
+the old extract-everything implementation.
+
+The southern Africa sub-region is read from each archive given on the
+command line, first with sahgutils.io.vgt4africa.read_ndvi, then with
+the previous implementation, which extracted the HDF file to curr.hdf
+and read the whole continent before cropping with Raster.subset. The
+new reader is also timed from several threads at once.
+
+Usage: python bench_vgt4africa.py ndvi.zip [ndvi.zip ...]
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+from zipfile import ZipFile
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from numpy import ma
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+from sahgutils.io import vgt4africa
+from sahgutils.io.arraytools import Raster
+
+# Southern Africa
+MIN_LAT, MIN_LON, MAX_LAT, MAX_LON = -35.0, 10.0, -15.0, 41.0
+
+def read_extract(ndvi_fname):
+    """The previous implementation, extracting to curr.hdf."""
+    temp_fname = 'curr.hdf'
+
+    archive = ZipFile(ndvi_fname)
+    x0, y0, dx, dy = vgt4africa._read_georeference(archive)
+    fp = open(temp_fname, 'wb')
+    fp.write(archive.read(vgt4africa._ndvi_member))
+    fp.close()
+    archive.close()
+
+    dataset = gdal.Open(temp_fname)
+    data = dataset.ReadAsArray()
+    del dataset
+    os.remove(temp_fname)
+
+    ndvi = Raster(data, x0, y0, dx, dy)
+    ndvi = ndvi.subset(MIN_LON, MIN_LAT, MAX_LON, MAX_LAT)
+    ndvi = ma.masked_equal(ndvi, 0)
+    ndvi = 0.004*ndvi - 0.1
+
+    return ndvi.clip(0, 0.8)
+
+def read_window(ndvi_fname):
+    return vgt4africa.read_ndvi(ndvi_fname, MIN_LAT, MIN_LON,
+                                MAX_LAT, MAX_LON)
+
+def bench(func, ndvi_fnames, threads=1):
+    start = time.time()
+    if threads == 1:
+        results = [func(fname) for fname in ndvi_fnames]
+    else:
+        pool = ThreadPool(threads)
+        results = pool.map(func, ndvi_fnames)
+        pool.close()
+        pool.join()
+    elapsed = (time.time() - start)/len(ndvi_fnames)
+
+    print('%-20s %2d thread(s) %8.3f s per file' %
+          (func.__name__, threads, elapsed))
+
+    return elapsed, results
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    ndvi_fnames = [os.path.abspath(fname) for fname in sys.argv[1:]]
+
+    # curr.hdf is written to the current directory by the old code
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+    try:
+        window, new = bench(read_window, ndvi_fnames)
+        extract, old = bench(read_extract, ndvi_fnames)
+        print('Speed up: %.1fx' % (extract/window))
+
+        for a, b in zip(new, old):
+            assert np.ma.allequal(a, b)
+
+        bench(read_window, ndvi_fnames, threads=4)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)